@@ -0,0 +1,70 @@
+"""Helpers shared by the tools which process caches in bulk."""
+
+import contextlib
+import os
+
+
+def run_tasks(func, tasks, workers=None):
+    """Call ``func(*args)`` for every tuple of arguments in ``tasks``.
+
+    The calls are spread across a pool of ``workers`` processes (one per CPU
+    if ``None``), unless there is only one worker or fewer than two tasks, in
+    which case they are run in this process.
+
+    :return: List of the results, in the same order as ``tasks``.
+
+    """
+
+    tasks = list(tasks)
+    if workers == 1 or len(tasks) < 2:
+        return [func(*args) for args in tasks]
+
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, *args) for args in tasks]
+        return [future.result() for future in futures]
+
+
+def check_xml_dst(dst_path):
+    """Check that a destination is an XML file, and create its directory.
+
+    :return: ``(dst_path, dst_base_path)``; the absolute path, and it without
+        the ``.xml``, to which frame names are appended.
+    :raises ValueError: if the path is not to an XML file.
+
+    """
+
+    dst_path = os.path.abspath(dst_path)
+    dst_base_path, dst_ext = os.path.splitext(dst_path)
+    if dst_ext != '.xml':
+        raise ValueError('destination must be an XML file; got %r' % dst_path)
+
+    dst_directory = os.path.dirname(dst_path)
+    if not os.path.exists(dst_directory):
+        os.makedirs(dst_directory)
+
+    return dst_path, dst_base_path
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', suffix='.tmp'):
+    """Open a temporary file which replaces ``path`` once it is complete.
+
+    If the block raises, the temporary file is removed and ``path`` is not
+    touched, so that a partial file is never mistaken for a complete one::
+
+        with atomic_write(path) as fh:
+            for chunk in frame.dumps_iter():
+                fh.write(chunk)
+
+    """
+
+    tmp_path = path + suffix
+    try:
+        with open(tmp_path, mode) as fh:
+            yield fh
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    os.rename(tmp_path, path)
@@ -55,6 +55,22 @@ class StructEncoder(Encoder):
         return ' '.join(repr(x) for x in self.unpack(encoded))
 
 
+class HalfEncoder(StructEncoder):
+
+    """Encoder for big-endian half floats, which :mod:`struct` can't handle."""
+
+    def __init__(self):
+        self.format_char = 'e'
+        self.size = 2
+
+    def unpack(self, encoded):
+        import numpy as np
+        count, rem = divmod(len(encoded), self.size)
+        if rem:
+            raise ValueError('encoded length %d is not multiple of %d; %d remains' % (len(encoded), self.size, rem))
+        return tuple(float(x) for x in np.frombuffer(encoded, dtype='>f2'))
+
+
 class StringEncoder(Encoder):
 
     def split(self, encoded, size_hint):
@@ -78,7 +94,10 @@ def register_encoder(names, encoder=None):
     Types that are registered upon import include:
 
     * ``"float"``;
-    * ``"uint"`` (32-bit big-endian integer);
+    * ``"double"``;
+    * ``"half"`` (16-bit float);
+    * ``"uint"`` and ``"int"`` (32-bit big-endian integers);
+    * ``"ushort"`` and ``"uchar"`` (16 and 8-bit unsigned integers);
     * ``"string"`` (``NULL`` terminated).
 
     :param names: A string, or iterable of strings.
@@ -103,7 +122,12 @@ def register_encoder(names, encoder=None):
 
 
 register_encoder('float', StructEncoder('f'))
+register_encoder('double', StructEncoder('d'))
+register_encoder('half', HalfEncoder())
 register_encoder('uint', StructEncoder('L'))
+register_encoder('int', StructEncoder('l'))
+register_encoder('ushort', StructEncoder('H'))
+register_encoder('uchar', StructEncoder('B'))
 register_encoder('string', StringEncoder())
 
 
@@ -134,14 +158,24 @@ tag_encoding = {
 
     # Cache headers.
     'VRSN': 'string', # cache version
-    'STIM': 'uint',   # cache start time
-    'ETIM': 'uint',   # cache end time
+    'STIM': 'int',    # cache start time
+    'ETIM': 'int',    # cache end time
 
     # Cache channels.
     'CHNM': 'string', # channel name
 
     # Cache data.
     'FBCA': 'float',  # floating cache array
+    'DBLA': 'double', # double cache array
+    'FVCA': 'float',  # float vector cache array
+    'DVCA': 'double', # double vector cache array
+    'DBCA': 'double', # double cache array, as written by some exporters
+
+    # Compact cache data (not understood by Maya); see mayatools.fluids.core.
+    'FHCA': 'half',   # half float cache array
+    'QSCL': 'double', # quantization scale and offset
+    'QSCA': 'ushort', # 16-bit quantized cache array
+    'QBCA': 'uchar',  # 8-bit quantized cache array
 
 }
 
@@ -316,8 +350,18 @@ class Chunk(object):
         for k, v in kwargs.iteritems():
             setattr(self, k, v)
 
+    @property
+    def data_size(self):
+        """The size of the data, even if it was skipped when parsing."""
+        if self.data is not None:
+            return len(self.data)
+        return getattr(self, 'size', 0)
+
     def pprint(self, _indent):
         """Print a structured representation of the node to stdout."""
+        if self.data is None:
+            print _indent * '    ' + ('%s; %d bytes (not loaded)' % (self.tag, self.data_size))
+            return
         encoding = tag_encoding.get(self.tag)
         if encoding:
             header = '%d bytes as %s(s)' % (len(self.data), encoding)
@@ -327,7 +371,7 @@ class Chunk(object):
         print hexdump(self.data, self.offset, tag=self.tag, indent=(_indent + 1) * '    ').rstrip()
 
     def __repr__(self):
-        return '<%s %s; %d bytes>' % (self.__class__.__name__, self.tag, len(self.data))
+        return '<%s %s; %d bytes>' % (self.__class__.__name__, self.tag, self.data_size)
 
     def dumps_iter(self):
         yield self.tag
@@ -359,6 +403,18 @@ class Chunk(object):
     def ints(self, values):
         self._pack('L', values)
 
+    @property
+    def signed_ints(self):
+        """Binary data interpreted as array of signed integers.
+
+        Cache times (e.g. ``STIM`` and ``ETIM``) are signed, since caches may
+        start before zero. This is settable to an iterable of integers."""
+        return self._unpack('l')
+
+    @signed_ints.setter
+    def signed_ints(self, values):
+        self._pack('l', values)
+
     @property
     def floats(self):
         """Binary data interpreted as array of floats.
@@ -388,19 +444,32 @@ class Parser(Node):
 
     :param file: The file-like object to parse from; must support ``read(size)``
         and ``tell()``.
+    :param skip_tags: Tags of chunks to not read the data of; their ``data``
+        is ``None`` until passed to :meth:`read_data`, which requires that the
+        file also supports ``seek()``.
 
     """
 
-    def __init__(self, file):
+    def __init__(self, file, skip_tags=()):
         super(Parser, self).__init__()
 
         self._file = file
         self._group_stack = []
         self.children = []
+        self.skip_tags = frozenset(skip_tags)
 
     def close(self):
         self._file.close()
 
+    def read_data(self, chunk):
+        """Read the data of a chunk that was skipped while parsing."""
+        position = self._file.tell()
+        try:
+            self._file.seek(chunk.offset)
+            return self._file.read(chunk.size)
+        finally:
+            self._file.seek(position)
+
     def pprint(self, _indent=-1):
         """Print a structured representation of the file to stdout."""
         for child in self.children:
@@ -440,8 +509,12 @@ class Parser(Node):
         else:
 
             offset = self._file.tell()
-            data = self._file.read(size)
-            chunk = Chunk(tag, data, offset)
+            if tag in self.skip_tags:
+                self._file.seek(size, 1)
+                data = None
+            else:
+                data = self._file.read(size)
+            chunk = Chunk(tag, data, offset, size=size)
 
             assert self._group_stack, 'Data chunk outside of group.'
             self._group_stack[-1].add_child(chunk)
@@ -1,10 +1,113 @@
 import ast
+import bisect
+import contextlib
 import copy
+import mmap
 import os
 import re
-import xml.etree.cElementTree as etree
+
+import numpy as np
 
 from .. import binary
+from .. import mcc
+from . import sampling
+
+
+#: How each known interpretation is laid out in a channel's data; either the
+#: number of interleaved components per voxel, or ``"faces"`` for the
+#: staggered grids of the velocity. Anything else (e.g. ``resolution`` and
+#: ``offset``) is metadata about the shape.
+channel_layouts = {
+    'density': 1,
+    'temperature': 1,
+    'fuel': 1,
+    'falloff': 1,
+    'color': 3,
+    'coordinates': 3,
+    'velocity': 'faces',
+}
+
+
+#: How channel data may be stored in a frame; the tag of its chunk, the NumPy
+#: dtype within it, and the number of components per element. The first four
+#: are Maya's own array types (see :data:`mayatools.mcc.array_types`), of which
+#: vectors are interleaved when read. The rest are for compact intermediate
+#: caches, which Maya does not understand, and are read transparently as
+#: float32. Integer types are quantized with a scale and offset which are
+#: stored (as a ``QSCL`` chunk of two doubles) just before the data.
+storage_types = {
+    'float32': ('FBCA', '>f4', 1),
+    'float64': ('DBLA', '>f8', 1),
+    'float32_vector': ('FVCA', '>f4', 3),
+    'float64_vector': ('DVCA', '>f8', 3),
+    'float16': ('FHCA', '>f2', 1),
+    'uint16': ('QSCA', '>u2', 1),
+    'uint8': ('QBCA', '>u1', 1),
+}
+
+# Map tags to their dtype and components, including "DBCA", which some
+# exporters write for doubles instead of Maya's "DBLA".
+_tag_types = dict((tag, (dtype, components)) for tag, dtype, components in storage_types.itervalues())
+_tag_types['DBCA'] = _tag_types['DBLA']
+
+# The storage of each of Maya's types, which are written back as they were
+# read; compact channels are written back as float32.
+_tag_storage = dict(
+    (tag, name)
+    for name, (tag, dtype, components) in storage_types.iteritems()
+    if tag in mcc.array_types
+)
+_tag_storage['DBCA'] = 'float64'
+
+
+def encode_channel_data(data, storage='float32'):
+    """Encode channel data for storage in a frame; see :data:`storage_types`.
+
+    :return: ``(tag, encoded, quantization)``, where ``quantization`` is the
+        ``(scale, offset)`` for integer types, and otherwise ``None``.
+
+    """
+
+    try:
+        tag, dtype, components = storage_types[storage]
+    except KeyError:
+        raise ValueError('unknown storage type %r' % storage)
+
+    data = np.asarray(data)
+    if data.size % components:
+        raise ValueError('cannot store %d values as %s' % (data.size, storage))
+    if dtype[1] == 'f':
+        return tag, data.astype(dtype).tostring(), None
+
+    # Quantize from the range of the finite values.
+    data = data.astype(np.float64)
+    finite = np.isfinite(data)
+    values = data[finite]
+    lo = float(values.min()) if values.size else 0.0
+    hi = float(values.max()) if values.size else 0.0
+    steps = np.iinfo(dtype).max
+    scale = (hi - lo) / steps
+    if scale:
+        quantized = np.rint((np.where(finite, data, lo) - lo) / scale)
+    else:
+        quantized = np.zeros(data.shape)
+    quantized = np.clip(quantized, 0, steps).astype(dtype)
+    return tag, quantized.tostring(), (scale, lo)
+
+
+def decode_channel_data(tag, encoded, quantization=None):
+    """Decode channel data which was encoded by :func:`encode_channel_data`.
+
+    Maya's types keep their precision; doubles are decoded as doubles.
+
+    """
+    data = np.frombuffer(encoded, dtype=_tag_types[tag][0])
+    if quantization is not None:
+        scale, offset = quantization
+        data = (data * scale + offset).astype(np.float32)
+    elif data.dtype.itemsize < 4:
+        data = data.astype(np.float32)
+    return data
 
 
 class Cache(object):
@@ -14,20 +117,104 @@ class Cache(object):
         'resolutionW', 'resolutionH', 'resolutionD',
     ))
 
-    def __init__(self, xml_path=None):
+    #: The default budget, in bytes, for decoded frame data.
+    frame_budget = 1 << 30
+
+    def __init__(self, xml_path=None, frame_budget=None):
 
         self.xml_path = self.directory = self.base_name = None
+        self.descriptor = None
+
+        if frame_budget is not None:
+            self.frame_budget = frame_budget
+
+        # Decoded frames, from least to most recently used, and their sizes.
+        self._decoded_frames = []
+        self._decoded_bytes = 0
+        self._frames_by_path = {}
+
+        # The XML is shared with the descriptor until we need to modify it.
+        self._etree_is_shared = False
 
         if xml_path:
             self.set_path(xml_path)
-            self.etree = etree.parse(self.xml_path)
+            self.descriptor = mcc.CacheDescriptor.get(self.xml_path)
+            self.etree = self.descriptor.etree
+            self._etree_is_shared = True
             self.parse_xml()
 
         self._frames = []
+        self._frame_times = []
 
     def free(self):
         for frame in self._frames:
             frame.free()
+        for frame in list(self._decoded_frames):
+            frame.free()
+
+    def get_frame(self, path):
+        """Get the shared :class:`Frame` for the given path.
+
+        Frames from here share their decoded data with every other caller,
+        within the :attr:`frame_budget`.
+
+        """
+        self.frames
+        path = os.path.abspath(path)
+        frame = self._frames_by_path.get(path)
+        if frame is None:
+            frame = self._frames_by_path[path] = Frame(self, path)
+        return frame
+
+    @contextlib.contextmanager
+    def pin(self, *frames):
+        """Context manager to keep frames from being released to fit the budget.
+
+        This is for frames which are in use together (e.g. the two sources of
+        a blend), which would otherwise evict each other; the budget may be
+        exceeded while they are pinned.
+
+        """
+        for frame in frames:
+            frame.pins += 1
+        try:
+            yield
+        finally:
+            for frame in frames:
+                frame.pins -= 1
+
+    def _frame_used(self, frame):
+        """Mark a frame as the most recently used."""
+        try:
+            self._decoded_frames.remove(frame)
+        except ValueError:
+            pass
+        self._decoded_frames.append(frame)
+
+    def _frame_decoded(self, frame):
+        """Track a newly decoded frame, releasing others to fit the budget."""
+        self._frame_used(frame)
+        self._frame_grew(frame, 0)
+
+    def _frame_grew(self, frame, nbytes):
+        """Track more data being decoded for a frame."""
+        frame.nbytes += nbytes
+        self._decoded_bytes += nbytes
+        while self._decoded_bytes > self.frame_budget:
+            for oldest in self._decoded_frames:
+                if oldest is not frame and not oldest.pins:
+                    break
+            else:
+                # Everything else is pinned.
+                return
+            oldest.release()
+
+    def _frame_released(self, frame):
+        try:
+            self._decoded_frames.remove(frame)
+        except ValueError:
+            return
+        self._decoded_bytes -= frame.nbytes
 
     def clone(self):
         clone = self.__class__()
@@ -97,23 +284,41 @@ class Cache(object):
 
     @property
     def frames(self):
-        if not self._frames:
+        """Every frame on disk, sorted by the time in their file names.
 
-            name_re = re.compile(r'^%sFrame(\d+)(?:Tick(\d))?\.mc$' % re.escape(self.base_name))
-            for file_name in os.listdir(self.directory):
-                m = name_re.match(file_name)
-                if m:
-                    frame = Frame(self, os.path.join(self.directory, file_name))
-                    self._frames.append(frame)
+        None of the frames are opened until their headers or data are needed.
 
+        """
+        if not self._frames and self.descriptor:
+            for time, path in self.descriptor.frames:
+                frame = Frame(self, path, time)
+                self._frames.append(frame)
+                self._frames_by_path[path] = frame
+            self._frame_times = [frame.time for frame in self._frames]
         return self._frames
 
+    @property
+    def frame_times(self):
+        """The sorted times of :attr:`frames`."""
+        self.frames
+        return self._frame_times
+
+    def frame_at(self, time):
+        """Get the frame at the given time, or ``None``."""
+        frames = self.frames
+        i = bisect.bisect_left(self._frame_times, time)
+        if i < len(frames) and self._frame_times[i] == time:
+            return frames[i]
+
+    def detach_xml(self):
+        """Make sure that our XML is our own to modify."""
+        if self._etree_is_shared:
+            self.etree = copy.deepcopy(self.etree)
+            self._etree_is_shared = False
+
     def update_xml(self, min_time, max_time):
-        self.etree.find('time').set('Range', '%d-%d' % (min_time, max_time))
-        for channel in self.etree.find('Channels'):
-            channel.set('SamplingType', 'Irregular')
-            channel.set('StartTime', str(min_time))
-            channel.set('EndTime', str(max_time))
+        self.detach_xml()
+        mcc.set_time_range(self.etree, min_time, max_time)
 
     def write_xml(self, path):
         self.etree.write(path)
@@ -126,6 +331,7 @@ class ShapeSpec(object):
         self.dimensions = tuple(kwargs.pop('dimensions' + axis) for axis in 'WHD')
         self.resolution = tuple(kwargs.pop('resolution' + axis) for axis in 'WHD')
         self.unit_size = tuple(float(d) / float(r) for d, r in zip(self.dimensions, self.resolution))
+        self.offset = (0.0, 0.0, 0.0)
 
     def __repr__(self):
         return '<%s unit_size=%r>' % (self.__class__.__name__, self.unit_size)
@@ -151,27 +357,49 @@ class Frame(object):
 
     _header_tags = set(('STIM', 'ETIM'))
 
-    def __init__(self, cache=None, path=None):
+    def __init__(self, cache=None, path=None, time=None):
 
         self.cache = cache
         self.path = path
         self.parser = None
 
+        # The time according to the file name; the headers are authoritative.
+        self.time = time
+
         self._channels = {}
         self._headers = {}
         self._shapes = {}
 
+        # The size of the decoded data.
+        self.nbytes = 0
+
+        # How many users have pinned this frame; see :meth:`Cache.pin`.
+        self.pins = 0
+
     def close(self):
         if self.parser:
             self.parser.close()
             self.parser = None
 
     def free(self):
-        self.close()
+        """Release this frame's data, and empty any channels still using it."""
         for channel in self._channels.itervalues():
             channel.data = ()
+        self.release()
+
+    def release(self):
+        """Drop our references to the decoded data, to be decoded again if needed.
+
+        Unlike :meth:`free`, any channels or shapes which are still in use
+        elsewhere keep their data.
+
+        """
+        self.close()
+        if self.cache is not None:
+            self.cache._frame_released(self)
         self._channels = {}
         self._shapes = {}
+        self.nbytes = 0
 
     def pprint(self):
         print 'Frame from %d to %d' % (self.start_time, self.end_time)
@@ -185,12 +413,17 @@ class Frame(object):
 
     def parse_headers(self):
         self.parser = self.parser or binary.Parser(open(self.path, 'rb'))
-        while True:
-            if all(tag in self._headers for tag in self._header_tags):
-                break
-            chunk = self.parser.parse_next()
-            if chunk.tag in self._header_tags:
-                self._headers[chunk.tag] = chunk.ints[0]
+        try:
+            while True:
+                if all(tag in self._headers for tag in self._header_tags):
+                    break
+                chunk = self.parser.parse_next()
+                if chunk.tag in self._header_tags:
+                    self._headers[chunk.tag] = chunk.signed_ints[0]
+        finally:
+            # Frames may sit in the cache for a long time, so never hold
+            # their files open.
+            self.close()
 
     @property
     def headers(self):
@@ -223,37 +456,117 @@ class Frame(object):
                 shape = Shape(self, shape_spec)
                 self._shapes[shape_name] = shape
 
-            self.parse_headers()
-            self.parser.parse_all()
-            channels = self.parser.find_one('MYCH')
-            for name, data in zip(channels.find('CHNM'), channels.find('FBCA')):
-                name = name.string
-                data = data.floats
-                self._channels[name] = Channel(self, name, data)
+            # Only the structure is parsed here; the data of each channel is
+            # read (by reopening the file) when it is first used.
+            parser = binary.Parser(open(self.path, 'rb'), skip_tags=_tag_types)
+            try:
+                parser.parse_all()
+            finally:
+                parser.close()
+            for tag in self._header_tags:
+                if tag not in self._headers:
+                    self._headers[tag] = parser.find_one(tag).signed_ints[0]
+            name = quantization = None
+            for chunk in parser.find_one('MYCH').children:
+                if chunk.tag == 'CHNM':
+                    name = chunk.string
+                    quantization = None
+                elif chunk.tag == 'QSCL':
+                    quantization = tuple(np.frombuffer(chunk.data, dtype='>f8'))
+                elif chunk.tag in _tag_types:
+                    chunk.quantization = quantization
+                    self._channels[name] = Channel(self, name, chunk=chunk)
+
+            self.cache._frame_decoded(self)
 
             for shape in self._shapes.itervalues():
                 shape.finalize()
 
+        elif self.path and self.cache is not None:
+            self.cache._frame_used(self)
+
         return self._shapes
 
-    def dumps_iter(self):
-        """Prepare all channels and specs for dumping, and then do it."""
+    def load_chunk(self, chunk):
+        """Decode the data of a chunk which was skipped when parsing."""
+        data = chunk.data
+        if data is None:
+            with open(self.path, 'rb') as fh:
+                fh.seek(chunk.offset)
+                data = fh.read(chunk.size)
+        data = decode_channel_data(chunk.tag, data, getattr(chunk, 'quantization', None))
+        if self.cache is not None and self._shapes:
+            self.cache._frame_grew(self, data.nbytes)
+        return data
+
+    def dumps_iter(self, storage=None):
+        """Prepare all channels and specs for dumping, and then do it.
+
+        :param dict storage: Map channel interpretations to how they should be
+            stored (see :data:`storage_types`); others are stored as they were
+            read, or as ``float32`` (as Maya expects) if they were compact or
+            are new.
+
+        """
 
         root = binary.Node()
 
         header = root.add_group('CACH')
         header.add_chunk('VRSN').string = '0.1'
-        header.add_chunk('STIM').ints = [self.headers['STIM']]
-        header.add_chunk('ETIM').ints = [self.headers['ETIM']]
+        header.add_chunk('STIM').signed_ints = [self.headers['STIM']]
+        header.add_chunk('ETIM').signed_ints = [self.headers['ETIM']]
 
         channels = root.add_group('MYCH')
-        for interpretation, channel in self.channels.iteritems():
+        for channel in self.channels.itervalues():
+            channel_storage = (storage or {}).get(channel.interpretation, channel.storage)
+            tag, encoded, quantization = encode_channel_data(channel.data, channel_storage)
             channels.add_chunk('CHNM').string = channel.name
-            channels.add_chunk('SIZE').ints = [len(channel.data)]
-            channels.add_chunk('FBCA').floats = channel.data
+            channels.add_chunk('SIZE').ints = [np.size(channel.data) // _tag_types[tag][1]]
+            if quantization is not None:
+                channels.add_chunk('QSCL').data = np.array(quantization, dtype='>f8').tostring()
+            channels.add_chunk(tag).data = encoded
 
         return root.dumps_iter()
 
+
+_grid_axes_cache = {}
+_grid_axes_cache_size = 64
+
+
+def grid_axes(bb_min, unit_size, resolution, grid='centres', z_start=0, z_end=None):
+    """Get the (memoized) 1D sample coordinates along each axis of a grid.
+
+    See :meth:`Shape.grid_points` for the arguments.
+
+    """
+
+    resolution = tuple(int(r) for r in resolution)
+    z_end = resolution[2] if z_end is None else z_end
+    key = (tuple(bb_min), tuple(unit_size), resolution, grid, z_start, z_end)
+
+    try:
+        return _grid_axes_cache[key]
+    except KeyError:
+        pass
+
+    axes = []
+    for axis in xrange(3):
+        if axis == 2:
+            stop = z_end + 1 if grid == 2 and z_end == resolution[2] else z_end
+            indices = np.arange(z_start, stop)
+        else:
+            indices = np.arange(resolution[axis] + (1 if grid == axis else 0))
+        offset = 0.0 if grid == axis else 0.5
+        values = bb_min[axis] + unit_size[axis] * (offset + indices)
+        values.flags.writeable = False
+        axes.append(values)
+
+    if len(_grid_axes_cache) >= _grid_axes_cache_size:
+        _grid_axes_cache.clear()
+    _grid_axes_cache[key] = axes = tuple(axes)
+    return axes
+
+
 class Shape(object):
 
     def __init__(self, frame, spec, channels=None):
@@ -267,13 +580,13 @@ class Shape(object):
 
         res_channel = self.channels.get('resolution')
         if res_channel:
-            self.resolution = res_channel.data
+            self.resolution = tuple(int(x) for x in res_channel.data)
         else:
             self.resolution = self.spec.resolution
 
         off_channel = self.channels.get('offset')
         if off_channel:
-            self.offset = off_channel.data
+            self.offset = tuple(float(x) for x in off_channel.data)
         else:
             self.offset = self.spec.offset
 
@@ -281,14 +594,59 @@ class Shape(object):
         self.bb_max = tuple(o + r * u / 2.0 for o, r, u in zip(self.offset, self.resolution, self.spec.unit_size))
 
     def iter_centers(self):
-        for zi in xrange(self.resolution[2]):
-            z = self.bb_min[2] + self.spec.unit_size[2] * (0.5 + zi)
-            for yi in xrange(self.resolution[1]):
-                y = self.bb_min[1] + self.spec.unit_size[1] * (0.5 + yi)
-                for xi in xrange(self.resolution[0]):
-                    x = self.bb_min[0] + self.spec.unit_size[0] * (0.5 + xi)
+        xs, ys, zs = (axis.ravel().tolist() for axis in self.center_axes())
+        for z in zs:
+            for y in ys:
+                for x in xs:
                     yield x, y, z
 
+    def center_axes(self):
+        """Get the voxel centre coordinates along each axis.
+
+        :return: ``(xs, ys, zs)`` tuple of 1D arrays, shaped so that they
+            broadcast against each other to the ``(z, y, x)`` shape of the grid.
+
+        """
+        return self.grid_points('centres')
+
+    def grid_points(self, grid='centres', z_start=0, z_end=None):
+        """Get the coordinates of the samples of one of this shape's grids.
+
+        The coordinates along each axis are memoized (see :func:`grid_axes`),
+        and are never expanded to the full grid.
+
+        :param grid: ``"centres"`` for voxel centres, or ``0``, ``1``, or ``2``
+            for the faces of that axis, as used by the velocity.
+        :param int z_start: The first z slice to include.
+        :param int z_end: The end of the z slices to include; the top face of
+            the z face grid is only included when this is the last slice.
+        :return: ``(x, y, z)`` read-only arrays which broadcast to the shape of
+            the grid.
+
+        """
+        xs, ys, zs = grid_axes(self.bb_min, self.spec.unit_size, self.resolution, grid, z_start, z_end)
+        return xs[None, None, :], ys[None, :, None], zs[:, None, None]
+
+    def indices_for_points(self, x, y, z):
+        """Vectorized :meth:`index_for_point`.
+
+        :return: ``(xi, yi, zi, valid)`` arrays; the indices are zero wherever
+            the point is outside of the bounds (i.e. not ``valid``).
+
+        """
+
+        valid = (
+            (x >= self.bb_min[0]) & (x <= self.bb_max[0]) &
+            (y >= self.bb_min[1]) & (y <= self.bb_max[1]) &
+            (z >= self.bb_min[2]) & (z <= self.bb_max[2])
+        )
+
+        # Truncation is fine since these will never be negative.
+        xi = np.where(valid, (x - self.bb_min[0]) / self.spec.unit_size[0], 0).astype(np.intp)
+        yi = np.where(valid, (y - self.bb_min[1]) / self.spec.unit_size[1], 0).astype(np.intp)
+        zi = np.where(valid, (z - self.bb_min[2]) / self.spec.unit_size[2], 0).astype(np.intp)
+        return xi, yi, zi, valid
+
     def index_for_point(self, x, y, z):
 
         if x < self.bb_min[0] or x > self.bb_max[0]:
@@ -327,10 +685,14 @@ class Shape(object):
         xr = int(self.resolution[0])
         yr = int(self.resolution[1])
         zr = int(self.resolution[2])
+
+        # Points on the max bounds are on the last face of their own axis,
+        # but in the last voxel of the others.
+        xc, yc, zc = min(xi, xr - 1), min(yi, yr - 1), min(zi, zr - 1)
         data_indices = (
-            xi + (yi * (xr + 1)) + (zi * (xr + 1) *  yr     ),
-            xi + (yi *  xr     ) + (zi *  xr      * (yr + 1)) + ((xr + 1) * yr * zr),
-            xi + (yi *  xr     ) + (zi *  xr      *  yr     ) + ((xr + 1) * yr * zr) + (xr * (yr + 1) * zr),
+            xi + (yc * (xr + 1)) + (zc * (xr + 1) *  yr     ),
+            xc + (yi *  xr     ) + (zc *  xr      * (yr + 1)) + ((xr + 1) * yr * zr),
+            xc + (yc *  xr     ) + (zi *  xr      *  yr     ) + ((xr + 1) * yr * zr) + (xr * (yr + 1) * zr),
         )
         try:
             return tuple(channel.data[i] for i in data_indices)
@@ -342,6 +704,186 @@ class Shape(object):
             print 'Stats: %d/%d %d/%d %d/%d' % (xi, xr, yi, yr, zi, zr)
             raise
 
+    def lookup_values(self, channel, x, y, z, data=None):
+        """Vectorized :meth:`lookup_value`.
+
+        :param data: The channel's data as a ``float64`` array, if the caller
+            already has it.
+        :return: Array with a trailing axis of ``channel.data_size``.
+
+        """
+
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+        size = channel.data_size
+
+        xi, yi, zi, valid = self.indices_for_points(x, y, z)
+        xr = int(self.resolution[0])
+        yr = int(self.resolution[1])
+        index = size * (xi + (yi * xr) + (zi * xr * yr))
+
+        # Points exactly on the max bounds may be past the end of the data.
+        valid &= index + size <= len(data)
+        index = np.where(valid, index, 0)[..., None] + np.arange(size)
+
+        values = data[index]
+        values[~valid] = 0.0
+        return values
+
+    def lookup_velocities(self, channel, x, y, z, data=None):
+        """Vectorized :meth:`lookup_velocity`.
+
+        :param data: The channel's data as a ``float64`` array, if the caller
+            already has it.
+        :return: Array with a trailing axis of 3.
+
+        """
+
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+
+        xi, yi, zi, valid = self.indices_for_points(x, y, z)
+        xr = int(self.resolution[0])
+        yr = int(self.resolution[1])
+        zr = int(self.resolution[2])
+
+        expected = 3 * xr * yr * zr + xr * yr + yr * zr + zr * xr
+        if len(data) < expected:
+            raise ValueError('Not enough fluid data; have %d of %d expected floats' % (len(data), expected))
+
+        # Points on the max bounds are on the last face of their own axis,
+        # but in the last voxel of the others.
+        xc = np.minimum(xi, xr - 1)
+        yc = np.minimum(yi, yr - 1)
+        zc = np.minimum(zi, zr - 1)
+        data_indices = (
+            xi + (yc * (xr + 1)) + (zc * (xr + 1) *  yr     ),
+            xc + (yi *  xr     ) + (zc *  xr      * (yr + 1)) + ((xr + 1) * yr * zr),
+            xc + (yc *  xr     ) + (zi *  xr      *  yr     ) + ((xr + 1) * yr * zr) + (xr * (yr + 1) * zr),
+        )
+
+        values = np.zeros(valid.shape + (3, ))
+        for i, index in enumerate(data_indices):
+            ok = valid & (index < len(data))
+            values[..., i] = np.where(ok, data[np.where(ok, index, 0)], 0.0)
+        return values
+
+    def fits_grid(self, channel):
+        """Is the channel's data the right length for a voxel-centred grid?"""
+        xr, yr, zr = (int(r) for r in self.resolution)
+        return channel.data_size > 0 and len(channel.data) == xr * yr * zr * channel.data_size
+
+    def value_grid(self, channel, data=None):
+        """Get a channel's data as a ``(z, y, x, data_size)`` array."""
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+        xr, yr, zr = (int(r) for r in self.resolution)
+        return data[:xr * yr * zr * channel.data_size].reshape(zr, yr, xr, channel.data_size)
+
+    def velocity_grids(self, channel, data=None):
+        """Get a velocity channel's data as its three staggered face grids.
+
+        :return: ``(vx, vy, vz)``, with shapes ``(zr, yr, xr + 1)``,
+            ``(zr, yr + 1, xr)``, and ``(zr + 1, yr, xr)`` respectively.
+
+        """
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+        xr, yr, zr = (int(r) for r in self.resolution)
+        grids = []
+        start = 0
+        for shape in ((zr, yr, xr + 1), (zr, yr + 1, xr), (zr + 1, yr, xr)):
+            size = shape[0] * shape[1] * shape[2]
+            grids.append(data[start:start + size].reshape(shape))
+            start += size
+        if start > len(data):
+            raise ValueError('Not enough fluid data; have %d of %d expected floats' % (len(data), start))
+        return tuple(grids)
+
+    def sample_values(self, channel, x, y, z, mode='nearest', data=None):
+        """Sample a voxel-centred channel at arrays of points.
+
+        ``"nearest"`` is identical to :meth:`lookup_values`; see
+        :mod:`mayatools.fluids.sampling` for the others.
+
+        :return: Array with a trailing axis of ``channel.data_size``.
+
+        """
+        if mode == 'nearest':
+            return self.lookup_values(channel, x, y, z, data)
+        return sampling.sample(
+            self.value_grid(channel, data),
+            (x - self.bb_min[0]) / self.spec.unit_size[0] - 0.5,
+            (y - self.bb_min[1]) / self.spec.unit_size[1] - 0.5,
+            (z - self.bb_min[2]) / self.spec.unit_size[2] - 0.5,
+            mode,
+        )
+
+    def sample_velocities(self, channel, x, y, z, mode='nearest', data=None):
+        """Sample the staggered velocity channel at arrays of points.
+
+        Each component is interpolated on its own face-centred grid.
+        ``"nearest"`` is identical to :meth:`lookup_velocities`.
+
+        :return: Array with a trailing axis of 3.
+
+        """
+
+        if mode == 'nearest':
+            return self.lookup_velocities(channel, x, y, z, data)
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+        return np.concatenate([
+            self.sample_velocity_component(channel, axis, x, y, z, mode, data)[..., None]
+            for axis in xrange(3)
+        ], axis=-1)
+
+    def sample_velocity_component(self, channel, axis, x, y, z, mode='nearest', data=None):
+        """Sample one component of the staggered velocity at arrays of points."""
+
+        if mode == 'nearest':
+            return self.lookup_velocities(channel, x, y, z, data)[..., axis]
+
+        # Continuous indices relative to the faces on this axis, and to the
+        # voxel centres on the others.
+        coords = [
+            (c - self.bb_min[i]) / self.spec.unit_size[i] - (0.0 if i == axis else 0.5)
+            for i, c in enumerate((x, y, z))
+        ]
+        return sampling.sample(self.velocity_grids(channel, data)[axis], coords[0], coords[1], coords[2], mode)
+
+    def advect(self, x, y, z, time_scale, velocity_scale=1.0, substeps=1, sampling='linear', data=None):
+        """Trace points back through this shape's velocity field.
+
+        This is a semi-Lagrangian step: each point moves by
+        ``-velocity * time_scale * velocity_scale``, where the velocity is
+        sampled from the staggered grid at the point's current position. With
+        more than one substep the total time is split evenly between them and
+        the velocity is resampled along the way.
+
+        :param time_scale: The time to trace over; negative to trace forwards.
+        :param velocity_scale: Multiplier for the velocities.
+        :param int substeps: The number of steps to split the time into.
+        :param str sampling: The mode for sampling velocities.
+        :param data: The velocity data as a ``float64`` array, if the caller
+            already has it.
+        :return: ``(x, y, z)`` arrays of the traced positions.
+
+        """
+
+        channel = self.channels['velocity']
+        if data is None:
+            data = np.asarray(channel.data, dtype=np.float64)
+        step = time_scale / substeps if substeps > 1 else time_scale
+
+        for i in xrange(max(1, substeps)):
+            vel = self.sample_velocities(channel, x, y, z, sampling, data)
+            x = x - step * vel[..., 0] * velocity_scale
+            y = y - step * vel[..., 1] * velocity_scale
+            z = z - step * vel[..., 2] * velocity_scale
+
+        return x, y, z
+
     @classmethod
     def setup_blend(cls, frame, name, shape_a, shape_b):
 
@@ -369,47 +911,256 @@ class Shape(object):
 
         return self
 
-    def blend(self, blend_factor, advect=1.0):
-        has_vel = 'velocity' in self.src_a.channels
-        for interpretation in self.src_a.channels:
-            if interpretation in ('density', ):
-                self.blend_channel(interpretation, blend_factor, advect=advect if has_vel else 0)
+    def blend(self, blend_factor, advect=1.0, sampling='nearest', velocity_sampling='linear', substeps=1, slab_workers=None):
+        """Blend every channel of the two sources of this shape.
 
-    def blend_channel(self, interpretation, blend_factor, advect=0):
+        Channels with unknown interpretations are blended as voxel-centred
+        grids if they fit the grids of both sources; otherwise (or if they are
+        only in one source) they are copied from the nearest source.
 
-        blend_factor_inv = 1.0 - blend_factor
+        :param float blend_factor: How far from the first source to the second.
+        :param float advect: Multiplier for the velocities when tracing each
+            sample back to the sources, or ``0`` to not advect.
+        :param int slab_workers: Split the grid into z slabs blended by this
+            many processes; see :meth:`blend_parallel`.
 
-        a_channel = self.src_a.channels[interpretation]
-        b_channel = self.src_b.channels[interpretation]
+        """
 
-        lookup_a = self.src_a.lookup_value
-        lookup_b = self.src_b.lookup_value
+        interpretations = []
+        for name, a_channel in sorted(self.src_a.channels.iteritems()):
+            if name in ('resolution', 'offset'):
+                continue
+            b_channel = self.src_b.channels.get(name)
+            if b_channel is not None and (name in channel_layouts or (
+                a_channel.data_size == b_channel.data_size and
+                self.src_a.fits_grid(a_channel) and self.src_b.fits_grid(b_channel)
+            )):
+                interpretations.append(name)
+            else:
+                nearest = self.src_b if blend_factor >= 0.5 and b_channel is not None else self.src_a
+                channel = nearest.channels[name]
+                Channel(self.frame, channel.name, channel.data, storage=channel.storage)
+
+        kwargs = dict(
+            advect=advect,
+            sampling=sampling,
+            velocity_sampling=velocity_sampling,
+            substeps=substeps,
+        )
+        if slab_workers and slab_workers > 1 and int(self.resolution[2]) > 1:
+            self.blend_parallel(interpretations, blend_factor, slab_workers, **kwargs)
+        else:
+            self.store_blended(self.blend_slab(interpretations, blend_factor, **kwargs))
+
+    def blend_parallel(self, interpretations, blend_factor, workers, **kwargs):
+        """Blend several channels in z slabs across a pool of processes.
+
+        The output of every channel is allocated in anonymous shared memory
+        which the forked workers write their slabs directly into, and the
+        sources are inherited by the fork rather than pickled. The sources are
+        loaded and converted to doubles once before forking (see
+        :meth:`blend_sources`), so each worker only reads the parts of them
+        that its slabs sample. The channels are then backed by the output
+        memory without any further copies.
+
+        Keyword arguments are passed to :meth:`blend_slab`.
+
+        """
+
+        global _slab_state
+
+        xr, yr, zr = (int(r) for r in self.resolution)
+
+        flats = {}
+        outputs = {}
+        for interpretation in interpretations:
+            layout = channel_layouts.get(interpretation) or self.src_a.channels[interpretation].data_size
+            if layout == 'faces':
+                shapes = ((zr, yr, xr + 1), (zr, yr + 1, xr), (zr + 1, yr, xr))
+                sizes = [a * b * c for a, b, c in shapes]
+                flat = _shared_array(sum(sizes))
+                grids = []
+                start = 0
+                for shape, size in zip(shapes, sizes):
+                    grids.append(flat[start:start + size].reshape(shape))
+                    start += size
+                outputs[interpretation] = tuple(grids)
+            else:
+                flat = _shared_array(xr * yr * zr * layout)
+                outputs[interpretation] = flat.reshape(zr, yr, xr, layout)
+            flats[interpretation] = flat
+
+        slab_count = min(zr, workers * 2)
+        bounds = [zr * i // slab_count for i in xrange(slab_count + 1)]
+
+        kwargs = dict(kwargs, sources=self.blend_sources(interpretations, kwargs.get('advect')))
+
+        import concurrent.futures
+
+        # The workers are forked on the first submit, so they will see this.
+        _slab_state = (self, interpretations, blend_factor, kwargs, outputs)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(_blend_slab_task, z_start, z_end) for z_start, z_end in zip(bounds[:-1], bounds[1:])]
+                for future in futures:
+                    future.result()
+        finally:
+            _slab_state = None
+
+        for interpretation in sorted(interpretations):
+            print '\t\tblending', interpretation
+            self.channels[interpretation] = Channel(self.frame, self.spec.name + '_' + interpretation, flats[interpretation],
+                storage=self.src_a.channels[interpretation].storage,
+            )
+
+    def blend_channel(self, interpretation, blend_factor, advect=0, sampling='nearest', velocity_sampling='linear', substeps=1):
+        self.store_blended(self.blend_slab([interpretation], blend_factor,
+            advect=advect,
+            sampling=sampling,
+            velocity_sampling=velocity_sampling,
+            substeps=substeps,
+        ))
+
+    def blend_sources(self, interpretations, advect=0):
+        """Load and convert the source data needed to blend some channels.
+
+        :return: ``dict`` mapping interpretations to ``(a_data, b_data)``
+            tuples of ``float64`` arrays, including the velocity if it is
+            needed to ``advect``.
+
+        """
+        names = set(interpretations)
+        if advect:
+            names.add('velocity')
+        sources = {}
+        for name in names:
+            a_channel = self.src_a.channels.get(name)
+            b_channel = self.src_b.channels.get(name)
+            if a_channel is not None and b_channel is not None:
+                sources[name] = (
+                    np.asarray(a_channel.data, dtype=np.float64),
+                    np.asarray(b_channel.data, dtype=np.float64),
+                )
+        return sources
+
+    def blend_slab(self, interpretations, blend_factor, z_start=0, z_end=None,
+        advect=0, sampling='nearest', velocity_sampling='linear', substeps=1,
+        sources=None
+    ):
+        """Blend a range of z slices of several channels.
+
+        The samples of each grid (the voxel centres, and the faces of each
+        axis if blending velocity) are advected once, and shared by every
+        channel on that grid.
+
+        :param list interpretations: The channels to blend.
+        :param int z_start: The first z slice to blend.
+        :param int z_end: The end of the z slices to blend.
+        :param dict sources: The results of :meth:`blend_sources`, if the
+            caller already has them.
+        :return: ``dict`` mapping interpretations to the blended data; voxel
+            centred channels are ``(z, y, x, size)`` arrays, and velocity is a
+            tuple of three face grids.
+
+        """
+
+        blend_factor_inv = 1.0 - blend_factor
 
+        if advect and ('velocity' not in self.src_a.channels or 'velocity' not in self.src_b.channels):
+            advect = 0
         if advect:
             if not isinstance(advect, float):
                 advect = 1.0
             advect_scale = advect * (self.src_b.frame.start_time - self.src_a.frame.end_time) / self.cache.time_per_frame
-            lookup_vel_a = lambda x, y, z, channel=self.src_a.channels['velocity'], lookup=self.src_a.lookup_velocity: lookup(channel, x, y, z)
-            lookup_vel_b = lambda x, y, z, channel=self.src_b.channels['velocity'], lookup=self.src_b.lookup_velocity: lookup(channel, x, y, z)
-
-        data = []
-        dst_channel = Channel(self.frame, self.spec.name + '_' + interpretation, data)
-        self.channels[interpretation] = dst_channel
 
-        print '\t\tblending', interpretation
-        for centre in self.iter_centers():
-            centre_a = centre_b = centre
-            if advect:
-                centre_a = tuple(coord - blend_factor     * vel * advect_scale for coord, vel in zip(centre_a, lookup_vel_a(*centre)))
-                centre_b = tuple(coord + blend_factor_inv * vel * advect_scale for coord, vel in zip(centre_b, lookup_vel_b(*centre)))
-            a = lookup_a(a_channel, *centre_a)
-            b = lookup_b(b_channel, *centre_b)
-            data.extend(av * blend_factor_inv + bv * blend_factor for av, bv in zip(a, b))
+        if sources is None:
+            sources = self.blend_sources(interpretations, advect)
+
+        def trace(grid):
+            # Everything is done in double precision (as the pure-Python
+            # version of this was) and only rounded to floats at the very end.
+            x, y, z = self.grid_points(grid, z_start, z_end)
+            if not advect:
+                return (x, y, z), (x, y, z)
+            # Trace back to A, and forward to B.
+            vel_a, vel_b = sources['velocity']
+            return (
+                self.src_a.advect(x, y, z, blend_factor, advect_scale, substeps, velocity_sampling, vel_a),
+                self.src_b.advect(x, y, z, -blend_factor_inv, advect_scale, substeps, velocity_sampling, vel_b),
+            )
+
+        points = {}
+        res = {}
+
+        for interpretation in interpretations:
+
+            a_channel = self.src_a.channels[interpretation]
+            b_channel = self.src_b.channels[interpretation]
+            a_data, b_data = sources[interpretation]
+
+            if channel_layouts.get(interpretation) == 'faces':
+                grids = []
+                for axis in xrange(3):
+                    if axis not in points:
+                        points[axis] = trace(axis)
+                    pa, pb = points[axis]
+                    a = self.src_a.sample_velocity_component(a_channel, axis, *pa, mode=sampling, data=a_data)
+                    b = self.src_b.sample_velocity_component(b_channel, axis, *pb, mode=sampling, data=b_data)
+                    grids.append((a * blend_factor_inv + b * blend_factor).astype(np.float32))
+                res[interpretation] = tuple(grids)
+
+            else:
+                if 'centres' not in points:
+                    points['centres'] = trace('centres')
+                pa, pb = points['centres']
+                a = self.src_a.sample_values(a_channel, *pa, mode=sampling, data=a_data)
+                b = self.src_b.sample_values(b_channel, *pb, mode=sampling, data=b_data)
+                res[interpretation] = (a * blend_factor_inv + b * blend_factor).astype(np.float32)
+
+        return res
+
+    def store_blended(self, blended):
+        """Create channels from the results of :meth:`blend_slab`.
+
+        The channels are stored the same way as those of the first source.
+
+        """
+        for interpretation, data in sorted(blended.iteritems()):
+            print '\t\tblending', interpretation
+            if isinstance(data, tuple):
+                data = np.concatenate([grid.ravel() for grid in data])
+            else:
+                data = data.ravel()
+            self.channels[interpretation] = Channel(self.frame, self.spec.name + '_' + interpretation, data,
+                storage=self.src_a.channels[interpretation].storage,
+            )
+
+
+def _shared_array(size):
+    """Allocate a float32 array in anonymous memory which is shared with forks."""
+    buffer_ = mmap.mmap(-1, max(1, size) * 4)
+    return np.frombuffer(buffer_, dtype=np.float32, count=size)
+
+
+# The work of Shape.blend_parallel, for the forked workers to inherit.
+_slab_state = None
+
+
+def _blend_slab_task(z_start, z_end):
+    shape, interpretations, blend_factor, kwargs, outputs = _slab_state
+    blended = shape.blend_slab(interpretations, blend_factor, z_start, z_end, **kwargs)
+    for interpretation, data in blended.iteritems():
+        output = outputs[interpretation]
+        if isinstance(data, tuple):
+            for grid, out in zip(data, output):
+                out[z_start:z_start + grid.shape[0]] = grid
+        else:
+            output[z_start:z_end] = data
 
 
 class Channel(object):
 
-    def __init__(self, frame, name, data):
+    def __init__(self, frame, name, data=None, chunk=None, storage=None):
 
         self.frame = frame
         self.cache = frame.cache
@@ -422,12 +1173,42 @@ class Channel(object):
         self.frame.channels[name] = self
         
         self.interpretation = self.spec.interpretation
-        self.data_size = {
-            'density': 1,
-            'velocity': 3,
-        }.get(self.interpretation, 0)
 
-        self.data = data
+        #: How this channel is written; see :data:`storage_types`.
+        self.storage = storage or _tag_storage.get(chunk.tag if chunk is not None else None, 'float32')
+
+        # The number of components per voxel; unknown interpretations are
+        # assumed to be grids of whatever their array type holds.
+        layout = channel_layouts.get(self.interpretation)
+        if layout == 'faces':
+            self.data_size = 3
+        elif layout is not None:
+            self.data_size = layout
+        elif self.interpretation in ('resolution', 'offset'):
+            self.data_size = 0
+        else:
+            self.data_size = storage_types[self.storage][2]
+
+        self._data = data
+
+        # The chunk to lazily load our data from.
+        self._chunk = chunk
+
+    @property
+    def is_loaded(self):
+        return self._chunk is None
+
+    @property
+    def data(self):
+        if self._chunk is not None:
+            self._data = self.frame.load_chunk(self._chunk)
+            self._chunk = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._chunk = None
 
 
 if __name__ == '__main__':
@@ -439,8 +1220,17 @@ if __name__ == '__main__':
     opt_parser.add_option('-v', '--velocities', action='store_true')
     opt_parser.add_option('-s', '--start', type='float')
     opt_parser.add_option('-e', '--end', type='float')
+    opt_parser.add_option('--stats', action='store_true',
+        help='print CSV statistics of every frame instead; see mayatools.fluids.stats')
+    opt_parser.add_option('-w', '--workers', type='int')
     opts, args = opt_parser.parse_args()
 
+    if opts.stats:
+        from mayatools.fluids import stats
+        results = stats.cache_stats(args, workers=opts.workers)
+        stats.write_csv(results, sys.stdout)
+        exit(2 if stats.report_problems(results, sys.stderr) else 0)
+
     for arg in args:
 
         cache = Cache(arg)
@@ -0,0 +1,246 @@
+"""Crop fluid caches to the region that is actually occupied.
+
+Fluid containers are often much larger than the smoke within them. This
+shrinks the ``resolution`` and ``offset`` of every shape in every frame to the
+bounding box of voxels with any density (plus some padding), so that later
+blending, previews, and the cache itself only cover that region.
+
+"""
+
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+from ..batch import atomic_write, check_xml_dst, run_tasks
+from .core import Cache, Channel, Frame, Shape, channel_layouts
+
+
+def ensure_metadata_channels(cache):
+    """Add ``resolution`` and ``offset`` channels to a cache's XML if missing.
+
+    Maya only writes these for auto-resizing fluids, but a cropped cache needs
+    them to describe each frame.
+
+    :return: The number of channels that were added.
+
+    """
+
+    added = 0
+    for shape_name in sorted(cache.shape_specs):
+        for interpretation in ('resolution', 'offset'):
+
+            name = '%s_%s' % (shape_name, interpretation)
+            if name in cache.channel_specs:
+                continue
+
+            cache.detach_xml()
+            channels = cache.etree.find('Channels')
+            template = None
+            for element in channels:
+                if element.get('ChannelName', '').startswith(shape_name + '_'):
+                    template = element
+                    break
+            if template is None:
+                raise ValueError('no channels for %r to base %r on' % (shape_name, name))
+
+            element = template.makeelement('channel%d' % len(channels), dict(template.attrib))
+            element.set('ChannelName', name)
+            element.set('ChannelInterpretation', interpretation)
+            element.tail = template.tail
+            channels.append(element)
+            added += 1
+
+    if added:
+        cache.parse_xml()
+    return added
+
+
+def find_occupied(shape, threshold=0.0, interpretations=('density', )):
+    """Find the voxels of a shape where any of the given channels are occupied.
+
+    :return: ``(lo, hi)`` tuples of ``(x, y, z)`` voxel indices, where ``hi``
+        is exclusive, or ``None`` if nothing is occupied.
+
+    """
+
+    occupied = None
+    for interpretation in interpretations:
+        channel = shape.channels.get(interpretation)
+        if channel is None:
+            continue
+        grid = shape.value_grid(channel, channel.data)
+        mask = (np.abs(grid) > threshold).any(axis=-1)
+        occupied = mask if occupied is None else occupied | mask
+
+    if occupied is None or not occupied.any():
+        return
+
+    lo = []
+    hi = []
+    for axis in (2, 1, 0): # x, y, z
+        others = tuple(i for i in xrange(3) if i != axis)
+        indices = np.flatnonzero(occupied.any(axis=others))
+        lo.append(int(indices[0]))
+        hi.append(int(indices[-1]) + 1)
+    return tuple(lo), tuple(hi)
+
+
+def crop_shape(dst_frame, shape, lo, hi):
+    """Create a cropped copy of a shape in the given frame.
+
+    :param dst_frame: The :class:`.Frame` for the new shape.
+    :param shape: The :class:`.Shape` to crop.
+    :param lo: The ``(x, y, z)`` index of the first voxel to keep.
+    :param hi: The ``(x, y, z)`` index after the last voxel to keep.
+    :return: The new :class:`.Shape`.
+
+    """
+
+    name = shape.spec.name
+    dst = Shape(dst_frame, shape.spec)
+    dst_frame._shapes[name] = dst
+
+    unit_size = shape.spec.unit_size
+    resolution = tuple(h - l for l, h in zip(lo, hi))
+    bb_min = tuple(b + l * u for b, l, u in zip(shape.bb_min, lo, unit_size))
+    offset = tuple(b + r * u / 2.0 for b, r, u in zip(bb_min, resolution, unit_size))
+
+    Channel(dst_frame, name + '_resolution', np.array(resolution, dtype=np.float32))
+    Channel(dst_frame, name + '_offset', np.array(offset, dtype=np.float32))
+
+    (x0, y0, z0), (x1, y1, z1) = lo, hi
+    for interpretation, channel in sorted(shape.channels.iteritems()):
+
+        if interpretation in ('resolution', 'offset'):
+            continue
+
+        layout = channel_layouts.get(interpretation)
+        if layout is None and not channel.data_size:
+            raise ValueError('cannot crop %r channel' % interpretation)
+
+        if layout == 'faces':
+            grids = shape.velocity_grids(channel, channel.data)
+            data = np.concatenate([
+                grid[z0:z1 + (axis == 2), y0:y1 + (axis == 1), x0:x1 + (axis == 0)].ravel()
+                for axis, grid in enumerate(grids)
+            ])
+        else:
+            data = shape.value_grid(channel, channel.data)[z0:z1, y0:y1, x0:x1].ravel()
+
+        Channel(dst_frame, channel.name, data, storage=channel.storage)
+
+    dst.finalize()
+    return dst
+
+
+def crop_frame(frame, padding=1, threshold=0.0, interpretations=('density', )):
+    """Crop every shape of a frame to its occupied voxels.
+
+    Shapes with nothing in them are cropped to their single central voxel.
+
+    :param int padding: The number of voxels to keep around the occupied ones.
+    :param float threshold: Values at or below this are unoccupied.
+    :return: A new :class:`.Frame`.
+
+    """
+
+    dst_frame = Frame(frame.cache)
+    dst_frame.set_times(frame.start_time, frame.end_time)
+
+    for name, shape in sorted(frame.shapes.iteritems()):
+        resolution = tuple(int(r) for r in shape.resolution)
+        bounds = find_occupied(shape, threshold, interpretations)
+        if bounds is None:
+            lo = tuple(r // 2 for r in resolution)
+            hi = tuple(l + 1 for l in lo)
+        else:
+            lo = tuple(max(0, l - padding) for l in bounds[0])
+            hi = tuple(min(r, h + padding) for h, r in zip(bounds[1], resolution))
+        crop_shape(dst_frame, shape, lo, hi)
+
+    return dst_frame
+
+
+def _crop_one(src_path, frame_path, dst_frame_path, padding, threshold, interpretations):
+
+    cache = Cache(src_path)
+    ensure_metadata_channels(cache)
+    frame = cache.get_frame(frame_path)
+    before = dict((name, shape.resolution) for name, shape in frame.shapes.iteritems())
+
+    dst_frame = crop_frame(frame, padding, threshold, interpretations)
+
+    with atomic_write(dst_frame_path) as fh:
+        for chunk in dst_frame.dumps_iter():
+            fh.write(chunk)
+
+    return dst_frame_path, dict(
+        (name, (before[name], shape.resolution))
+        for name, shape in dst_frame.shapes.iteritems()
+    )
+
+
+def crop_cache(src_path, dst_path, padding=1, threshold=0.0, interpretations=('density', ), workers=None, verbose=False):
+    """Crop every frame of a fluid cache, writing a new cache at ``dst_path``.
+
+    The destination may be the source, in which case it is cropped in place.
+    Frames are cropped in a pool of ``workers`` processes.
+
+    :return: List of ``(path, {shape: (old_resolution, new_resolution)})``.
+
+    """
+
+    src_path = os.path.abspath(src_path)
+    dst_path, dst_base_path = check_xml_dst(dst_path)
+
+    cache = Cache(src_path)
+    src_base_name = cache.base_name
+    ensure_metadata_channels(cache)
+
+    tasks = []
+    for frame in cache.frames:
+        name = os.path.basename(frame.path)
+        dst_frame_path = dst_base_path + name[len(src_base_name):]
+        tasks.append((src_path, frame.path, dst_frame_path, padding, threshold, interpretations))
+
+    results = run_tasks(_crop_one, tasks, workers)
+
+    # Only replace the XML once every frame is done.
+    with atomic_write(dst_path) as fh:
+        cache.write_xml(fh)
+
+    if verbose:
+        for path, shapes in results:
+            for name, (before, after) in sorted(shapes.iteritems()):
+                print '%s %s: %s -> %s' % (os.path.basename(path), name, 'x'.join(map(str, before)), 'x'.join(map(str, after)))
+
+    return results
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] input.xml output.xml')
+    opt_parser.add_option('-p', '--padding', type='int', default=1)
+    opt_parser.add_option('-t', '--threshold', type='float', default=0.0)
+    opt_parser.add_option('-c', '--channel', dest='channels', action='append',
+        help='channel interpretations which count as occupied; defaults to density')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 2:
+        opt_parser.print_usage()
+        exit(1)
+
+    crop_cache(*args,
+        padding=opts.padding,
+        threshold=opts.threshold,
+        interpretations=tuple(opts.channels or ('density', )),
+        workers=opts.workers,
+        verbose=opts.verbose
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Export fluid caches to NumPy arrays.
+
+Every frame becomes either a ``.npz`` archive, or a directory of ``.npy``
+files which can be memory-mapped with ``np.load(path, mmap_mode='r')``. Both
+contain the same arrays, named:
+
+- ``start_time`` and ``end_time``, in ticks;
+- ``<shape>.resolution``, ``<shape>.offset``, ``<shape>.bb_min``,
+  ``<shape>.bb_max``, and ``<shape>.unit_size``, all as ``(x, y, z)``;
+- ``<shape>.<interpretation>`` for every voxel-centred channel, as a
+  ``(z, y, x)`` float32 array, or ``(z, y, x, size)`` for vectors like colour;
+  channels with other interpretations are assumed to be voxel-centred with
+  the size of their storage, and are skipped (with a warning) if they are not
+  the right length for that;
+- ``<shape>.velocity_x``, ``<shape>.velocity_y``, and ``<shape>.velocity_z``,
+  the staggered face grids of velocity (see :meth:`.Shape.velocity_grids`).
+
+"""
+
+import os
+import shutil
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+from ..batch import atomic_write, run_tasks
+from .core import Cache, channel_layouts
+
+
+#: The names of every output format.
+formats = ('npz', 'npy')
+
+
+def frame_arrays(frame):
+    """Get a dict of every array to export for a frame."""
+
+    arrays = dict(
+        start_time=np.array(frame.start_time),
+        end_time=np.array(frame.end_time),
+    )
+
+    for shape_name, shape in sorted(frame.shapes.iteritems()):
+
+        prefix = shape_name + '.'
+        arrays[prefix + 'resolution'] = np.array(shape.resolution, dtype=np.int32)
+        arrays[prefix + 'offset'] = np.array(shape.offset, dtype=np.float32)
+        arrays[prefix + 'bb_min'] = np.array(shape.bb_min, dtype=np.float32)
+        arrays[prefix + 'bb_max'] = np.array(shape.bb_max, dtype=np.float32)
+        arrays[prefix + 'unit_size'] = np.array(shape.spec.unit_size, dtype=np.float32)
+
+        for interpretation, channel in sorted(shape.channels.iteritems()):
+
+            if interpretation in ('resolution', 'offset'):
+                continue
+            layout = channel_layouts.get(interpretation, channel.data_size)
+
+            data = np.asarray(channel.data).astype(np.float32)
+            if interpretation not in channel_layouts and len(data) != layout * int(np.prod(shape.resolution)):
+                print >> sys.stderr, 'Not exporting %s; %d values do not fit the grid.' % (channel.name, len(data))
+                continue
+
+            if layout == 'faces':
+                for axis, grid in zip('xyz', shape.velocity_grids(channel, data)):
+                    arrays['%s%s_%s' % (prefix, interpretation, axis)] = np.ascontiguousarray(grid)
+            else:
+                grid = shape.value_grid(channel, data)
+                if layout == 1:
+                    grid = grid[..., 0]
+                arrays[prefix + interpretation] = np.ascontiguousarray(grid)
+
+    return arrays
+
+
+def get_export_path(output_directory, frame_path, format='npz'):
+    base = os.path.splitext(os.path.basename(frame_path))[0]
+    return os.path.join(output_directory, base + ('.npz' if format == 'npz' else ''))
+
+
+def save_arrays(path, arrays, format='npz', compress=False):
+    """Atomically save a dict of arrays as a ``.npz``, or a directory of ``.npy``."""
+
+    if format == 'npz':
+        with atomic_write(path) as fh:
+            (np.savez_compressed if compress else np.savez)(fh, **arrays)
+        return
+
+    if format != 'npy':
+        raise ValueError('unknown format %r' % format)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in arrays.iteritems():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_arrays(path, mmap_mode='r'):
+    """Load the arrays of an exported frame, memory-mapping ``.npy`` files."""
+    if os.path.isdir(path):
+        return dict(
+            (name[:-4], np.load(os.path.join(path, name), mmap_mode=mmap_mode))
+            for name in os.listdir(path)
+            if name.endswith('.npy')
+        )
+    with np.load(path) as archive:
+        return dict((name, archive[name]) for name in archive.files)
+
+
+def _export_one(xml_path, frame_path, dst_path, format, compress):
+    cache = Cache(xml_path)
+    frame = cache.get_frame(frame_path)
+    try:
+        save_arrays(dst_path, frame_arrays(frame), format, compress)
+    finally:
+        frame.free()
+    return dst_path
+
+
+def export_cache(xml_path, output_directory, format='npz', compress=False, workers=None, verbose=False):
+    """Export every frame of a cache in a pool of processes.
+
+    :param str format: ``"npz"`` for an archive per frame, or ``"npy"`` for a
+        directory of memory-mappable arrays per frame.
+    :param bool compress: Compress ``.npz`` archives.
+    :return: List of the paths that were written.
+
+    """
+
+    if format not in formats:
+        raise ValueError('unknown format %r' % format)
+
+    xml_path = os.path.abspath(xml_path)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    cache = Cache(xml_path)
+    tasks = [
+        (xml_path, frame.path, get_export_path(output_directory, frame.path, format), format, compress)
+        for frame in cache.frames
+    ]
+
+    written = run_tasks(_export_one, tasks, workers)
+
+    if verbose:
+        for path in written:
+            print 'Saved to', path
+    return written
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] cache.xml output_directory')
+    opt_parser.add_option('-f', '--format', type='choice', choices=list(formats), default='npz')
+    opt_parser.add_option('-z', '--compress', action='store_true', help='compress .npz archives')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 2:
+        opt_parser.print_usage()
+        exit(1)
+
+    export_cache(*args,
+        format=opts.format,
+        compress=opts.compress,
+        workers=opts.workers,
+        verbose=opts.verbose
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""Render preview images of fluid caches without Maya.
+
+Each frame of a cache is flattened into an orthographic projection along one
+axis, either the maximum or the sum of density along every ray, and written
+as a PNG (or a JPEG if PIL is available). Sum projections are shaded as an
+optical depth, so thin smoke stays translucent. With temperature in the cache
+the smoke can be coloured by it, from grey through orange to white.
+
+Images are only rendered again when their frame is newer than they are, so
+the previews of a whole shot can be kept up to date cheaply::
+
+    python -m mayatools.fluids.preview -o previews shot/fluid/fluid.xml
+
+"""
+
+import os
+import struct
+import zlib
+from optparse import OptionParser
+
+import numpy as np
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from ..batch import atomic_write, run_tasks
+from .core import Cache
+
+
+#: The names of every projection mode.
+modes = ('max', 'sum')
+
+#: Looking along each axis, which array axes (of a ``(z, y, x)`` grid) become
+#: the rows and columns of the image, and whether to flip them.
+_views = dict(
+    x=(2, (1, True), (0, True)),
+    y=(1, (0, False), (2, False)),
+    z=(0, (1, True), (2, False)),
+)
+
+# Colours for temperatures from 0 to 1.
+_ramp_positions = (0.0, 0.33, 0.66, 1.0)
+_ramp_colours = (
+    (0.75, 0.75, 0.75),
+    (0.9, 0.3, 0.05),
+    (1.0, 0.7, 0.2),
+    (1.0, 1.0, 0.9),
+)
+
+
+def write_png(path, pixels):
+    """Atomically write a ``(height, width)`` or ``(height, width, 3)`` uint8 array as a PNG."""
+
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    height, width = pixels.shape[:2]
+    colour_type = 2 if pixels.ndim == 3 else 0
+
+    # Every scanline is prefixed by its filter type; 0 is none.
+    raw = np.zeros((height, 1 + pixels[0].size), dtype=np.uint8)
+    raw[:, 1:] = pixels.reshape(height, -1)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with atomic_write(path) as fh:
+        fh.write('\x89PNG\r\n\x1a\n')
+        fh.write(chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, colour_type, 0, 0, 0)))
+        fh.write(chunk('IDAT', zlib.compress(raw.tostring(), 6)))
+        fh.write(chunk('IEND', ''))
+
+
+def write_image(path, pixels):
+    """Atomically write a uint8 image as a PNG, or any other format PIL supports."""
+    if path.lower().endswith('.png'):
+        write_png(path, pixels)
+    elif Image is None:
+        raise ValueError('PIL is required to write %r' % os.path.basename(path))
+    else:
+        # Keep the extension last so that PIL can tell the format.
+        with atomic_write(path, suffix='.tmp' + os.path.splitext(path)[1]) as fh:
+            Image.fromarray(np.asarray(pixels, dtype=np.uint8)).save(fh)
+
+
+def project(grid, axis='z', mode='max'):
+    """Project a ``(z, y, x)`` grid along an axis into an image-oriented array."""
+
+    if mode not in modes:
+        raise ValueError('unknown projection mode %r' % mode)
+    try:
+        array_axis, (row_axis, flip_rows), (col_axis, flip_cols) = _views[axis]
+    except KeyError:
+        raise ValueError('unknown axis %r' % axis)
+
+    image = grid.max(axis=array_axis) if mode == 'max' else grid.sum(axis=array_axis)
+    remaining = [a for a in (0, 1, 2) if a != array_axis]
+    if remaining.index(row_axis):
+        image = image.T
+    if flip_rows:
+        image = image[::-1]
+    if flip_cols:
+        image = image[:, ::-1]
+    return image
+
+
+def render_shape(shape, axis='z', mode='max', exposure=1.0, temperature=True, temperature_scale=1.0):
+    """Render one shape into a uint8 image.
+
+    :param float exposure: Multiplier for density before shading.
+    :param bool temperature: Colour by the temperature channel, if there is one.
+    :param float temperature_scale: The temperature which is shaded white.
+    :return: A ``(height, width)`` array, or ``(height, width, 3)`` if coloured.
+
+    """
+
+    density = shape.channels.get('density')
+    if density is None:
+        raise ValueError('shape %r has no density' % shape.spec.name)
+    density = np.maximum(shape.value_grid(density)[..., 0], 0.0)
+
+    depth = project(density, axis, mode) * exposure
+    if mode == 'sum':
+        depth *= shape.spec.unit_size['xyz'.index(axis)]
+        alpha = 1.0 - np.exp(-depth)
+    else:
+        alpha = np.clip(depth, 0.0, 1.0)
+
+    heat = shape.channels.get('temperature') if temperature else None
+    if heat is None:
+        return (alpha * 255 + 0.5).astype(np.uint8)
+
+    heat = shape.value_grid(heat)[..., 0]
+    if mode == 'sum':
+        # The density-weighted average along every ray.
+        weight = project(density, axis, 'sum')
+        heat = project(density * heat, axis, 'sum') / np.where(weight > 0, weight, 1.0)
+    else:
+        heat = project(heat, axis, 'max')
+    heat = np.clip(heat / temperature_scale, 0.0, 1.0)
+
+    rgb = np.empty(alpha.shape + (3, ))
+    for i in xrange(3):
+        rgb[..., i] = alpha * np.interp(heat, _ramp_positions, [c[i] for c in _ramp_colours])
+    return (rgb * 255 + 0.5).astype(np.uint8)
+
+
+def get_preview_path(output_directory, frame_path, shape_name, axis, mode, ext='.png'):
+    base = os.path.splitext(os.path.basename(frame_path))[0]
+    return os.path.join(output_directory, '%s.%s.%s%s%s' % (base, shape_name, mode, axis, ext))
+
+
+def _preview_one(xml_path, frame_path, output_directory, ext, force, kwargs):
+
+    cache = Cache(xml_path)
+    frame = cache.get_frame(frame_path)
+    frame_mtime = os.path.getmtime(frame_path)
+    axis = kwargs.get('axis', 'z')
+    mode = kwargs.get('mode', 'max')
+
+    written = []
+    try:
+        for shape_name in sorted(cache.shape_specs):
+            path = get_preview_path(output_directory, frame_path, shape_name, axis, mode, ext)
+            if not force and os.path.exists(path) and os.path.getmtime(path) >= frame_mtime:
+                continue
+            shape = frame.shapes.get(shape_name)
+            if shape is None:
+                continue
+            write_image(path, render_shape(shape, **kwargs))
+            written.append(path)
+    finally:
+        frame.free()
+
+    return written
+
+
+def render_cache(xml_path, output_directory, ext='.png', force=False, workers=None, verbose=False, **kwargs):
+    """Render previews of every frame of a cache in a pool of processes.
+
+    Previews which are newer than their frame are not rendered again unless
+    ``force`` is set. Other keyword arguments are passed to
+    :func:`render_shape`.
+
+    :return: List of the images that were written.
+
+    """
+
+    xml_path = os.path.abspath(xml_path)
+    if not ext.lower() == '.png' and Image is None:
+        raise ValueError('PIL is required to write %r images' % ext)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    cache = Cache(xml_path)
+    tasks = [(xml_path, frame.path, output_directory, ext, force, kwargs) for frame in cache.frames]
+
+    results = run_tasks(_preview_one, tasks, workers)
+
+    written = [path for paths in results for path in paths]
+    if verbose:
+        for path in written:
+            print 'Saved to', path
+    return written
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] cache.xml [...]')
+    opt_parser.add_option('-o', '--output', help='directory for images; defaults to "preview" beside each cache')
+    opt_parser.add_option('-a', '--axis', type='choice', choices=['x', 'y', 'z'], default='z')
+    opt_parser.add_option('-m', '--mode', type='choice', choices=list(modes), default='max')
+    opt_parser.add_option('-x', '--exposure', type='float', default=1.0)
+    opt_parser.add_option('--no-temperature', dest='temperature', action='store_false', default=True)
+    opt_parser.add_option('--temperature-scale', type='float', default=1.0)
+    opt_parser.add_option('--jpeg', action='store_true', help='write JPEGs instead of PNGs; requires PIL')
+    opt_parser.add_option('-f', '--force', action='store_true')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if not args:
+        opt_parser.print_usage()
+        exit(1)
+
+    for xml_path in args:
+        render_cache(
+            xml_path,
+            opts.output or os.path.join(os.path.dirname(os.path.abspath(xml_path)), 'preview'),
+            ext='.jpg' if opts.jpeg else '.png',
+            force=opts.force,
+            workers=opts.workers,
+            verbose=opts.verbose,
+            axis=opts.axis,
+            mode=opts.mode,
+            exposure=opts.exposure,
+            temperature=opts.temperature,
+            temperature_scale=opts.temperature_scale,
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Convert fluid caches to and from compact storage types.
+
+Density and temperature rarely need full float precision, so intermediate
+caches can store them as ``float16``, or quantized to 8 or 16 bits with a
+per-frame scale and offset (see :data:`.core.storage_types`). They are read
+back transparently as floats, but Maya cannot load them, so convert them back
+to ``float32`` before they are handed off::
+
+    python -m mayatools.fluids.quantize -c density=uint8 -c temperature=float16 in.xml small.xml
+    python -m mayatools.fluids.quantize small.xml maya.xml
+
+Converting back is lossless with respect to the quantized values.
+
+The compact storage types are written as chunks which only this package
+understands:
+
+- ``float16`` channels are ``FHCA`` chunks of big-endian half floats;
+- ``uint16`` and ``uint8`` channels are ``QSCA`` and ``QBCA`` chunks of
+  big-endian unsigned integers, spanning the range of the channel's finite
+  values in the frame (non-finite values become the minimum).
+
+Each quantized chunk is preceded (after its ``SIZE``) by a ``QSCL`` chunk of
+two big-endian doubles, the ``scale`` and ``offset``, so that each value is
+``quantized * scale + offset``. A channel whose values are all the same has a
+scale of zero.
+
+"""
+
+import os
+import shutil
+from optparse import OptionParser
+
+from ..batch import atomic_write, check_xml_dst, run_tasks
+from .core import Cache, storage_types
+
+
+def _convert_one(src_path, frame_path, dst_frame_path, storage):
+    frame = Cache(src_path).get_frame(frame_path)
+    try:
+        with atomic_write(dst_frame_path) as fh:
+            for chunk in frame.dumps_iter(storage):
+                fh.write(chunk)
+    finally:
+        frame.free()
+    return dst_frame_path
+
+
+def convert_cache(src_path, dst_path, storage=None, workers=None, verbose=False):
+    """Rewrite every frame of a cache with the given storage types.
+
+    :param dict storage: Map channel interpretations to storage types. Any
+        others (or all of them, if not given) keep Maya's types as they were
+        read (e.g. doubles stay ``float64``), and compact types are stored as
+        ``float32``.
+    :return: List of the frame paths that were written.
+
+    """
+
+    storage = dict(storage or {})
+    for interpretation, storage_type in storage.iteritems():
+        if storage_type not in storage_types:
+            raise ValueError('unknown storage type %r for %s' % (storage_type, interpretation))
+
+    src_path = os.path.abspath(src_path)
+    dst_path, dst_base_path = check_xml_dst(dst_path)
+    if src_path == dst_path:
+        raise ValueError('cannot convert a cache in place')
+
+    cache = Cache(src_path)
+    tasks = []
+    for frame in cache.frames:
+        dst_frame_path = dst_base_path + os.path.basename(frame.path)[len(cache.base_name):]
+        tasks.append((src_path, frame.path, dst_frame_path, storage))
+
+    written = run_tasks(_convert_one, tasks, workers)
+
+    shutil.copyfile(src_path, dst_path)
+
+    if verbose:
+        for path in written:
+            print 'Saved to', path
+
+    return written
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] input.xml output.xml')
+    opt_parser.add_option('-c', '--channel', dest='channels', action='append', default=[],
+        help='how to store a channel, e.g. "density=uint8"; one of %s' % ', '.join(sorted(storage_types)))
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 2:
+        opt_parser.print_usage()
+        exit(1)
+
+    storage = {}
+    for spec in opts.channels:
+        interpretation, _, storage_type = spec.partition('=')
+        if storage_type not in storage_types:
+            opt_parser.error('bad channel storage %r' % spec)
+        storage[interpretation] = storage_type
+
+    convert_cache(*args,
+        storage=storage,
+        workers=opts.workers,
+        verbose=opts.verbose
+    )
+
+
+if __name__ == '__main__':
+    main()
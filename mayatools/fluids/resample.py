@@ -0,0 +1,242 @@
+"""Resample fluid caches to a new voxel size.
+
+Every channel of every frame is resampled onto a grid with the new voxel size
+which covers the same region, and the container's ``resolution`` in the XML
+``extra`` data is updated to match. Voxel-centred channels use either
+trilinear interpolation or a box filter (the average of the source voxels
+which overlap each new voxel; best for reducing resolution). Velocity is
+always sampled trilinearly on its own face grids.
+
+For example, to make a half-resolution proxy::
+
+    resample_cache('hero/fluid.xml', 'proxy/fluid.xml', scale=0.5)
+
+"""
+
+import math
+import os
+import re
+from optparse import OptionParser
+
+import numpy as np
+
+from ..batch import atomic_write, check_xml_dst, run_tasks
+from .core import Cache, Channel, Frame, Shape, channel_layouts
+from .crop import ensure_metadata_channels
+
+
+#: The names of every filter.
+filters = ('linear', 'box')
+
+
+def _box_taps(src_min, src_unit, src_count, dst_min, dst_unit, dst_count):
+    """Get ``(indices, weights)`` pairs for box filtering along one axis."""
+
+    starts = dst_min + dst_unit * np.arange(dst_count)
+    ends = starts + dst_unit
+    first = np.floor((starts - src_min) / src_unit).astype(np.intp)
+
+    taps = []
+    for k in xrange(int(math.ceil(dst_unit / src_unit)) + 1):
+        indices = first + k
+        src_starts = src_min + src_unit * indices
+        overlap = np.minimum(ends, src_starts + src_unit) - np.maximum(starts, src_starts)
+        valid = (indices >= 0) & (indices < src_count) & (overlap > 0)
+        if valid.any():
+            taps.append((np.clip(indices, 0, src_count - 1), np.where(valid, overlap / dst_unit, 0.0)))
+    return taps
+
+
+def box_filter(grid, src_min, src_unit, dst_min, dst_unit, dst_resolution):
+    """Box filter a ``(z, y, x, size)`` grid onto a new one.
+
+    :param src_min: The ``(x, y, z)`` minimum bounds of the source grid.
+    :param src_unit: The ``(x, y, z)`` voxel size of the source grid.
+    :param dst_min: The ``(x, y, z)`` minimum bounds of the new grid.
+    :param dst_unit: The ``(x, y, z)`` voxel size of the new grid.
+    :param dst_resolution: The ``(x, y, z)`` resolution of the new grid.
+
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    for axis in xrange(3):
+        array_axis = 2 - axis
+        shape = [1] * grid.ndim
+        shape[array_axis] = dst_resolution[axis]
+        out = None
+        for indices, weights in _box_taps(
+            src_min[axis], src_unit[axis], grid.shape[array_axis],
+            dst_min[axis], dst_unit[axis], dst_resolution[axis],
+        ):
+            value = weights.reshape(shape) * grid.take(indices, axis=array_axis)
+            out = value if out is None else out + value
+        if out is None:
+            shape = list(grid.shape)
+            shape[array_axis] = dst_resolution[axis]
+            out = np.zeros(shape)
+        grid = out
+    return grid
+
+
+def resample_shape(dst_frame, shape, filter='linear'):
+    """Create a resampled copy of a shape in the given frame.
+
+    The new shape uses the spec of the same name from the cache of
+    ``dst_frame``, and keeps the centre of the original.
+
+    :return: The new :class:`.Shape`.
+
+    """
+
+    name = shape.spec.name
+    spec = dst_frame.cache.shape_specs[name]
+    dst = Shape(dst_frame, spec)
+    dst_frame._shapes[name] = dst
+
+    resolution = tuple(
+        max(1, int(round(r * su / du)))
+        for r, su, du in zip(shape.resolution, shape.spec.unit_size, spec.unit_size)
+    )
+    offset = shape.offset
+    Channel(dst_frame, name + '_resolution', np.array(resolution, dtype=np.float32))
+    Channel(dst_frame, name + '_offset', np.array(offset, dtype=np.float32))
+    dst.finalize()
+
+    x, y, z = dst.center_axes()
+    for interpretation, channel in sorted(shape.channels.iteritems()):
+
+        if interpretation in ('resolution', 'offset'):
+            continue
+
+        layout = channel_layouts.get(interpretation)
+        if layout is None and not channel.data_size:
+            raise ValueError('cannot resample %r channel' % interpretation)
+
+        data = np.asarray(channel.data)
+        dtype = np.float64 if data.dtype.itemsize == 8 else np.float32
+        data = data.astype(np.float64)
+        if layout == 'faces':
+            grids = []
+            for axis in xrange(3):
+                points = dst.grid_points(axis)
+                grids.append(shape.sample_velocity_component(channel, axis, *points, mode='linear', data=data).ravel())
+            values = np.concatenate(grids)
+        elif filter == 'box':
+            values = box_filter(
+                shape.value_grid(channel, data),
+                shape.bb_min, shape.spec.unit_size,
+                dst.bb_min, spec.unit_size, dst.resolution,
+            )
+        else:
+            values = shape.sample_values(channel, x, y, z, 'linear', data)
+
+        Channel(dst_frame, channel.name, values.astype(dtype).ravel(), storage=channel.storage)
+
+    return dst
+
+
+def resample_frame(frame, dst_cache, filter='linear'):
+    """Resample every shape of a frame into a frame of ``dst_cache``."""
+    dst_frame = Frame(dst_cache)
+    dst_frame.set_times(frame.start_time, frame.end_time)
+    for name, shape in sorted(frame.shapes.iteritems()):
+        resample_shape(dst_frame, shape, filter)
+    return dst_frame
+
+
+def _set_extra(cache, shape_name, key, value):
+    pattern = re.compile(r'^%s\.%s=' % (re.escape(shape_name), key))
+    for element in cache.etree.findall('extra'):
+        if pattern.match(element.text or ''):
+            element.text = '%s.%s=%s' % (shape_name, key, value)
+            return
+    raise ValueError('no %s.%s in XML' % (shape_name, key))
+
+
+def _resample_one(src_path, dst_path, frame_path, dst_frame_path, filter):
+
+    src_cache = Cache(src_path)
+    dst_cache = Cache(dst_path)
+    dst_frame = resample_frame(src_cache.get_frame(frame_path), dst_cache, filter)
+
+    with atomic_write(dst_frame_path) as fh:
+        for chunk in dst_frame.dumps_iter():
+            fh.write(chunk)
+
+    return dst_frame_path
+
+
+def resample_cache(src_path, dst_path, scale=None, voxel_size=None, filter='linear', workers=None, verbose=False):
+    """Resample every frame of a fluid cache, writing a new cache at ``dst_path``.
+
+    :param float scale: Multiplier for the resolution, e.g. ``0.5`` for half
+        resolution.
+    :param float voxel_size: The new size of voxels, instead of ``scale``.
+    :param str filter: ``"linear"`` or ``"box"``.
+    :param int workers: The number of processes to resample frames with.
+    :return: List of the frame paths that were written.
+
+    """
+
+    if (scale is None) == (voxel_size is None):
+        raise ValueError('exactly one of scale or voxel_size is required')
+    if filter not in filters:
+        raise ValueError('unknown filter %r' % filter)
+
+    src_path = os.path.abspath(src_path)
+    dst_path, dst_base_path = check_xml_dst(dst_path)
+    if src_path == dst_path:
+        raise ValueError('cannot resample a cache in place')
+
+    # The new XML describes the container at the new resolution; the
+    # dimensions are unchanged.
+    cache = Cache(src_path)
+    ensure_metadata_channels(cache)
+    cache.detach_xml()
+    for name, spec in sorted(cache.shape_specs.iteritems()):
+        for axis, dimension, resolution in zip('WHD', spec.dimensions, spec.resolution):
+            if voxel_size is None:
+                new_resolution = max(1, int(round(resolution * scale)))
+            else:
+                new_resolution = max(1, int(round(float(dimension) / voxel_size)))
+            _set_extra(cache, name, 'resolution' + axis, new_resolution)
+    cache.write_xml(dst_path)
+
+    tasks = []
+    for frame in cache.frames:
+        dst_frame_path = dst_base_path + os.path.basename(frame.path)[len(cache.base_name):]
+        tasks.append((src_path, dst_path, frame.path, dst_frame_path, filter))
+
+    written = run_tasks(_resample_one, tasks, workers)
+
+    if verbose:
+        for path in written:
+            print 'Saved to', path
+
+    return written
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] input.xml output.xml')
+    opt_parser.add_option('-s', '--scale', type='float')
+    opt_parser.add_option('--voxel-size', type='float')
+    opt_parser.add_option('-f', '--filter', type='choice', choices=list(filters), default='linear')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 2 or (opts.scale is None) == (opts.voxel_size is None):
+        opt_parser.print_usage()
+        exit(1)
+
+    resample_cache(*args,
+        scale=opts.scale,
+        voxel_size=opts.voxel_size,
+        filter=opts.filter,
+        workers=opts.workers,
+        verbose=opts.verbose
+    )
+
+
+if __name__ == '__main__':
+    main()
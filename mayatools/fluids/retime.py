@@ -1,11 +1,17 @@
+import bisect
+import hashlib
+import json
 import math
 import os
+import time
 
 from optparse import OptionParser
 
-import qbfutures
-
-from .core import Cache, Frame, Shape, Channel
+from .. import mcc
+from ..batch import atomic_write, check_xml_dst, run_tasks
+from . import sampling as _sampling
+from .core import Cache, Frame, Shape
+from .crop import crop_frame
 
 
 def frange(a, b, step):
@@ -17,12 +23,144 @@ def frange(a, b, step):
         v += step
 
 
+#: Bump this whenever the blending (or the manifest) changes enough to
+#: invalidate old output.
+MANIFEST_VERSION = 2
+
+
+def get_manifest_path(dst_path):
+    """Get the path of the manifest of a retime which outputs ``dst_path``."""
+    return os.path.splitext(os.path.abspath(dst_path))[0] + '.retime.json'
+
+
+def load_manifest(dst_path):
+    """Load the manifest of a previous retime, or an empty one.
+
+    The manifest maps output ticks (see :func:`get_tick_key`) to ``dict`` with the ``hash``
+    of the parameters for that tick, when it was ``submitted``, and the
+    ``output`` ``[size, mtime]`` once it is known to be complete.
+
+    """
+    try:
+        with open(get_manifest_path(dst_path)) as fh:
+            manifest = json.load(fh)
+    except (IOError, ValueError):
+        manifest = None
+    if not manifest or manifest.get('version') != MANIFEST_VERSION:
+        manifest = dict(version=MANIFEST_VERSION, ticks={})
+    return manifest
+
+
+def save_manifest(dst_path, manifest):
+    with atomic_write(get_manifest_path(dst_path), 'w') as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+
+
+def get_tick_key(dst_time, time_per_frame=250):
+    """Get the manifest key of an output tick.
+
+    This is the name of the tick's frame (e.g. ``"Frame12Tick125"``), so that
+    ticks share keys exactly when they share output files.
+
+    """
+    return os.path.splitext(mcc.get_frame_name('', dst_time, time_per_frame))[0]
+
+
+def _stat_output(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    return [stat.st_size, stat.st_mtime]
+
+
+def _tick_hash(src_time, frame_a_path, frame_b_path, params):
+    """Hash everything that goes into the output of one tick."""
+    frames = []
+    for path in (frame_a_path, frame_b_path):
+        stat = os.stat(path)
+        frames.append((path, stat.st_size, stat.st_mtime))
+    key = json.dumps([MANIFEST_VERSION, src_time, frames, params], sort_keys=True)
+    return hashlib.sha1(key).hexdigest()
+
+
+def _is_complete(entry, hash_, dst_path):
+    """Is a manifest entry for a tick complete and still valid?"""
+    if not entry or entry.get('hash') != hash_:
+        return False
+    output = _stat_output(dst_path)
+    if not output:
+        return False
+    if entry.get('output'):
+        return output == entry['output']
+    # The task was submitted but we never heard back (e.g. it was on the
+    # farm). Frames are written atomically, so any frame written since then
+    # is complete.
+    return output[1] >= entry.get('submitted', float('inf'))
+
+
 def iter_ticks(src_start, src_end, dst_start, dst_end, sampling_rate):
     for dst_time in frange(dst_start, dst_end, sampling_rate):
         src_time = src_start + (src_end - src_start) * (dst_time - dst_start) / (dst_end - dst_start)
         yield src_time, dst_time
 
 
+class FrameMapper(object):
+
+    """Maps times onto the pair of frames around them.
+
+    :param frames: List of ``(time, frame)`` tuples, where the frames may be
+        anything (e.g. paths or :class:`~mayatools.fluids.core.Frame` objects).
+    :param int time_per_frame: Only used to format errors.
+
+    """
+
+    def __init__(self, frames, time_per_frame=250):
+        frames = sorted(frames, key=lambda x: x[0])
+        if not frames:
+            raise ValueError('No frames to map onto')
+        self.times = [time for time, frame in frames]
+        self.frames = [frame for time, frame in frames]
+        self.time_per_frame = time_per_frame
+
+    def _format_time(self, time):
+        frames, ticks = divmod(time, self.time_per_frame)
+        return '%d:%d' % (frames, ticks)
+
+    def find_indices(self, time):
+        """Get the indices of the frames at or on either side of a time.
+
+        :return: ``(index_a, index_b)``, which are equal if there is a frame
+            at exactly that time.
+        :raises ValueError: If the time is outside of the frames.
+
+        """
+        i = bisect.bisect_right(self.times, time) - 1
+        if i < 0 or time > self.times[-1]:
+            raise ValueError('Cannot find data for time %s; have from %s to %s' % (
+                self._format_time(time),
+                self._format_time(self.times[0]),
+                self._format_time(self.times[-1]),
+            ))
+        if self.times[i] == time:
+            return i, i
+        return i, i + 1
+
+    def __call__(self, time):
+        """Get ``(frame_a, frame_b, weight)`` for a time.
+
+        The weight is how far the time is from ``frame_a`` to ``frame_b``, and
+        is zero when they are the same frame.
+
+        """
+        a, b = self.find_indices(time)
+        if a == b:
+            weight = 0.0
+        else:
+            weight = float(time - self.times[a]) / float(self.times[b] - self.times[a])
+        return self.frames[a], self.frames[b], weight
+
+
 def main():
 
     option_parser = OptionParser(usage='%prog [options] input.xml, output.xml')
@@ -34,7 +172,15 @@ def main():
     option_parser.add_option('-v', '--verbose', action='count', default=0)
     option_parser.add_option('-f', '--farm', action='store_true')
     option_parser.add_option('-w', '--workers', type='int', default=20)
-    option_parser.add_option('-a', '--advect', type='float', default=0.0)
+    option_parser.add_option('-l', '--local-workers', type='int')
+    option_parser.add_option('-c', '--chunk-size', type='int', default=4)
+    option_parser.add_option('--slab-workers', type='int', help='processes to blend each frame with')
+    option_parser.add_option('--crop', type='int', metavar='PADDING', help='crop output to the density, plus padding')
+    option_parser.add_option('--force', action='store_true', help='recompute every tick, even if complete')
+    option_parser.add_option('-a', '--advect', type='float', default=1.0)
+    option_parser.add_option('--substeps', type='int', default=1)
+    option_parser.add_option('--sampling', type='choice', choices=list(_sampling.modes), default='nearest')
+    option_parser.add_option('--velocity-sampling', type='choice', choices=list(_sampling.modes), default='linear')
     opts, args = option_parser.parse_args()
 
     if len(args) != 2:
@@ -51,11 +197,22 @@ def main():
         verbose=opts.verbose,
         farm=opts.farm,
         workers=opts.workers,
-        advect=opts.advect
+        local_workers=opts.local_workers,
+        chunk_size=opts.chunk_size,
+        slab_workers=opts.slab_workers,
+        crop=opts.crop,
+        force=opts.force,
+        advect=opts.advect,
+        sampling=opts.sampling,
+        velocity_sampling=opts.velocity_sampling,
+        substeps=opts.substeps
     )
 
     if opts.farm:
-        print 'Qube job ID', res
+        if res is None:
+            print 'Every tick is already complete; nothing was submitted.'
+        else:
+            print 'Qube job ID', res
 
 
 def schedule_retime(
@@ -66,49 +223,62 @@ def schedule_retime(
     farm=True,
     workers=20,
     verbose=0,
-    advect=0.0,
+    advect=1.0,
+    sampling='nearest',
+    velocity_sampling='linear',
+    substeps=1,
+    local_workers=None,
+    chunk_size=4,
+    force=False,
+    slab_workers=None,
+    crop=None,
 ):
+    """Retime a fluid cache, writing a new cache at ``dst_path``.
 
-    dst_path = os.path.abspath(dst_path)
-    src_path = os.path.abspath(src_path)
+    The output ticks are split into runs of ``chunk_size`` consecutive ticks,
+    each of which is blended by :func:`blend_chunk_on_farm`, either on the
+    farm via Qube, in a local pool of ``local_workers`` processes, or
+    serially in this process.
 
-    dst_base_name, dst_ext = os.path.splitext(dst_path)
-    if dst_ext != '.xml':
-        option_parser.print_usage()
-        exit(2)
-    dst_directory, dst_base_name = os.path.split(dst_base_name)
-    if not os.path.exists(dst_directory):
-        os.makedirs(dst_directory)
+    A manifest next to ``dst_path`` records the parameters and output of
+    every tick, so that rerunning an interrupted retime only blends the ticks
+    which are missing or stale (unless ``force`` is set).
+
+    If ``crop`` is not ``None``, every output frame is cropped to its density
+    plus that many voxels of padding (see :mod:`mayatools.fluids.crop`).
+
+    :return: The Qube job ID if on the ``farm``, otherwise a list of the frame
+        paths that were written. If every tick is already complete then
+        nothing is submitted, and this is ``None`` (or ``[]`` if not on the
+        ``farm``).
+
+    """
+
+    dst_path, dst_base_path = check_xml_dst(dst_path)
+    src_path = os.path.abspath(src_path)
 
     src_cache = Cache(src_path)
     if verbose >= 2:
         src_cache.pprint()
 
 
-    # Load the headers for all the frames, and sort them by time.
-    frame_times = []
-    for frame in src_cache.frames:
-        frame_times.append((frame.start_time, frame.path))
-        frame.free()
-    frame_times.sort()
+    # The frames are sorted by the times in their names, so none of them need
+    # to be opened here.
+    frame_times = [(frame.time, frame.path) for frame in src_cache.frames]
     if not frame_times:
         print 'No frames in src_cache.'
         exit(2)
 
-    # Reclaim the file handles.
-    src_cache.free()
-
     # Construct the new src_cache that our frames will go into.
     dst_cache = src_cache.clone()
-    dst_base_path = os.path.join(dst_directory, dst_base_name)
 
     # Convert all time options into an integer of ticks.
     if dst_start is None:
-        dst_start = dst_cache.frames[0].start_time
+        dst_start = frame_times[0][0]
     else:
         dst_start = int(dst_start * dst_cache.time_per_frame)
     if dst_end is None:
-        dst_end = dst_cache.frames[-1].end_time
+        dst_end = frame_times[-1][0]
     else:
         dst_end = int(dst_end * dst_cache.time_per_frame)
 
@@ -124,55 +294,112 @@ def schedule_retime(
     # This one remains a float.
     sampling_rate = sampling_rate * src_cache.time_per_frame
 
-    # Isolate the frames requested via src-*.
-    frames = [f for f in frame_times if f[0] >= dst_start and f[0] <= dst_end]
-
     # Write the new XML.
     dst_cache.update_xml(dst_start, dst_end)
     dst_cache.write_xml(dst_path)
 
-    def get_frames_for(src_time):
-        try:
-            frame_a_path = [f[1] for f in frame_times if f[0] <= src_time][-1]
-            frame_b_path = next(f[1] for f in frame_times if f[0] >= src_time)
-        except (IndexError, StopIteration):
-            def format_time(time):
-                frames, ticks = divmod(time, 250)
-                return '%d:%d' % (frames, ticks)
-            raise ValueError('Cannot find data for time %s; have from %s to %s' % (
-                format_time(src_time),
-                format_time(frames[0][0]),
-                format_time(frames[-1][0]),
-            ))
-        return frame_a_path, frame_b_path
+    mapper = FrameMapper(frame_times, src_cache.time_per_frame)
+
+    # Resolve every tick up front so that bad time ranges fail before any
+    # work is submitted.
+    ticks = []
+    for src_time, dst_time in iter_ticks(src_start, src_end, dst_start, dst_end, sampling_rate):
+        frame_a_path, frame_b_path = mapper(src_time)[:2]
+        ticks.append((src_time, dst_time, frame_a_path, frame_b_path))
+
+    # Skip any ticks which are already done.
+    manifest = load_manifest(dst_path)
+    params = [advect, sampling, velocity_sampling, substeps, crop]
+    submitted = time.time()
+    todo = []
+    for tick in ticks:
+        src_time, dst_time, frame_a_path, frame_b_path = tick
+        key = get_tick_key(dst_time, src_cache.time_per_frame)
+        hash_ = _tick_hash(src_time, frame_a_path, frame_b_path, params)
+        entry = manifest['ticks'].get(key)
+        tick_path = mcc.get_frame_name(dst_base_path, dst_time, src_cache.time_per_frame)
+        if not force and _is_complete(entry, hash_, tick_path):
+            if not entry.get('output'):
+                entry['output'] = _stat_output(tick_path)
+            continue
+        manifest['ticks'][key] = dict(hash=hash_, submitted=submitted, output=None)
+        todo.append(tick)
+    save_manifest(dst_path, manifest)
+
+    if verbose:
+        print 'Skipping %d of %d ticks which are already complete.' % (len(ticks) - len(todo), len(ticks))
+    if not todo:
+        return None if farm else []
+
+    chunk_size = max(1, chunk_size or 1)
+    chunks = [todo[i:i + chunk_size] for i in xrange(0, len(todo), chunk_size)]
+    extra_args = (dst_base_path, advect, sampling, velocity_sampling, substeps, slab_workers, crop)
 
     if farm:
+        import qbfutures
         executor = qbfutures.Executor(cpus=workers, groups='farm', reservations='host.processors=1')
         with executor.batch(name='Retime Fluid:%s:%s' % (os.path.basename(src_cache.directory), src_cache.shape_specs.keys()[0])) as batch:
-
-            for src_time, dst_time in iter_ticks(src_start, src_end, dst_start, dst_end, sampling_rate):
-                frame_a_path, frame_b_path = get_frames_for(src_time)
+            for chunk in chunks:
                 batch.submit_ext(
-                    func='mayatools.fluids.retime:blend_one_on_farm',
-                    args=[src_cache.xml_path, src_time, dst_time, frame_a_path, frame_b_path, dst_base_path, advect],
-                    name='Blend %d from %d' % (dst_time, src_time),
+                    func='mayatools.fluids.retime:blend_chunk_on_farm',
+                    args=[src_cache.xml_path, chunk] + list(extra_args),
+                    name='Blend %d-%d from %d-%d' % (chunk[0][1], chunk[-1][1], chunk[0][0], chunk[-1][0]),
                 )
         return batch.futures[0].job_id
 
-    # Iterate over the requested ticks.
-    for src_time, dst_time in iter_ticks(src_start, src_end, dst_start, dst_end, sampling_rate):
-        frame_a_path, frame_b_path = get_frames_for(src_time)
-        blend_one_on_farm(src_cache.xml_path, src_time, dst_time, frame_a_path, frame_b_path, dst_base_path, advect)
+    written = []
+    try:
+        if local_workers and local_workers > 1 and len(chunks) > 1:
+            tasks = [(src_cache.xml_path, chunk) + extra_args for chunk in chunks]
+            for paths in run_tasks(blend_chunk_on_farm, tasks, local_workers):
+                written.extend(paths)
+        else:
+            # Iterate over the requested ticks, sharing decoded frames
+            # between the chunks.
+            for chunk in chunks:
+                written.extend(blend_chunk_on_farm(src_cache, chunk, *extra_args))
+    finally:
+        # Record whatever we finished, even if something failed.
+        written_set = set(written)
+        for src_time, dst_time, frame_a_path, frame_b_path in todo:
+            tick_path = mcc.get_frame_name(dst_base_path, dst_time, src_cache.time_per_frame)
+            if tick_path in written_set:
+                manifest['ticks'][get_tick_key(dst_time, src_cache.time_per_frame)]['output'] = _stat_output(tick_path)
+        save_manifest(dst_path, manifest)
+
+    return written
+
+
+def blend_chunk_on_farm(cache, ticks, dst_base_path, advect, sampling='nearest', velocity_sampling='linear', substeps=1, slab_workers=None, crop=None):
+    """Blend a run of consecutive ticks, reusing the source frames between them.
+
+    The decoded source frames are shared through the cache, within its
+    :attr:`~mayatools.fluids.core.Cache.frame_budget`.
+
+    :param ticks: List of ``(src_time, dst_time, frame_a_path, frame_b_path)``.
+    :return: List of the frame paths that were written.
+
+    """
+
+    if isinstance(cache, basestring):
+        cache = Cache(cache)
+
+    written = []
+    for src_time, dst_time, frame_a_path, frame_b_path in ticks:
+        written.append(blend_one_on_farm(cache, src_time, dst_time, frame_a_path, frame_b_path,
+            dst_base_path, advect, sampling, velocity_sampling, substeps, slab_workers, crop))
+
+    return written
 
 
-def blend_one_on_farm(cache, src_time, dst_time, frame_a, frame_b, dst_base_path, advect):
+def blend_one_on_farm(cache, src_time, dst_time, frame_a, frame_b, dst_base_path, advect, sampling='nearest', velocity_sampling='linear', substeps=1, slab_workers=None, crop=None):
 
     if isinstance(cache, basestring):
         cache = Cache(cache)
     if isinstance(frame_a, basestring):
-        frame_a = Frame(cache, frame_a)
+        frame_a = cache.get_frame(frame_a)
     if isinstance(frame_b, basestring):
-        frame_b = Frame(cache, frame_b)
+        frame_b = cache.get_frame(frame_b)
 
     dst_frame = Frame(cache)
     dst_frame.set_times(dst_time, dst_time)
@@ -183,15 +410,16 @@ def blend_one_on_farm(cache, src_time, dst_time, frame_a, frame_b, dst_base_path
 
     else:
         blend_factor = float(src_time - frame_a.start_time) / float(frame_b.start_time - frame_a.start_time)
-        for shape_name, shape_a in sorted(frame_a.shapes.iteritems()):
-            dst_shape = Shape.setup_blend(dst_frame, shape_name, frame_a, frame_b)
-            dst_shape.blend(blend_factor, advect)
+        # Neither source may be released while the other is loading.
+        with cache.pin(frame_a, frame_b):
+            for shape_name, shape_a in sorted(frame_a.shapes.iteritems()):
+                dst_shape = Shape.setup_blend(dst_frame, shape_name, frame_a, frame_b)
+                dst_shape.blend(blend_factor, advect, sampling, velocity_sampling, substeps, slab_workers)
 
-    frame_no, tick = divmod(dst_time, cache.time_per_frame)
-    if tick:
-        dst_path = '%sFrame%dTick%d.mc' % (dst_base_path, frame_no, tick)
-    else:
-        dst_path = '%sFrame%d.mc' % (dst_base_path, frame_no)
+    if crop is not None:
+        dst_frame = crop_frame(dst_frame, crop)
+
+    dst_path = mcc.get_frame_name(dst_base_path, dst_time, cache.time_per_frame)
     print 'Saving to', dst_path
 
     try:
@@ -199,10 +427,14 @@ def blend_one_on_farm(cache, src_time, dst_time, frame_a, frame_b, dst_base_path
     except OSError:
         pass
 
-    with open(dst_path, 'wb') as fh:
+    # Write atomically, so that a partial frame is never mistaken for a
+    # complete one when resuming.
+    with atomic_write(dst_path) as fh:
         for chunk in dst_frame.dumps_iter():
             fh.write(chunk)
 
+    return dst_path
+
 
 
 if __name__ == '__main__':
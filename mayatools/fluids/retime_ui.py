@@ -197,7 +197,9 @@ class Dialog(QtGui.QDialog):
             )
             return
 
-        if os.path.exists(dst_path):
+        # Replacing must redo every tick, rather than resume a previous retime.
+        replace = os.path.exists(dst_path)
+        if replace:
             res = QtGui.QMessageBox.warning(None,
                 'Destination Exists',
                 'The destination already exists; do you want to continue and replace it?',
@@ -217,13 +219,20 @@ class Dialog(QtGui.QDialog):
             farm=True,
             workers=self.ui.workers.value(),
             advect=self.ui.advect.value(),
+            force=replace,
         )
-        print 'Qube Job ID:', job_id
 
-        QtGui.QMessageBox.information(None,
-            'Submitted to Qube',
-            'Submitted to Qube as Job %d' % job_id,
-        )
+        if job_id is None:
+            QtGui.QMessageBox.information(None,
+                'Nothing to Submit',
+                'Every frame of the retime is already complete.',
+            )
+        else:
+            print 'Qube Job ID:', job_id
+            QtGui.QMessageBox.information(None,
+                'Submitted to Qube',
+                'Submitted to Qube as Job %d' % job_id,
+            )
 
         self.close()
 
@@ -0,0 +1,117 @@
+"""Vectorized interpolation of regular 3D grids.
+
+Grids are arrays indexed as ``(z, y, x)``, optionally with a trailing axis of
+components. Sample positions are given in continuous index space along each
+axis, in which the samples of the grid lie on integer coordinates.
+
+Positions outside of the grid (by more than half a sample) are zero; positions
+near the edges clamp their taps to the edge samples, so that the values of the
+outermost voxels are not darkened by the void around them.
+
+"""
+
+import numpy as np
+
+
+#: The names of every sampling mode.
+modes = ('nearest', 'linear', 'cubic')
+
+
+def _prepare(grid, u, v, w):
+    u, v, w = np.broadcast_arrays(
+        np.asarray(u, dtype=np.float64),
+        np.asarray(v, dtype=np.float64),
+        np.asarray(w, dtype=np.float64),
+    )
+    zr, yr, xr = grid.shape[:3]
+    valid = (
+        (u >= -0.5) & (u <= xr - 0.5) &
+        (v >= -0.5) & (v <= yr - 0.5) &
+        (w >= -0.5) & (w <= zr - 0.5)
+    )
+    return u, v, w, valid
+
+
+def _finish(grid, values, valid):
+    if grid.ndim > 3:
+        values[~valid] = 0.0
+    else:
+        values = np.where(valid, values, 0.0)
+    return values
+
+
+def _taps(coord, size, offsets, weights_func):
+    """Yield ``(index, weight)`` for every tap along one axis."""
+    base = np.floor(coord)
+    frac = coord - base
+    base = base.astype(np.intp)
+    weights = weights_func(frac)
+    for offset, weight in zip(offsets, weights):
+        yield np.clip(base + offset, 0, size - 1), weight
+
+
+def _linear_weights(t):
+    return 1.0 - t, t
+
+
+def _cubic_weights(t):
+    # Catmull-Rom.
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        0.5 * (-t3 + 2 * t2 - t),
+        0.5 * (3 * t3 - 5 * t2 + 2),
+        0.5 * (-3 * t3 + 4 * t2 + t),
+        0.5 * (t3 - t2),
+    )
+
+
+def _sample_separable(grid, u, v, w, offsets, weights_func):
+
+    u, v, w, valid = _prepare(grid, u, v, w)
+    zr, yr, xr = grid.shape[:3]
+
+    values = np.zeros(u.shape + grid.shape[3:])
+    trailing = (Ellipsis, ) + (None, ) * (grid.ndim - 3)
+
+    x_taps = list(_taps(u, xr, offsets, weights_func))
+    y_taps = list(_taps(v, yr, offsets, weights_func))
+    for zi, zw in _taps(w, zr, offsets, weights_func):
+        for yi, yw in y_taps:
+            zyw = zw * yw
+            for xi, xw in x_taps:
+                values += (zyw * xw)[trailing] * grid[zi, yi, xi]
+
+    return _finish(grid, values, valid)
+
+
+def sample_nearest(grid, u, v, w):
+    u, v, w, valid = _prepare(grid, u, v, w)
+    zr, yr, xr = grid.shape[:3]
+    xi = np.clip(np.floor(u + 0.5).astype(np.intp), 0, xr - 1)
+    yi = np.clip(np.floor(v + 0.5).astype(np.intp), 0, yr - 1)
+    zi = np.clip(np.floor(w + 0.5).astype(np.intp), 0, zr - 1)
+    return _finish(grid, grid[zi, yi, xi].astype(np.float64), valid)
+
+
+def sample_linear(grid, u, v, w):
+    """Trilinear interpolation of a grid."""
+    return _sample_separable(grid, u, v, w, (0, 1), _linear_weights)
+
+
+def sample_cubic(grid, u, v, w):
+    """Tricubic (Catmull-Rom) interpolation of a grid."""
+    return _sample_separable(grid, u, v, w, (-1, 0, 1, 2), _cubic_weights)
+
+
+def sample(grid, u, v, w, mode='linear'):
+    """Sample a grid with the given mode; see :data:`modes`."""
+    try:
+        func = dict(
+            nearest=sample_nearest,
+            linear=sample_linear,
+            cubic=sample_cubic,
+        )[mode]
+    except KeyError:
+        raise ValueError('unknown sampling mode %r' % mode)
+    return func(grid, u, v, w)
@@ -0,0 +1,252 @@
+"""Summary statistics of fluid caches, for spotting broken sims at a glance.
+
+For every frame, shape, and channel of a cache this computes the min, max, and
+mean of the channel's values, the number of non-finite values, and, for the
+voxel-centred channels, the number of occupied voxels and the total (the sum
+of the values scaled by the voxel volume; the mass for density). Frames are
+processed in parallel, and frames which are missing from an otherwise
+regular sequence or which cannot be read are reported.
+
+The results are written as CSV (one row per frame and channel, which most
+plotting tools take directly), or as JSON with a time series per channel::
+
+    python -m mayatools.fluids.stats -f json shot/fluid/*.xml > stats.json
+
+"""
+
+import csv
+import json
+import os
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+from ..batch import run_tasks
+from .core import Cache, channel_layouts
+
+
+#: The statistics of every channel, in output order.
+stat_names = ('min', 'max', 'mean', 'nonfinite', 'occupied', 'total')
+
+#: The columns of the CSV output.
+csv_columns = ('cache', 'time', 'frame', 'shape', 'channel') + stat_names
+
+
+def channel_stats(shape, channel, threshold=0.0):
+    """Get a dict of statistics for one channel of a shape.
+
+    ``occupied`` and ``total`` are ``None`` for channels which are not
+    voxel-centred (e.g. velocity, or metadata).
+
+    """
+
+    data = np.asarray(channel.data, dtype=np.float64)
+    finite = np.isfinite(data)
+    nonfinite = int(data.size - finite.sum())
+    values = data[finite] if nonfinite else data
+
+    stats = dict(
+        min=float(values.min()) if values.size else None,
+        max=float(values.max()) if values.size else None,
+        mean=float(values.mean()) if values.size else None,
+        nonfinite=nonfinite,
+        occupied=None,
+        total=None,
+    )
+
+    if channel_layouts.get(channel.interpretation) != 'faces' and channel.data_size and data.size:
+        grid = shape.value_grid(channel, np.where(finite, data, 0.0))
+        stats['occupied'] = int((grid > threshold).any(axis=-1).sum())
+        stats['total'] = float(grid.sum() * np.prod(shape.spec.unit_size))
+
+    return stats
+
+
+def frame_stats(frame, threshold=0.0):
+    """Get statistics for every channel of a frame.
+
+    :return: List of ``(shape_name, interpretation, stats)`` tuples.
+
+    """
+    out = []
+    for shape_name, shape in sorted(frame.shapes.iteritems()):
+        for interpretation, channel in sorted(shape.channels.iteritems()):
+            if interpretation in ('resolution', 'offset'):
+                continue
+            out.append((shape_name, interpretation, channel_stats(shape, channel, threshold)))
+    return out
+
+
+def find_missing_times(times, time_per_frame=250):
+    """Find whole frame times which are missing from a sorted sequence.
+
+    Substeps in the sequence are allowed; only gaps of more than one frame
+    between neighbours are considered missing.
+
+    """
+    missing = []
+    for prev, next_ in zip(times, times[1:]):
+        if next_ - prev <= time_per_frame:
+            continue
+        time = (prev // time_per_frame + 1) * time_per_frame
+        while time < next_:
+            missing.append(time)
+            time += time_per_frame
+    return missing
+
+
+def _stats_one(xml_path, frame_path, threshold):
+    cache = Cache(xml_path)
+    frame = cache.get_frame(frame_path)
+    try:
+        return frame_stats(frame, threshold), None
+    except Exception as e:
+        return None, '%s: %s' % (e.__class__.__name__, e)
+    finally:
+        frame.free()
+
+
+def cache_stats(xml_paths, threshold=0.0, workers=None):
+    """Get statistics for every frame of the given caches.
+
+    Frames of all of the caches are processed together in a pool of
+    ``workers`` processes.
+
+    :return: A list with a dict for each cache, with keys ``cache``,
+        ``times``, ``missing_times``, ``errors`` (a dict mapping times to
+        messages), and ``frames`` (a list of ``(time, frame_stats)``).
+
+    """
+
+    results = []
+    tasks = []
+    for xml_path in xml_paths:
+        xml_path = os.path.abspath(xml_path)
+        cache = Cache(xml_path)
+        times = list(cache.frame_times)
+        results.append(dict(
+            cache=xml_path,
+            time_per_frame=cache.time_per_frame,
+            times=times,
+            missing_times=find_missing_times(times, cache.time_per_frame),
+            errors={},
+            frames=[],
+        ))
+        for frame in cache.frames:
+            tasks.append((len(results) - 1, frame.time, (xml_path, frame.path, threshold)))
+
+    outputs = run_tasks(_stats_one, [args for _, _, args in tasks], workers)
+
+    for (i, time, _), (stats, error) in zip(tasks, outputs):
+        if error is not None:
+            results[i]['errors'][time] = error
+        else:
+            results[i]['frames'].append((time, stats))
+
+    return results
+
+
+def iter_rows(results):
+    """Yield a dict for each row of CSV output."""
+    for result in results:
+        for time, stats in result['frames']:
+            for shape_name, interpretation, values in stats:
+                row = dict(
+                    cache=result['cache'],
+                    time=time,
+                    frame=float(time) / result['time_per_frame'],
+                    shape=shape_name,
+                    channel=interpretation,
+                )
+                row.update(values)
+                yield row
+
+
+def write_csv(results, fh):
+    writer = csv.DictWriter(fh, csv_columns)
+    writer.writerow(dict(zip(csv_columns, csv_columns)))
+    for row in iter_rows(results):
+        writer.writerow(row)
+
+
+def as_time_series(result):
+    """Restructure the result for one cache into a time series per statistic.
+
+    Every list in ``series`` lines up with ``times``, with ``None`` where a
+    frame could not be read.
+
+    """
+
+    times = result['times']
+    index = dict((time, i) for i, time in enumerate(times))
+    series = {}
+    for time, stats in result['frames']:
+        for shape_name, interpretation, values in stats:
+            key = '%s.%s' % (shape_name, interpretation)
+            channel_series = series.get(key)
+            if channel_series is None:
+                channel_series = series[key] = dict((name, [None] * len(times)) for name in stat_names)
+            for name in stat_names:
+                channel_series[name][index[time]] = values[name]
+
+    return dict(
+        cache=result['cache'],
+        times=times,
+        frames=[float(time) / result['time_per_frame'] for time in times],
+        missing_times=result['missing_times'],
+        errors=dict((str(time), error) for time, error in sorted(result['errors'].iteritems())),
+        series=series,
+    )
+
+
+def write_json(results, fh):
+    json.dump([as_time_series(result) for result in results], fh, indent=2, sort_keys=True)
+    fh.write('\n')
+
+
+def report_problems(results, fh):
+    """Write a line for every missing or unreadable frame; return how many."""
+    count = 0
+    for result in results:
+        for time in result['missing_times']:
+            fh.write('%s: missing frame at %s\n' % (result['cache'], time))
+            count += 1
+        for time, error in sorted(result['errors'].iteritems()):
+            fh.write('%s: could not read frame at %s; %s\n' % (result['cache'], time, error))
+            count += 1
+    return count
+
+
+def main(argv=None):
+
+    opt_parser = OptionParser(usage='%prog [options] cache.xml [...]')
+    opt_parser.add_option('-f', '--format', type='choice', choices=['csv', 'json'], default='csv')
+    opt_parser.add_option('-o', '--output', help='file to write to; defaults to stdout')
+    opt_parser.add_option('-t', '--threshold', type='float', default=0.0,
+        help='values above which a voxel is occupied')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opts, args = opt_parser.parse_args(argv)
+
+    if not args:
+        opt_parser.print_usage()
+        exit(1)
+
+    results = cache_stats(args, threshold=opts.threshold, workers=opts.workers)
+
+    fh = open(opts.output, 'wb') if opts.output else sys.stdout
+    try:
+        if opts.format == 'json':
+            write_json(results, fh)
+        else:
+            write_csv(results, fh)
+    finally:
+        if opts.output:
+            fh.close()
+
+    if report_problems(results, sys.stderr):
+        exit(2)
+
+
+if __name__ == '__main__':
+    main()
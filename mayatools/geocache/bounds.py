@@ -0,0 +1,235 @@
+"""Per-frame bounding boxes and motion of geometry cache channels.
+
+The results are stored in a small JSON index next to the cache XML (e.g.
+``fooCache.bounds.json`` for ``fooCache.xml``) so that channels which are
+off-screen or motionless may be culled without reading any point data.
+
+For every frame, and every vector channel (e.g. positions) within it, the
+index records::
+
+    [xmin, ymin, zmin, xmax, ymax, zmax, motion]
+
+where ``motion`` is the largest distance that any single point moved since the
+previous frame (or ``None`` for the first frame, or if the point count changed).
+Scalar channels (e.g. ``radiusPP``) have no position, and are not indexed.
+
+"""
+
+import json
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+from .. import mcc
+from ..batch import atomic_write, run_tasks
+
+
+INDEX_VERSION = 2
+
+
+def get_index_path(xml_path):
+    return os.path.splitext(os.path.abspath(xml_path))[0] + '.bounds.json'
+
+
+def load_index(xml_path):
+    """Load the bounds index for the given cache, or ``None`` if there is not one."""
+    path = get_index_path(xml_path)
+    try:
+        with open(path) as fh:
+            index = json.load(fh)
+    except (IOError, ValueError):
+        return
+    if index.get('version') != INDEX_VERSION:
+        return
+    return index
+
+
+def _compute_run(paths, previous_path=None):
+    """Compute index entries for a run of consecutive frames.
+
+    :param list paths: The frames to compute, in time order.
+    :param str previous_path: The frame before the first of ``paths``, if any;
+        it is only used to compute the motion of the first frame.
+
+    """
+
+    previous = {}
+    if previous_path:
+        previous = dict(mcc.read_frame(previous_path)[2])
+
+    entries = []
+    for path in paths:
+
+        start_time, end_time, channels = mcc.read_frame(path)
+
+        entry_channels = {}
+        for name, points in channels:
+
+            # Only vector arrays are points.
+            if points.ndim != 2:
+                continue
+
+            if not len(points):
+                entry_channels[name] = None
+                continue
+
+            points = points.astype(np.float64)
+            bounds = points.min(axis=0).tolist() + points.max(axis=0).tolist()
+
+            last = previous.get(name)
+            if last is not None and last.shape == points.shape:
+                motion = float(np.sqrt(((points - last) ** 2).sum(axis=1)).max())
+            else:
+                motion = None
+
+            entry_channels[name] = bounds + [motion]
+            previous[name] = points
+
+        # Don't carry forward channels which don't exist in this frame.
+        for name in set(previous).difference(entry_channels):
+            del previous[name]
+
+        entries.append(dict(
+            time=start_time,
+            channels=entry_channels,
+        ))
+
+    return entries
+
+
+def update_index(xml_path, workers=None, chunk_size=16, force=False):
+    """Bring the bounds index for a cache up to date, and return it.
+
+    Only frames which have changed (by size or mtime) since the index was last
+    written, or whose previous frame has changed, are read.
+
+    :param str xml_path: The XML file for the given cache.
+    :param int workers: Number of processes to use; ``None`` for the CPU count,
+        or ``1`` to do everything in this process.
+    :param int chunk_size: Maximum number of consecutive frames read by a
+        single task.
+    :param bool force: Recompute every frame.
+    :return: The index ``dict``.
+
+    """
+
+    xml_path = os.path.abspath(xml_path)
+    frame_paths = [path for time, path in mcc.CacheDescriptor.get(xml_path).frames]
+
+    old_index = None if force else load_index(xml_path)
+    old_entries = {}
+    for entry in (old_index or {}).get('frames', ()):
+        old_entries[entry['file']] = entry
+
+    entries = []
+    dirty = []
+    previous_file = None
+    previous_changed = False
+    for i, path in enumerate(frame_paths):
+
+        file_name = os.path.basename(path)
+        stat = os.stat(path)
+        entry = old_entries.get(file_name)
+
+        # The motion depends on the previous frame, so we must also recompute
+        # if that has changed.
+        changed = not (
+            entry and
+            entry['size'] == stat.st_size and
+            entry['mtime'] == stat.st_mtime
+        )
+        if changed or previous_changed or entry['previous'] != previous_file:
+            entry = dict(file=file_name, size=stat.st_size, mtime=stat.st_mtime, previous=previous_file)
+            dirty.append(i)
+
+        entries.append(entry)
+        previous_file = file_name
+        previous_changed = changed
+
+    # Group the dirty frames into runs of consecutive frames, so that each
+    # frame's predecessor is only read once per run.
+    runs = []
+    for i in dirty:
+        if runs and runs[-1][-1] == i - 1 and len(runs[-1]) < chunk_size:
+            runs[-1].append(i)
+        else:
+            runs.append([i])
+
+    tasks = [
+        ([frame_paths[i] for i in run], frame_paths[run[0] - 1] if run[0] else None)
+        for run in runs
+    ]
+    for run, computed in zip(runs, run_tasks(_compute_run, tasks, workers)):
+        for i, data in zip(run, computed):
+            entries[i].update(data)
+
+    index = dict(version=INDEX_VERSION, frames=entries)
+
+    if dirty or old_index is None or len(entries) != len(old_index['frames']):
+        index_path = get_index_path(xml_path)
+        with atomic_write(index_path, 'w') as fh:
+            json.dump(index, fh, separators=(',', ':'))
+
+    return index
+
+
+def get_channel_bounds(index, start_time=None, end_time=None):
+    """Get the union of bounding boxes for every channel over a time range.
+
+    :return: ``dict`` mapping channel names to ``(min, max)`` tuples of
+        3-tuples.
+
+    """
+    res = {}
+    for entry in index['frames']:
+        if start_time is not None and entry['time'] < start_time:
+            continue
+        if end_time is not None and entry['time'] > end_time:
+            continue
+        for name, data in entry['channels'].iteritems():
+            if data is None:
+                continue
+            bb_min, bb_max = data[0:3], data[3:6]
+            if name in res:
+                old_min, old_max = res[name]
+                bb_min = [min(a, b) for a, b in zip(old_min, bb_min)]
+                bb_max = [max(a, b) for a, b in zip(old_max, bb_max)]
+            res[name] = (tuple(bb_min), tuple(bb_max))
+    return res
+
+
+def get_static_channels(index, tolerance=0.0):
+    """Get the names of channels which never move more than the tolerance."""
+    moving = set()
+    names = set()
+    for entry in index['frames']:
+        for name, data in entry['channels'].iteritems():
+            names.add(name)
+            if data is not None and data[6] is not None and data[6] > tolerance:
+                moving.add(name)
+    return sorted(names.difference(moving))
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] cache.xml [...]')
+    opt_parser.add_option('-w', '--workers', type='int')
+    opt_parser.add_option('-f', '--force', action='store_true')
+    opt_parser.add_option('-t', '--tolerance', type='float', default=0.0)
+    opts, args = opt_parser.parse_args()
+
+    if not args:
+        opt_parser.print_usage()
+        exit(1)
+
+    for xml_path in args:
+        index = update_index(xml_path, workers=opts.workers, force=opts.force)
+        static = set(get_static_channels(index, opts.tolerance))
+        print xml_path
+        for name, (bb_min, bb_max) in sorted(get_channel_bounds(index).iteritems()):
+            print '\t%s%s: %s to %s' % (name, ' (static)' if name in static else '', bb_min, bb_max)
+
+
+if __name__ == '__main__':
+    main()
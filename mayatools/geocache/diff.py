@@ -0,0 +1,229 @@
+"""Compare two versions of a geometry cache without Maya.
+
+Frames are matched by time and channels by name. For every pair the maximum
+and mean point displacement is computed, and point count mismatches or frames
+missing from either side are reported.
+
+"""
+
+import json
+import os
+from optparse import OptionParser
+
+import concurrent.futures
+import numpy as np
+
+from .. import mcc
+
+
+_heatmap_chars = ' .:-=+*#%@'
+
+
+def _diff_frame(path_a, path_b):
+    """Compare a pair of frames.
+
+    :return: ``dict`` mapping channel names to ``(count_a, count_b, max, mean)``;
+        counts are ``None`` for channels missing from that side, and the
+        displacements are ``None`` if the counts differ.
+
+    """
+
+    channels_a = dict(mcc.read_frame(path_a)[2])
+    channels_b = dict(mcc.read_frame(path_b)[2])
+
+    res = {}
+    for name in set(channels_a).union(channels_b):
+        a = channels_a.get(name)
+        b = channels_b.get(name)
+        count_a = None if a is None else len(a)
+        count_b = None if b is None else len(b)
+        if count_a is None or count_a != count_b:
+            res[name] = (count_a, count_b, None, None)
+            continue
+        if not count_a:
+            res[name] = (0, 0, 0.0, 0.0)
+            continue
+        delta = a.astype(np.float64) - b.astype(np.float64)
+        distance = np.sqrt((delta.reshape(count_a, -1) ** 2).sum(axis=1))
+        res[name] = (count_a, count_b, float(distance.max()), float(distance.mean()))
+    return res
+
+
+class Report(object):
+
+    """The result of :func:`diff_caches`.
+
+    :ivar list times: The times of the frames which exist in both caches.
+    :ivar list missing_a: Times of frames which only exist in the second cache.
+    :ivar list missing_b: Times of frames which only exist in the first cache.
+    :ivar dict frames: Maps times to the results of comparing that frame, which
+        are ``dict`` mapping channel names to ``(count_a, count_b, max, mean)``.
+
+    """
+
+    def __init__(self, path_a, path_b, times, missing_a, missing_b, frames):
+        self.path_a = path_a
+        self.path_b = path_b
+        self.times = times
+        self.missing_a = missing_a
+        self.missing_b = missing_b
+        self.frames = frames
+
+    @property
+    def channels(self):
+        names = set()
+        for frame in self.frames.itervalues():
+            names.update(frame)
+        return sorted(names)
+
+    def channel_summary(self, name):
+        """Get ``(max, mean, mismatched_times)`` for a channel across all frames."""
+        max_ = 0.0
+        means = []
+        mismatched = []
+        for time in self.times:
+            count_a, count_b, frame_max, frame_mean = self.frames[time].get(name, (None, None, None, None))
+            if frame_max is None:
+                mismatched.append(time)
+                continue
+            max_ = max(max_, frame_max)
+            means.append(frame_mean)
+        return max_, (sum(means) / len(means) if means else 0.0), mismatched
+
+    def differs(self, tolerance=0.0):
+        """Are the caches meaningfully different?"""
+        if self.missing_a or self.missing_b:
+            return True
+        for name in self.channels:
+            max_, mean, mismatched = self.channel_summary(name)
+            if mismatched or max_ > tolerance:
+                return True
+        return False
+
+    def iter_summary_lines(self, time_per_frame=250):
+
+        def format_times(times):
+            return ', '.join('%g' % (float(t) / time_per_frame) for t in times)
+
+        yield '%s vs %s' % (self.path_a, self.path_b)
+        yield '\t%d common frames' % len(self.times)
+        if self.missing_a:
+            yield '\tmissing from first: %s' % format_times(self.missing_a)
+        if self.missing_b:
+            yield '\tmissing from second: %s' % format_times(self.missing_b)
+        for name in self.channels:
+            max_, mean, mismatched = self.channel_summary(name)
+            yield '\t%s: max %g, mean %g' % (name, max_, mean)
+            if mismatched:
+                yield '\t\tpoint count or channel mismatch at: %s' % format_times(mismatched)
+
+    def iter_heatmap_lines(self, width=80, time_per_frame=250):
+        """Iterate lines of a per-channel, per-frame displacement heatmap.
+
+        Each column covers one or more frames, and shows the largest maximum
+        displacement within them relative to the largest in the report.
+        ``X`` marks a mismatch, and a space marks no change at all.
+
+        """
+
+        names = self.channels
+        if not names or not self.times:
+            return
+
+        columns = min(width, len(self.times))
+        bins = [self.times[i * len(self.times) // columns:(i + 1) * len(self.times) // columns] for i in xrange(columns)]
+
+        scale = max(self.channel_summary(name)[0] for name in names) or 1.0
+        name_width = max(len(name) for name in names)
+
+        yield '%s  %g to %g' % (' ' * name_width, float(self.times[0]) / time_per_frame, float(self.times[-1]) / time_per_frame)
+        for name in names:
+            row = []
+            for times in bins:
+                values = [self.frames[t].get(name, (None, None, None, None))[2] for t in times]
+                if any(v is None for v in values):
+                    row.append('X')
+                    continue
+                value = max(values)
+                if not value:
+                    row.append(' ')
+                else:
+                    i = int(np.ceil(value / scale * (len(_heatmap_chars) - 1)))
+                    row.append(_heatmap_chars[min(i, len(_heatmap_chars) - 1)])
+            yield '%s |%s|' % (name.rjust(name_width), ''.join(row))
+
+    def to_json(self):
+        return dict(
+            path_a=self.path_a,
+            path_b=self.path_b,
+            missing_a=self.missing_a,
+            missing_b=self.missing_b,
+            frames=[dict(time=time, channels=self.frames[time]) for time in self.times],
+        )
+
+
+def diff_caches(path_a, path_b, workers=8):
+    """Compare two caches frame by frame and channel by channel.
+
+    Pairs of frames are read and compared in a pool of threads, and are not
+    retained afterwards.
+
+    :param str path_a: XML of the first cache.
+    :param str path_b: XML of the second cache.
+    :param int workers: Number of threads reading frames.
+    :return: A :class:`Report`.
+
+    """
+
+    frames_a = dict(mcc.CacheDescriptor.get(path_a).frames)
+    frames_b = dict(mcc.CacheDescriptor.get(path_b).frames)
+    times = sorted(set(frames_a).intersection(frames_b))
+
+    frames = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict(
+            (executor.submit(_diff_frame, frames_a[time], frames_b[time]), time)
+            for time in times
+        )
+        for future in concurrent.futures.as_completed(futures):
+            frames[futures[future]] = future.result()
+
+    return Report(
+        os.path.abspath(path_a),
+        os.path.abspath(path_b),
+        times,
+        sorted(set(frames_b).difference(frames_a)),
+        sorted(set(frames_a).difference(frames_b)),
+        frames,
+    )
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog [options] first.xml second.xml')
+    opt_parser.add_option('-w', '--workers', type='int', default=8)
+    opt_parser.add_option('-t', '--tolerance', type='float', default=0.0)
+    opt_parser.add_option('--width', type='int', default=80)
+    opt_parser.add_option('-j', '--json', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if len(args) != 2:
+        opt_parser.print_usage()
+        exit(1)
+
+    report = diff_caches(*args, workers=opts.workers)
+
+    if opts.json:
+        print json.dumps(report.to_json(), indent=4, sort_keys=True)
+    else:
+        for line in report.iter_summary_lines():
+            print line
+        print
+        for line in report.iter_heatmap_lines(opts.width):
+            print line
+
+    exit(1 if report.differs(opts.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
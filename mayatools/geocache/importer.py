@@ -14,6 +14,7 @@ import sgfs.ui.scene_name.widget as scene_name
 import sgpublish.check.maya
 
 from . import utils
+from .. import mcc
 
 
 sgfs = SGFS()
@@ -593,7 +594,9 @@ class Geocache(QtGui.QGroupBox):
         cache_path = self.cachePath()
         if not cache_path:
             return []
-        else:
+        try:
+            return mcc.CacheDescriptor.get(cache_path).channel_names
+        except (EnvironmentError, mcc.ParseError):
             return cmds.cacheFile(q=True, fileName=cache_path, channelName=True) or []
     
     def iterMapping(self):
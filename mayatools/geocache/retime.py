@@ -0,0 +1,223 @@
+"""Retime MCC point caches without returning to Maya.
+
+This is the point cache equivalent of :mod:`mayatools.fluids.retime`; it uses
+the same mapping of output ticks to source ticks, but linearly (or with cubic
+Hermite splines) interpolates the point positions of every channel.
+
+"""
+
+import os
+from optparse import OptionParser
+
+import numpy as np
+
+from .. import mcc
+from ..batch import check_xml_dst, run_tasks
+from ..fluids.retime import FrameMapper, iter_ticks
+
+
+def main():
+
+    option_parser = OptionParser(usage='%prog [options] input.xml, output.xml')
+    option_parser.add_option('-s', '--start', type='float')
+    option_parser.add_option('-e', '--end', type='float')
+    option_parser.add_option('--src-start', '--os', type='float')
+    option_parser.add_option('--src-end', '--oe', type='float')
+    option_parser.add_option('-r', '--rate', type='float', default=1.0)
+    option_parser.add_option('-i', '--interpolation', type='choice', choices=['linear', 'hermite'], default='linear')
+    option_parser.add_option('-w', '--workers', type='int')
+    option_parser.add_option('-c', '--chunk-size', type='int', default=32)
+    option_parser.add_option('-v', '--verbose', action='count', default=0)
+    opts, args = option_parser.parse_args()
+
+    if len(args) != 2:
+        option_parser.print_usage()
+        exit(1)
+
+    schedule_retime(*args,
+        src_start=opts.src_start,
+        src_end=opts.src_end,
+        dst_start=opts.start,
+        dst_end=opts.end,
+        sampling_rate=opts.rate,
+        interpolation=opts.interpolation,
+        workers=opts.workers,
+        chunk_size=opts.chunk_size,
+        verbose=opts.verbose
+    )
+
+
+def schedule_retime(
+    src_path, dst_path,
+    src_start=None, src_end=None,
+    dst_start=None, dst_end=None,
+    sampling_rate=1.0,
+    interpolation='linear',
+    workers=None,
+    chunk_size=32,
+    verbose=0,
+):
+    """Retime a point cache, writing a new cache at ``dst_path``.
+
+    Times are given in frames, and default to the extent of the source cache.
+    The ticks to output are split into runs of ``chunk_size`` consecutive
+    ticks, each of which is processed by one of ``workers`` processes.
+
+    :return: List of the frame paths that were written.
+
+    """
+
+    dst_path, dst_base_path = check_xml_dst(dst_path)
+    src_path = os.path.abspath(src_path)
+
+    src_cache = mcc.CacheDescriptor.get(src_path)
+    time_per_frame = src_cache.time_per_frame
+
+    frames = src_cache.frames
+    if not frames:
+        raise ValueError('No frames in %r' % src_path)
+    frame_times = [time for time, path in frames]
+    frame_paths = [path for time, path in frames]
+
+    # Convert all time options into an integer of ticks.
+    if dst_start is None:
+        dst_start = frame_times[0]
+    else:
+        dst_start = int(dst_start * time_per_frame)
+    if dst_end is None:
+        dst_end = frame_times[-1]
+    else:
+        dst_end = int(dst_end * time_per_frame)
+
+    if src_start is None:
+        src_start = dst_start
+    else:
+        src_start = int(src_start * time_per_frame)
+    if src_end is None:
+        src_end = dst_end
+    else:
+        src_end = int(src_end * time_per_frame)
+
+    # This one remains a float.
+    sampling_rate = sampling_rate * time_per_frame
+
+    # Resolve every tick up front so that bad time ranges fail before any
+    # work is done.
+    mapper = FrameMapper(frames, time_per_frame)
+    ticks = []
+    for src_time, dst_time in iter_ticks(src_start, src_end, dst_start, dst_end, sampling_rate):
+        a, b = mapper.find_indices(src_time)
+        ticks.append((src_time, int(round(dst_time)), a, b))
+
+    # Write the new XML.
+    dst_tree = src_cache.copy_etree()
+    mcc.set_time_range(dst_tree, dst_start, dst_end)
+    dst_tree.write(dst_path)
+
+    chunks = [ticks[i:i + chunk_size] for i in xrange(0, len(ticks), chunk_size)]
+    args = (frame_times, frame_paths, dst_base_path, time_per_frame, interpolation, verbose)
+
+    written = []
+    for paths in run_tasks(retime_chunk, [(chunk, ) + args for chunk in chunks], workers):
+        written.extend(paths)
+
+    return written
+
+
+def _hermite(p0, p1, p2, p3, t0, t1, t2, t3, s):
+    """Cubic Hermite interpolation between ``p1`` and ``p2``.
+
+    Tangents are finite differences across the neighbouring frames, scaled to
+    the interval between ``p1`` and ``p2``.
+
+    """
+    dt = float(t2 - t1)
+    m1 = (p2 - p0) * (dt / (t2 - t0))
+    m2 = (p3 - p1) * (dt / (t3 - t1))
+    s2 = s * s
+    s3 = s2 * s
+    return (
+        (2 * s3 - 3 * s2 + 1) * p1 +
+        (s3 - 2 * s2 + s) * m1 +
+        (-2 * s3 + 3 * s2) * p2 +
+        (s3 - s2) * m2
+    )
+
+
+def retime_chunk(ticks, frame_times, frame_paths, dst_base_path, time_per_frame, interpolation='linear', verbose=0):
+    """Interpolate and write a run of output ticks.
+
+    Only a sliding window of the source frames needed by the remaining ticks
+    is held in memory.
+
+    :param ticks: List of ``(src_time, dst_time, index_a, index_b)`` tuples,
+        where the indices are into ``frame_times`` and ``frame_paths``.
+    :return: List of the frame paths that were written.
+
+    """
+
+    window = {}
+    written = []
+    last = len(frame_paths) - 1
+
+    for src_time, dst_time, a, b in ticks:
+
+        if interpolation == 'hermite':
+            needed = [max(0, a - 1), a, b, min(last, b + 1)]
+        else:
+            needed = [a, b]
+
+        for i in list(window):
+            if i < needed[0]:
+                del window[i]
+        for i in needed:
+            if i not in window:
+                if verbose:
+                    print 'Loading', frame_paths[i]
+                window[i] = mcc.read_frame(frame_paths[i])[2]
+
+        if a == b:
+            s = 0.0
+        else:
+            s = float(src_time - frame_times[a]) / float(frame_times[b] - frame_times[a])
+
+        channels_b = dict(window[b])
+        channels = []
+        for name, data_a in window[a]:
+
+            data_b = channels_b.get(name)
+            if data_b is None or data_b.shape != data_a.shape:
+                # We can't interpolate, so take the nearest.
+                data = data_a if s < 0.5 or data_b is None else data_b
+
+            elif interpolation == 'hermite' and a != b:
+                i0, i1, i2, i3 = needed
+                data_0 = dict(window[i0]).get(name, data_a)
+                data_3 = dict(window[i3]).get(name, data_b)
+                if data_0.shape != data_a.shape:
+                    i0, data_0 = a, data_a
+                if data_3.shape != data_b.shape:
+                    i3, data_3 = b, data_b
+                data = _hermite(
+                    data_0.astype(np.float64), data_a.astype(np.float64),
+                    data_b.astype(np.float64), data_3.astype(np.float64),
+                    frame_times[i0], frame_times[i1], frame_times[i2], frame_times[i3],
+                    s
+                )
+
+            else:
+                data = data_a.astype(np.float64) * (1.0 - s) + data_b.astype(np.float64) * s
+
+            channels.append((name, np.asarray(data).astype(data_a.dtype)))
+
+        dst_path = mcc.get_frame_name(dst_base_path, dst_time, time_per_frame)
+        if verbose:
+            print 'Saving to', dst_path
+        mcc.write_frame(dst_path, dst_time, dst_time, channels)
+        written.append(dst_path)
+
+    return written
+
+
+if __name__ == '__main__':
+    main()
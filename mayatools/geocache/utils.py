@@ -9,11 +9,15 @@ from mayatools import mcc
 def get_cache_channels(cache_path):
     if cache_path is None:
         return []
+    cache = mcc.CacheDescriptor.get(cache_path)
     try:
-        return mcc.get_channels(cache_path)
-    except mcc.ParseError as e:
+        return cache.point_counts
+    except (EnvironmentError, mcc.ParseError) as e:
         cmds.warning('Could not parse MCC for channel data; %r' % e)
-        channels = cmds.cacheFile(q=True, fileName=cache_path, channelName=True)
+        try:
+            channels = cache.channel_names
+        except (EnvironmentError, mcc.ParseError):
+            channels = cmds.cacheFile(q=True, fileName=cache_path, channelName=True) or []
         return [(c, None) for c in channels]
 
 
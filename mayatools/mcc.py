@@ -1,17 +1,46 @@
+import copy
+import glob
 import os
+import re
 import struct
-import glob
+import time
+import xml.etree.cElementTree as etree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import binary
+
 
 class ParseError(RuntimeError):
     pass
 
 
+#: Map cache data tags to the NumPy dtype and number of components of each
+#: element stored within them.
+array_types = {
+    'FBCA': ('>f4', 1), # float array
+    'DBLA': ('>f8', 1), # double array
+    'FVCA': ('>f4', 3), # float vector array
+    'DVCA': ('>f8', 3), # double vector array
+}
+
+# Frames before zero are named as by get_frame_name, e.g. "Frame-2Tick125"
+# is at -375 ticks.
+_frame_name_re = re.compile(r'Frame(-?\d+)(?:Tick(\d+))?\.mc$')
+
+
 _get_channels_results = {}
 
 
 def get_channels(xml_path, memoize=True):
     """Get a list of channel names and their point counts from a Maya MCC cache.
     
+    The frames are found via the XML if possible, but if it is missing or
+    can't be parsed then any ``<name>Frame*.mc`` beside it are used instead.
+
     :param str xml_path: The XML file for the given cache.
     :param bool memoize: Use memoization to avoid parsing?
     :return: List of ``(name, size)`` tuples for each channel.
@@ -19,7 +48,11 @@ def get_channels(xml_path, memoize=True):
     
     """
     
-    mcc_paths = glob.glob(os.path.join(os.path.dirname(xml_path), os.path.splitext(os.path.basename(xml_path))[0] + 'Frame*.mc'))
+    try:
+        mcc_paths = [path for time, path in CacheDescriptor.get(xml_path).frames]
+    except (EnvironmentError, ParseError):
+        # The XML is missing or broken, so look for frames directly.
+        mcc_paths = glob.glob(os.path.join(os.path.dirname(xml_path), os.path.splitext(os.path.basename(xml_path))[0] + 'Frame*.mc'))
     if not mcc_paths:
         raise ParseError('Could not find any *.mc for %r' % xml_path)
     mcc_path = mcc_paths[0]
@@ -98,3 +131,268 @@ def get_channels(xml_path, memoize=True):
     
     return channels
 
+
+class CacheDescriptor(object):
+
+    """Lazy, memoized access to the metadata of a OneFilePerFrame MCC cache.
+
+    Use :meth:`get` to share descriptors (and their parsed XML and frame
+    listings) across tools; everything is reloaded automatically when the XML
+    or the cache directory is modified.
+
+    Malformed XML raises :class:`ParseError` when it is first needed, and a
+    missing file raises an ``EnvironmentError``.
+
+    :param str xml_path: The XML file for the given cache.
+
+    """
+
+    _instances = {}
+
+    # Stats within this many seconds of their file's mtime may be followed by
+    # further modifications within the filesystem's timestamp resolution, so
+    # we don't trust them.
+    _racy_window = 2.0
+
+    @classmethod
+    def get(cls, xml_path):
+        """Get the shared descriptor for the given cache."""
+        xml_path = os.path.abspath(xml_path)
+        try:
+            return cls._instances[xml_path]
+        except KeyError:
+            return cls._instances.setdefault(xml_path, cls(xml_path))
+
+    def __init__(self, xml_path):
+
+        self.xml_path = os.path.abspath(xml_path)
+        self.directory = os.path.dirname(self.xml_path)
+        self.base_name = os.path.splitext(os.path.basename(self.xml_path))[0]
+
+        self._xml_key = None
+        self._etree = None
+        self._xml_cache = {}
+
+        self._frames_key = None
+        self._frames = None
+
+    def _stat_key(self, path, old_key):
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime, time.time())
+        if old_key and old_key[:2] == key[:2] and old_key[2] - old_key[1] > self._racy_window:
+            return old_key
+        return key
+
+    def _check_xml(self):
+        key = self._stat_key(self.xml_path, self._xml_key)
+        if key is not self._xml_key:
+            self._xml_key = key
+            self._etree = None
+            self._xml_cache = {}
+
+    @property
+    def etree(self):
+        """The parsed XML; it must not be modified (see :meth:`copy_etree`)."""
+        self._check_xml()
+        if self._etree is None:
+            try:
+                self._etree = etree.parse(self.xml_path)
+            except SyntaxError as e:
+                raise ParseError('could not parse %r; %s' % (self.xml_path, e))
+        return self._etree
+
+    def copy_etree(self):
+        """Get a copy of the parsed XML which is safe to modify."""
+        return copy.deepcopy(self.etree)
+
+    def _memoized_xml(self, name, func):
+        tree = self.etree
+        try:
+            return self._xml_cache[name]
+        except KeyError:
+            pass
+        try:
+            value = func(tree)
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ParseError('bad %s in %r; %s' % (name, self.xml_path, e))
+        return self._xml_cache.setdefault(name, value)
+
+    @property
+    def time_per_frame(self):
+        return self._memoized_xml('time_per_frame', lambda tree: int(tree.find('cacheTimePerFrame').get('TimePerFrame')))
+
+    @property
+    def cache_type(self):
+        return self._memoized_xml('cache_type', lambda tree: tree.find('cacheType').get('Type'))
+
+    @property
+    def cache_format(self):
+        return self._memoized_xml('cache_format', lambda tree: tree.find('cacheType').get('Format'))
+
+    @property
+    def time_range(self):
+        """The ``(start, end)`` times from the XML, in ticks."""
+        def parse(tree):
+            start, end = tree.find('time').get('Range').split('-')
+            return int(start), int(end)
+        return self._memoized_xml('time_range', parse)
+
+    @property
+    def channels(self):
+        """List of ``(name, type, interpretation)`` tuples from the XML."""
+        return self._memoized_xml('channels', lambda tree: [
+            (c.get('ChannelName'), c.get('ChannelType'), c.get('ChannelInterpretation'))
+            for c in tree.find('Channels')
+        ])
+
+    @property
+    def channel_names(self):
+        return [name for name, type_, interpretation in self.channels]
+
+    @property
+    def extra(self):
+        """List of the raw strings of every ``extra`` element in the XML."""
+        return self._memoized_xml('extra', lambda tree: [e.text for e in tree.findall('extra')])
+
+    @property
+    def point_counts(self):
+        """List of ``(name, size)`` tuples; see :func:`get_channels`."""
+        return get_channels(self.xml_path)
+
+    @property
+    def frames(self):
+        """List of ``(time, path)`` tuples for every frame, sorted by time.
+
+        Times are derived from the frame file names (and the ``TimePerFrame``
+        of the XML), so none of the frames are opened. They may be negative.
+
+        """
+
+        time_per_frame = self.time_per_frame
+
+        key = self._stat_key(self.directory, self._frames_key)
+        if key is self._frames_key and self._frames[0] == time_per_frame:
+            return list(self._frames[1])
+
+        frames = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.startswith(self.base_name):
+                continue
+            m = _frame_name_re.match(file_name[len(self.base_name):])
+            if not m:
+                continue
+            frame, tick = m.groups()
+            frames.append((int(frame) * time_per_frame + int(tick or 0), os.path.join(self.directory, file_name)))
+        frames.sort()
+
+        self._frames_key = key
+        self._frames = (time_per_frame, frames)
+        return list(frames)
+
+    @property
+    def frame_range(self):
+        """The ``(start, end)`` times of the first and last frames on disk."""
+        frames = self.frames
+        if not frames:
+            return None
+        return frames[0][0], frames[-1][0]
+
+
+def set_time_range(tree, min_time, max_time, irregular=True):
+    """Set the time range of a cache's XML (as an ``ElementTree``) in place.
+
+    By default the channels are marked as irregularly sampled, since Maya will
+    otherwise assume the frames are spaced at the original sampling rate.
+
+    """
+    tree.find('time').set('Range', '%d-%d' % (min_time, max_time))
+    for channel in tree.find('Channels'):
+        if irregular:
+            channel.set('SamplingType', 'Irregular')
+        channel.set('StartTime', str(min_time))
+        channel.set('EndTime', str(max_time))
+
+
+def get_frame_name(base_name, time, time_per_frame=250):
+    """Get the file name for the frame of a cache at the given time."""
+    frame, tick = divmod(time, time_per_frame)
+    if tick:
+        return '%sFrame%dTick%d.mc' % (base_name, frame, tick)
+    else:
+        return '%sFrame%d.mc' % (base_name, frame)
+
+
+def read_frame(mcc_path):
+    """Read the headers and every channel from a single ``.mc`` frame.
+
+    :param str mcc_path: The frame to read.
+    :return: ``(start_time, end_time, channels)``, where ``channels`` is a list
+        of ``(name, array)`` tuples. Vector channels are ``(N, 3)`` arrays.
+    :raises ParseError:
+
+    """
+
+    if np is None:
+        raise RuntimeError('numpy is required to read cache data')
+
+    with open(mcc_path, 'rb') as fh:
+        parser = binary.Parser(fh)
+        parser.parse_all()
+
+    try:
+        start_time = parser.find_one('STIM').signed_ints[0]
+        end_time = parser.find_one('ETIM').signed_ints[0]
+        channel_group = parser.find_one('MYCH')
+    except KeyError as e:
+        raise ParseError('missing %s in %r' % (e.args[0], mcc_path))
+
+    channels = []
+    name = None
+    for chunk in channel_group.children:
+        if chunk.tag == 'CHNM':
+            name = chunk.string
+        elif chunk.tag in array_types:
+            dtype, components = array_types[chunk.tag]
+            data = np.frombuffer(chunk.data, dtype=dtype)
+            if components > 1:
+                data = data.reshape(-1, components)
+            channels.append((name, data))
+
+    return start_time, end_time, channels
+
+
+def dumps_frame_iter(start_time, end_time, channels):
+    """Iterate chunks of a packed ``.mc`` frame.
+
+    :param int start_time: Value for the ``STIM`` header.
+    :param int end_time: Value for the ``ETIM`` header.
+    :param channels: Iterable of ``(name, array)`` tuples. ``(N, 3)`` arrays
+        are stored as vector arrays, and ``float64`` arrays as doubles.
+
+    """
+
+    root = binary.Node()
+
+    header = root.add_group('CACH')
+    header.add_chunk('VRSN').string = '0.1'
+    header.add_chunk('STIM').signed_ints = [start_time]
+    header.add_chunk('ETIM').signed_ints = [end_time]
+
+    group = root.add_group('MYCH')
+    for name, data in channels:
+        data = np.asarray(data)
+        vector = data.ndim > 1
+        double = data.dtype.itemsize == 8
+        tag = ('DVCA' if double else 'FVCA') if vector else ('DBLA' if double else 'FBCA')
+        group.add_chunk('CHNM').string = name
+        group.add_chunk('SIZE').ints = [len(data)]
+        group.add_chunk(tag).data = data.astype(array_types[tag][0]).tostring()
+
+    return root.dumps_iter()
+
+
+def write_frame(mcc_path, start_time, end_time, channels):
+    """Write a single ``.mc`` frame; see :func:`dumps_frame_iter`."""
+    with open(mcc_path, 'wb') as fh:
+        for chunk in dumps_frame_iter(start_time, end_time, channels):
+            fh.write(chunk)
@@ -0,0 +1,194 @@
+"""Splice frame ranges from several MCC caches into one, without re-exporting.
+
+This works on any OneFilePerFrame cache (geometry or fluid) as long as every
+source has the same channels. Frames which stay at the same time are hard
+linked into the destination; frames which move only have their ``STIM`` and
+``ETIM`` headers rewritten.
+
+For example, to replace the last 20 frames of a 1000 frame cache::
+
+    splice_caches('fixed/cache.xml', [
+        ('v001/cache.xml', None, None),
+        ('v002/cache.xml', 981, 1000),
+    ])
+
+"""
+
+import errno
+import os
+import re
+import shutil
+from optparse import OptionParser
+
+from . import binary
+from . import mcc
+from .batch import atomic_write
+
+
+def _find_header_offsets(path):
+    """Get the file offsets and (signed) values of ``STIM`` and ``ETIM`` in a frame."""
+    offsets = {}
+    with open(path, 'rb') as fh:
+        parser = binary.Parser(fh)
+        while len(offsets) < 2:
+            chunk = parser.parse_next()
+            if chunk is None:
+                raise mcc.ParseError('could not find STIM/ETIM in %r' % path)
+            if chunk.tag in ('STIM', 'ETIM'):
+                offsets[chunk.tag] = (chunk.offset, chunk.signed_ints[0])
+    return offsets
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+
+def _copy_with_time(src, dst, start_time):
+    offsets = _find_header_offsets(src)
+    with open(src, 'rb') as fh:
+        data = bytearray(fh.read())
+    stim_offset, old_start = offsets['STIM']
+    etim_offset, old_end = offsets['ETIM']
+    for offset, time in ((stim_offset, start_time), (etim_offset, start_time + old_end - old_start)):
+        header = binary.Chunk('STIM')
+        header.signed_ints = [time]
+        data[offset:offset + len(header.data)] = header.data
+    with open(dst, 'wb') as fh:
+        fh.write(data)
+
+
+def splice_caches(dst_path, segments, verbose=False):
+    """Splice ranges of frames from several caches into a new cache.
+
+    :param str dst_path: The XML path of the new cache. It may be one of the
+        sources.
+    :param segments: List of ``(xml_path, start, end)`` or
+        ``(xml_path, start, end, dst_start)`` tuples. Times are in frames; a
+        ``None`` start or end is the extent of that cache, and ``dst_start``
+        defaults to ``start``. Later segments replace earlier ones wherever
+        they overlap.
+    :return: List of ``(time, path, moved)`` tuples for every frame.
+
+    """
+
+    dst_path = os.path.abspath(dst_path)
+    dst_directory = os.path.dirname(dst_path)
+    dst_base_path = os.path.splitext(dst_path)[0]
+
+    first = None
+
+    # Map output times to the source frame.
+    plan = {}
+    for segment in segments:
+
+        src_path, start, end = segment[:3]
+        dst_start = segment[3] if len(segment) > 3 else None
+
+        src_cache = mcc.CacheDescriptor.get(src_path)
+        if first is None:
+            first = src_cache
+            time_per_frame = first.time_per_frame
+        elif src_cache.channels != first.channels:
+            raise ValueError('channels of %r do not match %r' % (src_cache.xml_path, first.xml_path))
+        elif src_cache.time_per_frame != time_per_frame:
+            raise ValueError('TimePerFrame of %r does not match %r' % (src_cache.xml_path, first.xml_path))
+
+        frames = src_cache.frames
+        if not frames:
+            raise ValueError('No frames in %r' % src_path)
+
+        start = frames[0][0] if start is None else int(round(start * time_per_frame))
+        end = frames[-1][0] if end is None else int(round(end * time_per_frame))
+        offset = 0 if dst_start is None else int(round(dst_start * time_per_frame)) - start
+
+        for time, path in frames:
+            if start <= time <= end:
+                plan[time + offset] = (path, time)
+
+    if not plan:
+        raise ValueError('No frames selected')
+
+    if not os.path.exists(dst_directory):
+        os.makedirs(dst_directory)
+
+    # Stage every frame under a temporary name before replacing anything, so
+    # that a cache may be spliced into itself.
+    staged = []
+    try:
+        for dst_time, (src_path, src_time) in sorted(plan.iteritems()):
+            path = mcc.get_frame_name(dst_base_path, dst_time, time_per_frame)
+            tmp_path = path + '.splicing'
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            moved = dst_time != src_time
+            if moved:
+                _copy_with_time(src_path, tmp_path, dst_time)
+            elif os.path.abspath(src_path) != path:
+                _link_or_copy(src_path, tmp_path)
+            else:
+                tmp_path = None
+            staged.append((dst_time, path, tmp_path, moved))
+    except:
+        for dst_time, path, tmp_path, moved in staged:
+            if tmp_path:
+                os.unlink(tmp_path)
+        raise
+
+    # Remove any existing frames which are not part of the new cache.
+    keep = set(path for dst_time, path, tmp_path, moved in staged)
+    if os.path.exists(dst_path):
+        for time, path in mcc.CacheDescriptor.get(dst_path).frames:
+            if path not in keep:
+                os.unlink(path)
+
+    res = []
+    for dst_time, path, tmp_path, moved in staged:
+        if tmp_path:
+            os.rename(tmp_path, path)
+        if verbose:
+            print '%s %s' % ('Moved' if moved else 'Linked', path)
+        res.append((dst_time, path, moved))
+
+    dst_tree = first.copy_etree()
+    mcc.set_time_range(dst_tree, min(plan), max(plan), irregular=False)
+    with atomic_write(dst_path, suffix='.splicing') as fh:
+        dst_tree.write(fh)
+
+    return res
+
+
+def parse_segment(spec):
+    """Parse a ``path.xml[:start-end[@dst_start]]`` segment specification."""
+    m = re.match(r'^(.+?\.xml)(?::([-\d.]*?)-([-\d.]*?)(?:@([-\d.]+))?)?$', spec)
+    if not m:
+        raise ValueError('bad segment %r' % spec)
+    path, start, end, dst_start = m.groups()
+    return (
+        path,
+        float(start) if start else None,
+        float(end) if end else None,
+        float(dst_start) if dst_start else None,
+    )
+
+
+def main():
+
+    opt_parser = OptionParser(usage='%prog -o output.xml input.xml[:start-end[@dst_start]] [...]')
+    opt_parser.add_option('-o', '--output')
+    opt_parser.add_option('-v', '--verbose', action='store_true')
+    opts, args = opt_parser.parse_args()
+
+    if not opts.output or not args:
+        opt_parser.print_usage()
+        exit(1)
+
+    splice_caches(opts.output, [parse_segment(arg) for arg in args], verbose=opts.verbose)
+
+
+if __name__ == '__main__':
+    main()
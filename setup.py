@@ -9,6 +9,11 @@ setup(
     packages=find_packages(exclude=['build*', 'tests*']),
     include_package_data=True,
     
+    install_requires=[
+        'numpy',
+        'futures', # concurrent.futures
+    ],
+    
     author='Mike Boers',
     author_email='mayatools@mikeboers.com',
     license='BSD-3',
@@ -0,0 +1,113 @@
+"""Test cases and cache factories shared by the cache tests."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from mayatools import mcc
+from mayatools.fluids.core import channel_layouts
+
+
+_xml_template = '''<?xml version="1.0"?>
+<Autodesk_Cache_File>
+  <cacheType Type="OneFilePerFrame" Format="mcc"/>
+  <time Range="%(start)d-%(end)d"/>
+  <cacheTimePerFrame TimePerFrame="250"/>
+  <cacheVersion Version="2.0"/>
+%(extra)s
+  <Channels>
+%(channels)s
+  </Channels>
+</Autodesk_Cache_File>
+'''
+
+_channel_template = '    <channel%d ChannelName="%s" ChannelType="%s" ChannelInterpretation="%s" SamplingType="Regular" SamplingRate="250" StartTime="%d" EndTime="%d"/>'
+
+
+class TempDirTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+def write_xml(xml_path, start, end, channels, extra=()):
+    """Write a cache's XML; ``channels`` is a list of ``(name, type, interpretation)``."""
+
+    directory = os.path.dirname(xml_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    with open(xml_path, 'w') as fh:
+        fh.write(_xml_template % dict(
+            start=start,
+            end=end,
+            extra='\n'.join('  <extra>%s</extra>' % e for e in extra),
+            channels='\n'.join(
+                _channel_template % ((i, ) + tuple(channel) + (start, end))
+                for i, channel in enumerate(channels)
+            ),
+        ))
+
+    return xml_path
+
+
+def write_cache(directory, name, frames):
+    """Write a geometry cache; ``frames`` maps frame numbers to lists of channels."""
+
+    channel_names = [channel for channel, data in frames[min(frames)]]
+    xml_path = write_xml(
+        os.path.join(directory, name + '.xml'),
+        250 * min(frames),
+        250 * max(frames),
+        [(channel, 'FloatVectorArray', 'positions') for channel in channel_names],
+    )
+
+    for frame, channels in frames.iteritems():
+        path = os.path.join(directory, '%sFrame%d.mc' % (name, frame))
+        mcc.write_frame(path, 250 * frame, 250 * frame, channels)
+
+    return xml_path
+
+
+def write_fluid(directory, frames, resolution=(6, 5, 4), dimensions=(3.0, 2.5, 2.0),
+    interpretations=('density', 'velocity', 'resolution', 'offset'), seed=0
+):
+    """Write a fluid cache of random data, and return the path to its XML."""
+
+    shape = 'fluidShape1'
+
+    extra = []
+    for axis, dimension, res in zip('WHD', dimensions, resolution):
+        extra.append('%s.dimensions%s=%s' % (shape, axis, dimension))
+        extra.append('%s.resolution%s=%s' % (shape, axis, res))
+    xml_path = write_xml(
+        os.path.join(directory, 'fluid.xml'),
+        250 * min(frames),
+        250 * max(frames),
+        [('%s_%s' % (shape, interpretation), 'FloatArray', interpretation) for interpretation in interpretations],
+        extra,
+    )
+
+    random = np.random.RandomState(seed)
+    xr, yr, zr = resolution
+    for frame in frames:
+        data = []
+        for interpretation in interpretations:
+            if interpretation == 'velocity':
+                values = random.uniform(-1, 1, (xr + 1) * yr * zr + xr * (yr + 1) * zr + xr * yr * (zr + 1))
+            elif interpretation == 'resolution':
+                values = resolution
+            elif interpretation == 'offset':
+                values = (0.1 * frame, 0, 0)
+            else:
+                values = random.uniform(0, 1, xr * yr * zr * channel_layouts.get(interpretation, 1))
+            data.append(('%s_%s' % (shape, interpretation), np.array(values, dtype=np.float32)))
+        mcc.write_frame(os.path.join(directory, 'fluidFrame%d.mc' % frame), 250 * frame, 250 * frame, data)
+
+    return xml_path
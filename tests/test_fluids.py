@@ -0,0 +1,758 @@
+import os
+import struct
+import zlib
+from unittest import TestCase
+
+import numpy as np
+
+from mayatools import mcc
+from mayatools.fluids.core import Cache, Frame, Shape
+from mayatools.fluids.crop import crop_cache, crop_frame
+from mayatools.fluids.export import export_cache, load_arrays
+from mayatools.fluids.preview import render_cache
+from mayatools.fluids.quantize import convert_cache
+from mayatools.fluids.resample import resample_cache
+from mayatools.fluids.retime import FrameMapper, get_tick_key, load_manifest, schedule_retime
+from mayatools.fluids.stats import as_time_series, cache_stats, find_missing_times
+
+from fixtures import TempDirTestCase, write_fluid
+
+
+class TestBlend(TempDirTestCase):
+
+    def scalar_blend(self, dst_shape, blend_factor, advect_scale):
+        """The original per-voxel implementation of density blending."""
+        src_a = dst_shape.src_a
+        src_b = dst_shape.src_b
+        data = []
+        for centre in dst_shape.iter_centers():
+            vel_a = src_a.lookup_velocity(src_a.channels['velocity'], *centre)
+            vel_b = src_b.lookup_velocity(src_b.channels['velocity'], *centre)
+            centre_a = tuple(c - blend_factor * v * advect_scale for c, v in zip(centre, vel_a))
+            centre_b = tuple(c + (1 - blend_factor) * v * advect_scale for c, v in zip(centre, vel_b))
+            a = src_a.lookup_value(src_a.channels['density'], *centre_a)
+            b = src_b.lookup_value(src_b.channels['density'], *centre_b)
+            data.extend(av * (1 - blend_factor) + bv * blend_factor for av, bv in zip(a, b))
+        return np.array(data, dtype=np.float32)
+
+    def test_matches_scalar(self):
+
+        cache = Cache(write_fluid(self.root, [1, 2], resolution=(11, 8, 6), dimensions=(3.3, 2.4, 1.8)))
+        frame_a, frame_b = cache.frames
+
+        for blend_factor, advect in ((0.25, 0), (0.5, 1.0), (0.75, 2.5)):
+            dst_frame = Frame(cache)
+            dst_frame.set_times(300, 300)
+            shape = Shape.setup_blend(dst_frame, 'fluidShape1', frame_a, frame_b)
+            shape.blend_channel('density', blend_factor, advect=advect, velocity_sampling='nearest')
+            expected = self.scalar_blend(shape, blend_factor, advect)
+            self.assertEqual(shape.channels['density'].data.shape, expected.shape)
+            self.assertTrue((shape.channels['density'].data == expected).all())
+
+
+class TestSampling(TempDirTestCase):
+
+    def setUp(self):
+        super(TestSampling, self).setUp()
+        cache = Cache(write_fluid(self.root, [1], resolution=(5, 4, 3), dimensions=(2.5, 2.0, 1.5)))
+        self.shape = cache.frames[0].shapes['fluidShape1']
+
+    def test_centres_are_exact(self):
+        shape = self.shape
+        channel = shape.channels['density']
+        x, y, z = np.broadcast_arrays(*shape.center_axes())
+        expected = shape.lookup_values(channel, x, y, z)
+        for mode in ('linear', 'cubic'):
+            values = shape.sample_values(channel, x, y, z, mode)
+            self.assertTrue(np.allclose(values, expected))
+
+    def test_linear_between_faces(self):
+        shape = self.shape
+        channel = shape.channels['velocity']
+        vx, vy, vz = shape.velocity_grids(channel)
+
+        # Halfway between the first two x faces of the first voxel.
+        unit = shape.spec.unit_size
+        x = shape.bb_min[0] + 0.5 * unit[0]
+        y = shape.bb_min[1] + 0.5 * unit[1]
+        z = shape.bb_min[2] + 0.5 * unit[2]
+        value = shape.sample_velocities(channel, np.array([x]), np.array([y]), np.array([z]), 'linear')[0]
+        self.assertAlmostEqual(value[0], 0.5 * (vx[0, 0, 0] + vx[0, 0, 1]))
+        self.assertAlmostEqual(value[1], 0.5 * (vy[0, 0, 0] + vy[0, 1, 0]))
+        self.assertAlmostEqual(value[2], 0.5 * (vz[0, 0, 0] + vz[1, 0, 0]))
+
+    def test_nearest_on_max_bounds(self):
+
+        shape = self.shape
+        channel = shape.channels['velocity']
+        vx, vy, vz = shape.velocity_grids(channel)
+        unit = shape.spec.unit_size
+
+        # On the last x face, in the second row; the y and z components come
+        # from the last voxel of that row, not the start of the next one.
+        x = shape.bb_max[0]
+        y = shape.bb_min[1] + 1.5 * unit[1]
+        z = shape.bb_min[2] + 0.5 * unit[2]
+        expected = [vx[0, 1, 5], vy[0, 1, 4], vz[0, 1, 4]]
+        values = shape.lookup_velocities(channel, np.array([x]), np.array([y]), np.array([z]))
+        self.assertEqual(values[0].tolist(), expected)
+        self.assertEqual(list(shape.lookup_velocity(channel, x, y, z)), expected)
+
+        # The far corner.
+        expected = [vx[2, 3, 5], vy[2, 4, 4], vz[3, 3, 4]]
+        values = shape.lookup_velocities(channel, *(np.array([b]) for b in shape.bb_max))
+        self.assertEqual(values[0].tolist(), expected)
+        self.assertEqual(list(shape.lookup_velocity(channel, *shape.bb_max)), expected)
+
+    def test_outside_is_zero(self):
+        shape = self.shape
+        channel = shape.channels['density']
+        far = np.array([shape.bb_max[0] + 1.0])
+        centre = np.array([0.5 * (shape.bb_min[1] + shape.bb_max[1])])
+        for mode in ('nearest', 'linear', 'cubic'):
+            self.assertEqual(shape.sample_values(channel, far, centre, centre, mode).tolist(), [[0.0]])
+
+
+class TestAdvect(TempDirTestCase):
+
+    def test_uniform_velocity(self):
+
+        cache = Cache(write_fluid(self.root, [1], resolution=(5, 4, 3), dimensions=(2.5, 2.0, 1.5)))
+        shape = cache.frames[0].shapes['fluidShape1']
+        channel = shape.channels['velocity']
+        channel.data = np.zeros_like(channel.data)
+        vx, vy, vz = shape.velocity_grids(channel, channel.data)
+        vx[...] = 0.25
+        vz[...] = -0.125
+
+        x, y, z = np.broadcast_arrays(*shape.center_axes())
+        for substeps in (1, 4):
+            for mode in ('nearest', 'linear', 'cubic'):
+                x2, y2, z2 = shape.advect(x, y, z, 0.5, 2.0, substeps=substeps, sampling=mode)
+                self.assertTrue(np.allclose(x2, x - 0.25))
+                self.assertTrue(np.allclose(y2, y))
+                self.assertTrue(np.allclose(z2, z + 0.125))
+
+
+class TestBlendAll(TempDirTestCase):
+
+    def test_every_channel(self):
+
+        interpretations = ('density', 'temperature', 'color', 'velocity', 'resolution', 'offset')
+        cache = Cache(write_fluid(self.root, [1, 2], interpretations=interpretations))
+        frame_a, frame_b = cache.frames
+
+        dst_frame = Frame(cache)
+        dst_frame.set_times(300, 300)
+        shape = Shape.setup_blend(dst_frame, 'fluidShape1', frame_a, frame_b)
+        shape.blend(0.2, advect=1.0, sampling='linear')
+
+        self.assertEqual(sorted(shape.channels), sorted(interpretations))
+        xr, yr, zr = shape.resolution
+        self.assertEqual(len(shape.channels['color'].data), 3 * xr * yr * zr)
+        self.assertEqual(len(shape.channels['velocity'].data), 3 * xr * yr * zr + xr * yr + yr * zr + zr * xr)
+
+    def test_identity(self):
+
+        interpretations = ('density', 'color', 'velocity', 'resolution', 'offset')
+        cache = Cache(write_fluid(self.root, [1], interpretations=interpretations))
+        frame = cache.frames[0]
+        src = frame.shapes['fluidShape1']
+
+        for mode in ('linear', 'cubic'):
+            dst_frame = Frame(cache)
+            dst_frame.set_times(250, 250)
+            shape = Shape.setup_blend(dst_frame, 'fluidShape1', frame, frame)
+            shape.blend(0.5, sampling=mode)
+            for name in ('density', 'color', 'velocity'):
+                self.assertTrue(np.allclose(shape.channels[name].data, src.channels[name].data, atol=1e-6), (mode, name))
+
+    def test_slabs(self):
+
+        cache = Cache(write_fluid(self.root, [1, 2]))
+        frame_a, frame_b = cache.frames
+        dst_frame = Frame(cache)
+        dst_frame.set_times(300, 300)
+        shape = Shape.setup_blend(dst_frame, 'fluidShape1', frame_a, frame_b)
+
+        kwargs = dict(advect=1.0, sampling='linear')
+        whole = shape.blend_slab(['density', 'velocity'], 0.2, **kwargs)
+        zr = shape.resolution[2]
+
+        # The slabs share sources which were converted once up front.
+        sources = shape.blend_sources(['density', 'velocity'], advect=1.0)
+        self.assertEqual(sorted(sources), ['density', 'velocity'])
+        self.assertEqual(sources['density'][0].dtype, np.float64)
+        slabs = [shape.blend_slab(['density', 'velocity'], 0.2, z, min(z + 2, zr), sources=sources, **kwargs) for z in xrange(0, zr, 2)]
+
+        self.assertTrue((np.concatenate([s['density'] for s in slabs]) == whole['density']).all())
+        for axis in xrange(3):
+            joined = np.concatenate([s['velocity'][axis] for s in slabs])
+            self.assertTrue((joined == whole['velocity'][axis]).all())
+
+
+class TestFrameIndex(TempDirTestCase):
+
+    def test_negative_headers(self):
+
+        cache = Cache(write_fluid(self.root, [1]))
+        frame = cache.frames[0]
+        frame.set_times(-500, -375)
+        path = os.path.join(self.root, 'negative.mc')
+        with open(path, 'wb') as fh:
+            for chunk in frame.dumps_iter():
+                fh.write(chunk)
+
+        self.assertEqual(mcc.read_frame(path)[:2], (-500, -375))
+        reread = Frame(cache, path)
+        self.assertEqual((reread.start_time, reread.end_time), (-500, -375))
+        self.assertEqual(sorted(reread.channels), sorted(frame.channels))
+
+    def test_sorted_without_opening(self):
+
+        cache = Cache(write_fluid(self.root, [10, 2, 1, 3]))
+        self.assertEqual(cache.frame_times, [250, 500, 750, 2500])
+        self.assertEqual([f.time for f in cache.frames], cache.frame_times)
+        self.assertTrue(all(f.parser is None for f in cache.frames))
+
+        self.assertIs(cache.frame_at(750), cache.frames[2])
+        self.assertIs(cache.frame_at(800), None)
+        self.assertIs(cache.frame_at(3000), None)
+        self.assertEqual(cache.frame_at(2500).start_time, 2500)
+
+
+class TestFrameMapper(TestCase):
+
+    def test_lookups(self):
+
+        mapper = FrameMapper([(500, 'b'), (250, 'a'), (1000, 'c')])
+        self.assertEqual(mapper(250), ('a', 'a', 0.0))
+        self.assertEqual(mapper(375), ('a', 'b', 0.5))
+        self.assertEqual(mapper(625), ('b', 'c', 0.25))
+        self.assertEqual(mapper(1000), ('c', 'c', 0.0))
+        self.assertEqual(mapper.find_indices(600), (1, 2))
+
+        for time in (249, 1001.5):
+            try:
+                mapper(time)
+            except ValueError as e:
+                self.assertEqual(str(e), 'Cannot find data for time %s; have from 1:0 to 4:0' % ('0:249' if time < 250 else '4:1'))
+            else:
+                self.fail('no error for %r' % time)
+
+
+class TestRetime(TempDirTestCase):
+
+    def test_local_workers_match_serial(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2, 3])
+        serial = schedule_retime(src_path, os.path.join(self.root, 'serial', 'out.xml'), sampling_rate=0.5, farm=False)
+        pooled = schedule_retime(src_path, os.path.join(self.root, 'pooled', 'out.xml'), sampling_rate=0.5, farm=False, local_workers=2)
+
+        self.assertEqual(len(serial), 5)
+        self.assertEqual([os.path.basename(p) for p in serial], [os.path.basename(p) for p in pooled])
+        for a, b in zip(serial, pooled):
+            self.assertEqual(open(a, 'rb').read(), open(b, 'rb').read())
+
+    def test_chunks_match_single_ticks(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2, 3])
+        single = schedule_retime(src_path, os.path.join(self.root, 'single', 'out.xml'), sampling_rate=0.25, farm=False, chunk_size=1)
+        chunked = schedule_retime(src_path, os.path.join(self.root, 'chunked', 'out.xml'), sampling_rate=0.25, farm=False, chunk_size=3)
+
+        self.assertEqual(len(single), 9)
+        for a, b in zip(single, chunked):
+            self.assertEqual(open(a, 'rb').read(), open(b, 'rb').read())
+
+    def test_resume(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2, 3])
+        dst_path = os.path.join(self.root, 'dst', 'out.xml')
+
+        first = schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False)
+        self.assertEqual(len(first), 5)
+        self.assertEqual(schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False), [])
+
+        # Missing output is redone.
+        os.unlink(first[2])
+        self.assertEqual(schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False), [first[2]])
+
+        # New parameters redo everything.
+        self.assertEqual(len(schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False, sampling='linear')), 5)
+        self.assertEqual(len(schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False, sampling='linear', force=True)), 5)
+
+        # A changed source frame only redoes the ticks which use it.
+        write_fluid(os.path.join(self.root, 'src'), [3], seed=1)
+        redone = schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False, sampling='linear')
+        self.assertEqual(redone, first[3:])
+
+    def test_manifest_keys_match_frames(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2, 3])
+        dst_path = os.path.join(self.root, 'dst', 'out.xml')
+
+        # A rate of 0.3 gives ticks like 325.0000001, which must not be
+        # rounded to a different key than the frame they truncate to.
+        written = schedule_retime(src_path, dst_path, sampling_rate=0.3, farm=False)
+        keys = sorted(load_manifest(dst_path)['ticks'])
+        self.assertEqual(keys, sorted(os.path.basename(path)[3:-3] for path in written))
+        self.assertEqual(schedule_retime(src_path, dst_path, sampling_rate=0.3, farm=False), [])
+        self.assertEqual(get_tick_key(375.6), 'Frame1Tick125')
+
+    def test_storage_and_unknown_channels(self):
+
+        src_dir = os.path.join(self.root, 'src')
+        src_path = write_fluid(src_dir, [1, 2], interpretations=('density', 'color', 'velocity', 'heat', 'note', 'resolution', 'offset'))
+
+        # Store the known and unknown grids as doubles, and add something
+        # which isn't a grid at all.
+        for frame in (1, 2):
+            path = os.path.join(src_dir, 'fluidFrame%d.mc' % frame)
+            start, end, channels = mcc.read_frame(path)
+            channels = dict(channels)
+            channels['fluidShape1_density'] = channels['fluidShape1_density'].astype(np.float64)
+            channels['fluidShape1_heat'] = channels['fluidShape1_heat'].astype(np.float64)
+            channels['fluidShape1_color'] = channels['fluidShape1_color'].astype(np.float64).reshape(-1, 3)
+            channels['fluidShape1_note'] = np.array([frame, 0], dtype=np.float32)
+            mcc.write_frame(path, start, end, sorted(channels.iteritems()))
+
+        dst_path = os.path.join(self.root, 'dst', 'out.xml')
+        written = schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False, sampling='linear')
+        self.assertEqual(len(written), 3)
+
+        for i, path in enumerate(written):
+            channels = dict(mcc.read_frame(path)[2])
+            self.assertEqual(channels['fluidShape1_density'].dtype, np.dtype('>f8'), path)
+            self.assertEqual(channels['fluidShape1_heat'].dtype, np.dtype('>f8'), path)
+            self.assertEqual(channels['fluidShape1_color'].dtype, np.dtype('>f8'), path)
+            self.assertEqual(channels['fluidShape1_color'].shape, (6 * 5 * 4, 3), path)
+            self.assertEqual(channels['fluidShape1_velocity'].dtype, np.dtype('>f4'), path)
+            # The middle tick is half way, which takes the second source.
+            self.assertEqual(list(channels['fluidShape1_note']), [1 if i == 0 else 2, 0], path)
+
+
+class TestSlabParallel(TempDirTestCase):
+
+    def test_matches_serial(self):
+
+        interpretations = ('density', 'color', 'velocity', 'resolution', 'offset')
+        cache = Cache(write_fluid(self.root, [1, 2], resolution=(7, 6, 9), interpretations=interpretations))
+        frame_a, frame_b = cache.frames
+
+        blended = []
+        for slab_workers in (None, 3):
+            dst_frame = Frame(cache)
+            dst_frame.set_times(300, 300)
+            shape = Shape.setup_blend(dst_frame, 'fluidShape1', frame_a, frame_b)
+            shape.blend(0.2, sampling='linear', slab_workers=slab_workers)
+            blended.append(shape)
+
+        serial, parallel = blended
+        for name in ('density', 'color', 'velocity'):
+            self.assertEqual(serial.channels[name].data.shape, parallel.channels[name].data.shape)
+            self.assertTrue((serial.channels[name].data == parallel.channels[name].data).all(), name)
+
+
+class TestFrameBudget(TempDirTestCase):
+
+    def load(self, frame):
+        return frame.shapes['fluidShape1'].channels['density'].data
+
+    def test_files_are_closed(self):
+
+        import resource
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), range(1, 41))
+        dst_path = os.path.join(self.root, 'dst', 'out.xml')
+
+        # Leave room for what is already open, but not for a file per frame
+        # in the (unlimited) frame budget.
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = len(os.listdir('/dev/fd')) + 16
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            written = schedule_retime(src_path, dst_path, sampling_rate=0.5, farm=False)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(len(written), 79)
+
+    def test_lru(self):
+
+        cache = Cache(write_fluid(self.root, [1, 2, 3]), frame_budget=0)
+        frame_1 = cache.get_frame(cache.frames[0].path)
+        self.assertIs(frame_1, cache.frames[0])
+
+        density = frame_1.shapes['fluidShape1'].channels['density']
+        data = self.load(frame_1).copy()
+        cache.frame_budget = 2 * frame_1.nbytes
+
+        self.load(cache.frames[1])
+        self.assertEqual(len(cache._decoded_frames), 2)
+
+        # Touching the first makes the second the least recently used.
+        frame_1.shapes
+        self.load(cache.frames[2])
+        self.assertEqual(cache._decoded_frames, [frame_1, cache.frames[2]])
+        self.assertEqual(cache.frames[1].nbytes, 0)
+        self.assertEqual(cache._decoded_bytes, 2 * frame_1.nbytes)
+
+        # Evicting doesn't touch data that is still in use.
+        self.load(cache.frames[1])
+        self.load(cache.frames[0])
+        self.assertTrue((density.data == data).all())
+        self.assertIsNot(cache.frames[0].shapes['fluidShape1'].channels['density'], density)
+
+    def test_pinned(self):
+
+        cache = Cache(write_fluid(self.root, [1, 2, 3]), frame_budget=0)
+        frame_1, frame_2, frame_3 = cache.frames
+
+        # Pinned frames stay decoded even when they don't both fit.
+        with cache.pin(frame_1, frame_2):
+            self.load(frame_1)
+            self.load(frame_2)
+            self.load(frame_1)
+            self.assertEqual(cache._decoded_frames, [frame_2, frame_1])
+            self.assertTrue(frame_1.nbytes and frame_2.nbytes)
+            self.assertEqual(frame_1.pins, 1)
+
+        self.assertEqual(frame_1.pins, 0)
+        self.load(frame_3)
+        self.assertEqual(cache._decoded_frames, [frame_3])
+
+
+class TestLazyChannels(TempDirTestCase):
+
+    def test_only_used_channels_are_read(self):
+
+        interpretations = ('density', 'temperature', 'velocity', 'resolution', 'offset')
+        cache = Cache(write_fluid(self.root, [1], interpretations=interpretations))
+        frame = cache.frames[0]
+        channels = frame.shapes['fluidShape1'].channels
+
+        self.assertTrue(channels['resolution'].is_loaded)
+        self.assertFalse(channels['density'].is_loaded)
+        self.assertFalse(channels['velocity'].is_loaded)
+
+        expected = dict(mcc.read_frame(frame.path)[2])
+        self.assertTrue((channels['density'].data == expected['fluidShape1_density']).all())
+        self.assertTrue(channels['density'].is_loaded)
+        self.assertFalse(channels['velocity'].is_loaded)
+
+        # Still loadable after the frame lets go of its file.
+        frame.release()
+        self.assertTrue((channels['velocity'].data == expected['fluidShape1_velocity']).all())
+
+
+class TestGridPoints(TempDirTestCase):
+
+    def test_memoized(self):
+
+        cache = Cache(write_fluid(self.root, [1, 2], resolution=(5, 4, 3)))
+        shape_1 = cache.frames[0].shapes['fluidShape1']
+        shape_2 = cache.frames[1].shapes['fluidShape1']
+
+        xs, ys, zs = shape_1.center_axes()
+        self.assertEqual((xs.shape, ys.shape, zs.shape), ((1, 1, 5), (1, 4, 1), (3, 1, 1)))
+        self.assertIs(shape_1.center_axes()[0].base, xs.base)
+
+        # Different offsets are different grids.
+        self.assertFalse((shape_2.center_axes()[0] == xs).all())
+
+        # The face grids have one more sample along their axis.
+        self.assertEqual(shape_1.grid_points(0)[0].shape, (1, 1, 6))
+        faces = shape_1.grid_points(2, 1, 3)[2].ravel()
+        self.assertTrue(np.allclose(faces, shape_1.bb_min[2] + shape_1.spec.unit_size[2] * np.arange(1, 4)))
+        self.assertAlmostEqual(faces[-1], shape_1.bb_max[2])
+
+        self.assertEqual(list(shape_1.iter_centers())[:2], [
+            (xs.flat[0], ys.flat[0], zs.flat[0]),
+            (xs.flat[1], ys.flat[0], zs.flat[0]),
+        ])
+
+
+class TestCrop(TempDirTestCase):
+
+    def test_crop_frame(self):
+
+        cache = Cache(write_fluid(self.root, [1]))
+        frame = cache.frames[0]
+        shape = frame.shapes['fluidShape1']
+
+        density = np.zeros(6 * 5 * 4, dtype=np.float32)
+        grid = density.reshape(4, 5, 6)
+        grid[2, 1, 2:4] = (0.5, 0.25)
+        shape.channels['density'].data = density
+
+        cropped = crop_frame(frame, padding=1).shapes['fluidShape1']
+        self.assertEqual(cropped.resolution, (4, 3, 3))
+
+        # The same points in space have the same values.
+        x, y, z = np.broadcast_arrays(*cropped.center_axes())
+        for name in ('density', 'velocity'):
+            channel = shape.channels[name]
+            cropped_channel = cropped.channels[name]
+            if name == 'velocity':
+                a = shape.sample_velocities(channel, x, y, z, 'linear')
+                b = cropped.sample_velocities(cropped_channel, x, y, z, 'linear')
+            else:
+                a = shape.sample_values(channel, x, y, z)
+                b = cropped.sample_values(cropped_channel, x, y, z)
+            self.assertTrue(np.allclose(a, b, atol=1e-6), name)
+        self.assertEqual(cropped.channels['density'].data.sum(), 0.75)
+
+    def test_crop_cache(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2], interpretations=('density', 'velocity'))
+        results = crop_cache(src_path, os.path.join(self.root, 'dst', 'out.xml'), workers=1)
+        self.assertEqual(len(results), 2)
+
+        # The metadata channels were added, so the frames can describe themselves.
+        cache = Cache(os.path.join(self.root, 'dst', 'out.xml'))
+        self.assertIn('fluidShape1_resolution', cache.channel_specs)
+        self.assertIn('fluidShape1_offset', cache.channel_specs)
+        self.assertEqual(cache.frame_times, [250, 500])
+        shape = cache.frames[0].shapes['fluidShape1']
+        self.assertEqual(shape.resolution, (6, 5, 4))
+        self.assertEqual(shape.offset, (0.0, 0.0, 0.0))
+
+
+class TestResample(TempDirTestCase):
+
+    def test_half_res(self):
+
+        src_path = write_fluid(os.path.join(self.root, 'src'), [1, 2], resolution=(8, 6, 4), dimensions=(4.0, 3.0, 2.0))
+        dst_path = os.path.join(self.root, 'dst', 'out.xml')
+
+        for filter in ('linear', 'box'):
+
+            written = resample_cache(src_path, dst_path, scale=0.5, filter=filter, workers=1)
+            self.assertEqual(len(written), 2)
+
+            src = Cache(src_path).frames[0].shapes['fluidShape1']
+            dst = Cache(dst_path).frames[0].shapes['fluidShape1']
+            self.assertEqual(dst.spec.resolution, (4, 3, 2))
+            self.assertEqual(dst.resolution, (4, 3, 2))
+            self.assertEqual(dst.spec.unit_size, (1.0, 1.0, 1.0))
+            self.assertTrue(np.allclose(dst.bb_min, src.bb_min))
+
+            # Each new voxel is the average of 8 old ones.
+            expected = src.value_grid(src.channels['density']).reshape(2, 2, 3, 2, 4, 2).mean(axis=(1, 3, 5))
+            self.assertTrue(np.allclose(dst.value_grid(dst.channels['density']).ravel(), expected.ravel(), atol=1e-6))
+
+            xr, yr, zr = dst.resolution
+            self.assertEqual(len(dst.channels['velocity'].data), 3 * xr * yr * zr + xr * yr + yr * zr + zr * xr)
+
+
+class TestStats(TempDirTestCase):
+
+    def test_stats(self):
+
+        xml_path = write_fluid(self.root, [1, 2, 4], interpretations=('density', 'velocity', 'color'))
+        with open(os.path.join(self.root, 'fluidFrame2.mc'), 'wb') as fh:
+            fh.write('FOR4')
+
+        result, = cache_stats([xml_path], threshold=0.5, workers=1)
+        self.assertEqual(result['times'], [250, 500, 1000])
+        self.assertEqual(result['missing_times'], [750])
+        self.assertEqual(sorted(result['errors']), [500])
+        self.assertEqual([time for time, _ in result['frames']], [250, 1000])
+
+        frame = Cache(xml_path).frames[0]
+        shape = frame.shapes['fluidShape1']
+        density = np.asarray(shape.channels['density'].data, dtype=np.float64)
+        stats = dict(((s, i), v) for s, i, v in result['frames'][0][1])
+        self.assertEqual(sorted(i for _, i in stats), ['color', 'density', 'velocity'])
+
+        values = stats['fluidShape1', 'density']
+        self.assertAlmostEqual(values['min'], density.min())
+        self.assertAlmostEqual(values['max'], density.max())
+        self.assertAlmostEqual(values['mean'], density.mean())
+        self.assertEqual(values['occupied'], (density > 0.5).sum())
+        self.assertAlmostEqual(values['total'], density.sum() * 0.5 ** 3, places=4)
+        self.assertEqual(values['nonfinite'], 0)
+        self.assertEqual(stats['fluidShape1', 'velocity']['occupied'], None)
+
+        series = as_time_series(result)
+        self.assertEqual(series['series']['fluidShape1.density']['max'][1], None)
+        self.assertAlmostEqual(series['series']['fluidShape1.density']['max'][0], density.max())
+
+    def test_missing_times(self):
+        self.assertEqual(find_missing_times([250, 375, 500, 1250, 1375]), [750, 1000])
+        self.assertEqual(find_missing_times([250, 500, 750]), [])
+
+
+def read_png(path):
+    """Decode the 8-bit PNGs written by :func:`write_png`."""
+    with open(path, 'rb') as fh:
+        data = fh.read()
+    assert data[:8] == '\x89PNG\r\n\x1a\n'
+    pos = 8
+    chunks = {}
+    while pos < len(data):
+        size, = struct.unpack('>I', data[pos:pos + 4])
+        chunks[data[pos + 4:pos + 8]] = data[pos + 8:pos + 8 + size]
+        pos += 12 + size
+    width, height, depth, colour_type = struct.unpack('>IIBB', chunks['IHDR'][:10])
+    channels = 3 if colour_type == 2 else 1
+    raw = np.frombuffer(zlib.decompress(chunks['IDAT']), dtype=np.uint8).reshape(height, -1)
+    return raw[:, 1:].reshape((height, width, channels) if channels > 1 else (height, width))
+
+
+class TestPreview(TempDirTestCase):
+
+    def test_render(self):
+
+        xml_path = write_fluid(os.path.join(self.root, 'src'), [1, 2], interpretations=('density', 'temperature'))
+        out = os.path.join(self.root, 'preview')
+
+        written = render_cache(xml_path, out, axis='z', mode='max', temperature=False, workers=1)
+        self.assertEqual(len(written), 2)
+
+        shape = Cache(xml_path).frames[0].shapes['fluidShape1']
+        density = shape.value_grid(shape.channels['density'])[..., 0]
+        expected = (np.clip(density.max(axis=0), 0, 1) * 255 + 0.5).astype(np.uint8)[::-1]
+        pixels = read_png(written[0])
+        self.assertEqual(pixels.shape, (5, 6))
+        self.assertTrue((pixels == expected).all())
+
+        # Up to date previews are skipped.
+        self.assertEqual(render_cache(xml_path, out, axis='z', mode='max', temperature=False, workers=1), [])
+        self.assertEqual(len(render_cache(xml_path, out, axis='z', mode='max', temperature=False, workers=1, force=True)), 2)
+
+        written = render_cache(xml_path, out, axis='x', mode='sum', workers=1)
+        pixels = read_png(written[0])
+        self.assertEqual(pixels.shape, (5, 4, 3))
+        self.assertTrue(pixels.any())
+
+
+class TestExport(TempDirTestCase):
+
+    def test_export(self):
+
+        xml_path = write_fluid(os.path.join(self.root, 'src'), [1, 2], interpretations=('density', 'velocity', 'color'))
+        shape = Cache(xml_path).frames[1].shapes['fluidShape1']
+        density = shape.value_grid(shape.channels['density'])[..., 0]
+        color = shape.value_grid(shape.channels['color'])
+        vx, vy, vz = shape.velocity_grids(shape.channels['velocity'])
+
+        for format in ('npz', 'npy'):
+            written = export_cache(xml_path, os.path.join(self.root, format), format=format, workers=1)
+            self.assertEqual(len(written), 2)
+            arrays = load_arrays(written[1])
+            self.assertEqual(int(arrays['start_time']), 500)
+            self.assertEqual(list(arrays['fluidShape1.resolution']), [6, 5, 4])
+            self.assertTrue(np.allclose(arrays['fluidShape1.offset'], shape.offset))
+            self.assertEqual(arrays['fluidShape1.density'].shape, (4, 5, 6))
+            self.assertTrue((arrays['fluidShape1.density'] == density).all())
+            self.assertTrue((arrays['fluidShape1.color'] == color).all())
+            self.assertTrue((arrays['fluidShape1.velocity_x'] == vx).all())
+            self.assertTrue((arrays['fluidShape1.velocity_y'] == vy).all())
+            self.assertTrue((arrays['fluidShape1.velocity_z'] == vz).all())
+
+        self.assertTrue(isinstance(arrays['fluidShape1.density'], np.memmap))
+
+    def test_unknown_channels(self):
+
+        xml_path = write_fluid(os.path.join(self.root, 'src'), [1], interpretations=('density', 'heat', 'resolution'))
+        shape = Cache(xml_path).frames[0].shapes['fluidShape1']
+        heat = shape.value_grid(shape.channels['heat'])[..., 0]
+
+        written = export_cache(xml_path, os.path.join(self.root, 'out'), workers=1)
+        arrays = load_arrays(written[0])
+        self.assertEqual(arrays['fluidShape1.heat'].shape, (4, 5, 6))
+        self.assertTrue((arrays['fluidShape1.heat'] == heat).all())
+
+
+class TestQuantize(TempDirTestCase):
+
+    def test_round_trip(self):
+
+        xml_path = write_fluid(os.path.join(self.root, 'src'), [1, 2], interpretations=('density', 'temperature', 'velocity', 'resolution', 'offset'))
+        small_path = os.path.join(self.root, 'small', 'fluid.xml')
+        back_path = os.path.join(self.root, 'back', 'fluid.xml')
+
+        storage = dict(density='uint8', temperature='float16', velocity='uint16')
+        convert_cache(xml_path, small_path, storage, workers=1)
+        convert_cache(small_path, back_path, workers=1)
+
+        self.assertTrue(os.path.getsize(os.path.join(self.root, 'small', 'fluidFrame1.mc')) < 0.6 * os.path.getsize(os.path.join(self.root, 'src', 'fluidFrame1.mc')))
+
+        src = Cache(xml_path).frames[0].shapes['fluidShape1']
+        small = Cache(small_path).frames[0].shapes['fluidShape1']
+        back = Cache(back_path).frames[0].shapes['fluidShape1']
+        self.assertEqual(small.resolution, src.resolution)
+        self.assertEqual(small.offset, src.offset)
+
+        for interpretation, tolerance in (('density', 0.5 / 255), ('temperature', 1e-3), ('velocity', 1.0 / 65535)):
+            original = np.asarray(src.channels[interpretation].data, dtype=np.float64)
+            compact = np.asarray(small.channels[interpretation].data)
+            self.assertEqual(compact.dtype, np.float32)
+            self.assertTrue(np.abs(compact - original).max() <= tolerance * 1.01, interpretation)
+            self.assertTrue((np.asarray(back.channels[interpretation].data) == compact).all(), interpretation)
+
+        # Converted back, every channel is a standard array again.
+        data = mcc.read_frame(os.path.join(self.root, 'back', 'fluidFrame1.mc'))[2]
+        self.assertEqual(sorted(name for name, _ in data), sorted(src.frame.channels))
+
+
+class TestArrayTypes(TempDirTestCase):
+
+    def test_mixed_types(self):
+
+        interpretations = ('density', 'velocity', 'color', 'resolution', 'offset', 'heat')
+        xml_path = write_fluid(self.root, [1], interpretations=interpretations)
+        frame_path = os.path.join(self.root, 'fluidFrame1.mc')
+
+        # Rewrite the frame with doubles, vectors, and an unknown channel.
+        start, end, channels = mcc.read_frame(frame_path)
+        channels = dict(channels)
+        random = np.random.RandomState(1)
+        density = random.uniform(0, 1, 120)
+        color = random.uniform(0, 1, (120, 3)).astype(np.float32)
+        heat = random.uniform(0, 1, (120, 3))
+        channels['fluidShape1_density'] = density
+        channels['fluidShape1_color'] = color
+        channels['fluidShape1_heat'] = heat
+        mcc.write_frame(frame_path, start, end, sorted(channels.iteritems()))
+
+        # Some exporters write doubles as DBCA.
+        with open(frame_path, 'rb') as fh:
+            raw = fh.read()
+        with open(frame_path, 'wb') as fh:
+            fh.write(raw.replace('DBLA', 'DBCA'))
+
+        frame = Cache(xml_path).frames[0]
+        shape = frame.shapes['fluidShape1']
+        self.assertEqual(shape.channels['density'].data.dtype, np.dtype('>f8'))
+        self.assertTrue((shape.channels['density'].data == density).all())
+        self.assertEqual(shape.channels['density'].storage, 'float64')
+        self.assertEqual(shape.channels['color'].storage, 'float32_vector')
+        self.assertTrue((shape.value_grid(shape.channels['color']) == color.reshape(4, 5, 6, 3)).all())
+        self.assertEqual(shape.channels['heat'].data_size, 3)
+        self.assertEqual(shape.channels['resolution'].data_size, 0)
+
+        # Channels are written back as they were read, with DBLA for doubles.
+        out_path = os.path.join(self.root, 'out.mc')
+        with open(out_path, 'wb') as fh:
+            for chunk in frame.dumps_iter():
+                fh.write(chunk)
+        channels = dict(mcc.read_frame(out_path)[2])
+        self.assertEqual(channels['fluidShape1_density'].dtype, np.dtype('>f8'))
+        self.assertTrue((channels['fluidShape1_density'] == density).all())
+        self.assertTrue((channels['fluidShape1_color'] == color).all())
+        self.assertTrue((channels['fluidShape1_heat'] == heat).all())
+
+        # The vectorized engines take them all.
+        result, = cache_stats([xml_path], workers=1)
+        stats = dict((i, v) for s, i, v in result['frames'][0][1])
+        self.assertAlmostEqual(stats['density']['max'], density.max())
+        self.assertEqual(stats['heat']['occupied'], 120)
+
+        dst = Frame(frame.cache)
+        dst.set_times(250, 250)
+        blended = Shape.setup_blend(dst, 'fluidShape1', shape, shape)
+        blended.blend(0.5, advect=0.0)
+        self.assertTrue(np.allclose(dst.shapes['fluidShape1'].channels['density'].data, density))
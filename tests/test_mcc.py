@@ -0,0 +1,311 @@
+import os
+import sys
+from StringIO import StringIO
+
+import numpy as np
+
+from mayatools import batch, binary, mcc
+from mayatools.geocache import bounds
+
+from fixtures import TempDirTestCase, write_cache
+
+
+class TestFrames(TempDirTestCase):
+
+    def test_round_trip(self):
+
+        points = np.arange(12, dtype=np.float32).reshape(-1, 3)
+        path = os.path.join(self.root, 'cacheFrame1.mc')
+        mcc.write_frame(path, 250, 250, [('a', points), ('b', points.astype(np.float64))])
+
+        start, end, channels = mcc.read_frame(path)
+        self.assertEqual((start, end), (250, 250))
+        self.assertEqual([name for name, data in channels], ['a', 'b'])
+        self.assertEqual(channels[0][1].dtype, np.dtype('>f4'))
+        self.assertEqual(channels[1][1].dtype, np.dtype('>f8'))
+        self.assertTrue((channels[0][1] == points).all())
+        self.assertTrue((channels[1][1] == points).all())
+
+        # The original parser should agree with us.
+        self.assertEqual(mcc.get_channels(os.path.join(self.root, 'cache.xml')), [('a', 4), ('b', 4)])
+
+    def test_negative_times(self):
+        path = os.path.join(self.root, 'cacheFrame-2.mc')
+        mcc.write_frame(path, -500, -375, [('a', np.zeros((2, 3), dtype=np.float32))])
+        self.assertEqual(mcc.read_frame(path)[:2], (-500, -375))
+
+    def test_frame_paths(self):
+        points = np.zeros((1, 3), dtype=np.float32)
+        xml_path = write_cache(self.root, 'cache', dict((i, [('a', points)]) for i in (1, 2, 10)))
+        times = [time for time, path in mcc.CacheDescriptor.get(xml_path).frames]
+        self.assertEqual(times, [250, 500, 2500])
+
+
+class TestBinary(TempDirTestCase):
+
+    def test_skipped_chunks(self):
+
+        points = np.arange(12, dtype=np.float32).reshape(-1, 3)
+        path = os.path.join(self.root, 'cacheFrame1.mc')
+        mcc.write_frame(path, 250, 250, [('a', points)])
+
+        with open(path, 'rb') as fh:
+            parser = binary.Parser(fh, skip_tags=['FVCA'])
+            parser.parse_all()
+            chunk = parser.find_one('FVCA')
+            self.assertIs(chunk.data, None)
+            self.assertEqual(repr(chunk), '<Chunk FVCA; 48 bytes>')
+
+            stdout = sys.stdout
+            sys.stdout = out = StringIO()
+            try:
+                parser.pprint()
+            finally:
+                sys.stdout = stdout
+            self.assertIn('FVCA; 48 bytes (not loaded)', out.getvalue())
+
+            chunk.data = parser.read_data(chunk)
+            self.assertEqual(repr(chunk), '<Chunk FVCA; 48 bytes>')
+
+    def test_compact_encodings(self):
+        half = np.array([1.5, -2], dtype='>f2').tostring()
+        self.assertEqual(binary.get_encoder('FHCA').repr_chunk(half), '1.5 -2.0')
+        self.assertEqual(binary.hexdump(half, tag='FHCA').split(None, 2)[-1].strip(), '1.5 -2.0')
+        double = np.array([0.25], dtype='>f8').tostring()
+        self.assertEqual(binary.get_encoder('DBCA').repr_chunk(double), '0.25')
+
+
+class TestBounds(TempDirTestCase):
+
+    def test_incremental(self):
+
+        points = np.zeros((4, 3), dtype=np.float32)
+        points[:, 0] = np.arange(4)
+        frames = {}
+        for i in range(1, 6):
+            moved = points.copy()
+            moved[:, 1] = i
+            frames[i] = [('static', points), ('moving', moved)]
+        xml_path = write_cache(self.root, 'cache', frames)
+
+        index = bounds.update_index(xml_path, workers=1)
+        self.assertEqual(len(index['frames']), 5)
+        self.assertEqual(bounds.get_static_channels(index), ['static'])
+        bb_min, bb_max = bounds.get_channel_bounds(index)['moving']
+        self.assertEqual(bb_min, (0, 1, 0))
+        self.assertEqual(bb_max, (3, 5, 0))
+        self.assertEqual(index['frames'][0]['channels']['moving'][6], None)
+        self.assertEqual(index['frames'][1]['channels']['moving'][6], 1.0)
+
+        # Make the static channel move in frame 3, which should affect the
+        # motion of frames 3 and 4 only.
+        moved = points.copy()
+        moved[:, 2] = 2
+        path = os.path.join(self.root, 'cacheFrame3.mc')
+        mcc.write_frame(path, 750, 750, [('static', moved), ('moving', frames[3][1][1])])
+        os.utime(path, (0, 0))
+
+        index = bounds.update_index(xml_path, workers=1)
+        motions = [entry['channels']['static'][6] for entry in index['frames']]
+        self.assertEqual(motions, [None, 0.0, 2.0, 2.0, 0.0])
+        self.assertEqual(bounds.get_static_channels(index), [])
+
+    def test_scalar_channels(self):
+
+        points = np.arange(12, dtype=np.float32).reshape(-1, 3)
+        frames = {}
+        for i in range(1, 3):
+            # One with a count which could be mistaken for points, and one not.
+            frames[i] = [('positions', points * i), ('radiusPP', np.ones(4, dtype=np.float32)), ('ids', np.arange(3, dtype=np.float32))]
+        xml_path = write_cache(self.root, 'cache', frames)
+
+        index = bounds.update_index(xml_path, workers=1)
+        self.assertEqual(sorted(index['frames'][0]['channels']), ['positions'])
+        bb_min, bb_max = bounds.get_channel_bounds(index)['positions']
+        self.assertEqual((bb_min, bb_max), ((0, 1, 2), (18, 20, 22)))
+        self.assertEqual(bounds.get_static_channels(index), [])
+
+
+class TestRetime(TempDirTestCase):
+
+    def test_linear_and_hermite(self):
+
+        from mayatools.geocache import retime
+
+        frames = {}
+        for i in range(1, 6):
+            points = np.zeros((3, 3), dtype=np.float32)
+            points[:, 0] = i * i
+            frames[i] = [('a', points)]
+        src_path = write_cache(os.path.join(self.root, 'src'), 'cache', frames)
+
+        dst_path = os.path.join(self.root, 'dst', 'cache.xml')
+        written = retime.schedule_retime(src_path, dst_path, sampling_rate=0.5, workers=1, chunk_size=3)
+        self.assertEqual(len(written), 9)
+        self.assertEqual([time for time, path in mcc.CacheDescriptor.get(dst_path).frames], range(250, 1251, 125))
+
+        start, end, channels = mcc.read_frame(os.path.join(self.root, 'dst', 'cacheFrame2Tick125.mc'))
+        self.assertEqual(start, 625)
+        self.assertEqual(channels[0][1][0, 0], 6.5)
+
+        retime.schedule_retime(src_path, dst_path, sampling_rate=0.5, workers=1, interpolation='hermite')
+        start, end, channels = mcc.read_frame(os.path.join(self.root, 'dst', 'cacheFrame2Tick125.mc'))
+        self.assertEqual(channels[0][1][0, 0], 6.25)
+
+
+class TestDiff(TempDirTestCase):
+
+    def test_basics(self):
+
+        from mayatools.geocache import diff
+
+        points = np.zeros((4, 3), dtype=np.float32)
+        moved = points.copy()
+        moved[0] = (3, 4, 0)
+        path_a = write_cache(os.path.join(self.root, 'a'), 'cache', dict((i, [('a', points), ('b', points)]) for i in range(1, 5)))
+        path_b = write_cache(os.path.join(self.root, 'b'), 'cache', {
+            2: [('a', points), ('b', points)],
+            3: [('a', moved), ('b', points[:2])],
+            4: [('a', points), ('b', points)],
+            5: [('a', points), ('b', points)],
+        })
+
+        report = diff.diff_caches(path_a, path_b, workers=2)
+        self.assertEqual(report.times, [500, 750, 1000])
+        self.assertEqual(report.missing_a, [1250])
+        self.assertEqual(report.missing_b, [250])
+        self.assertEqual(report.frames[750]['a'], (4, 4, 5.0, 1.25))
+        self.assertEqual(report.channel_summary('b'), (0.0, 0.0, [750]))
+        self.assertTrue(report.differs())
+        self.assertEqual(list(report.iter_heatmap_lines())[1:], ['a | @ |', 'b | X |'])
+
+
+class TestSplice(TempDirTestCase):
+
+    def test_replace_tail_in_place(self):
+
+        from mayatools import splice
+
+        old = np.zeros((2, 3), dtype=np.float32)
+        new = np.ones((2, 3), dtype=np.float32)
+        base_path = write_cache(os.path.join(self.root, 'base'), 'cache', dict((i, [('a', old)]) for i in range(1, 11)))
+        fix_path = write_cache(os.path.join(self.root, 'fix'), 'cache', dict((i, [('a', new)]) for i in range(1, 4)))
+        untouched = os.stat(os.path.join(self.root, 'base', 'cacheFrame1.mc'))
+
+        res = splice.splice_caches(base_path, [
+            (base_path, None, 8),
+            splice.parse_segment(fix_path + ':1-2@9'),
+        ])
+        self.assertEqual([time for time, path, moved in res], range(250, 2501, 250))
+        self.assertEqual([moved for time, path, moved in res], [False] * 8 + [True] * 2)
+
+        frames = mcc.CacheDescriptor.get(base_path).frames
+        self.assertEqual(len(frames), 10)
+        self.assertEqual(os.stat(frames[0][1]).st_ino, untouched.st_ino)
+        start, end, channels = mcc.read_frame(frames[-1][1])
+        self.assertEqual((start, end), (2500, 2500))
+        self.assertTrue((channels[0][1] == new).all())
+
+    def test_negative_times(self):
+
+        from mayatools import splice
+
+        src = os.path.join(self.root, 'src.mc')
+        dst = os.path.join(self.root, 'dst.mc')
+        mcc.write_frame(src, 250, 250, [('a', np.zeros((2, 3), dtype=np.float32))])
+        splice._copy_with_time(src, dst, -500)
+        offsets = splice._find_header_offsets(dst)
+        self.assertEqual((offsets['STIM'][1], offsets['ETIM'][1]), (-500, -500))
+        self.assertEqual(mcc.read_frame(dst)[:2], (-500, -500))
+        splice._copy_with_time(dst, src, 750)
+        self.assertEqual(mcc.read_frame(src)[:2], (750, 750))
+
+    def test_negative_dst_start(self):
+
+        from mayatools import splice
+
+        points = np.zeros((2, 3), dtype=np.float32)
+        src_path = write_cache(os.path.join(self.root, 'src'), 'cache', dict((i, [('a', points)]) for i in range(1, 5)))
+        dst_path = os.path.join(self.root, 'dst', 'cache.xml')
+
+        res = splice.splice_caches(dst_path, [splice.parse_segment(src_path + ':1-4@-2')])
+        self.assertEqual([time for time, path, moved in res], [-500, -250, 0, 250])
+
+        frames = mcc.CacheDescriptor.get(dst_path).frames
+        self.assertEqual([time for time, path in frames], [-500, -250, 0, 250])
+        self.assertEqual(os.path.basename(frames[0][1]), 'cacheFrame-2.mc')
+        self.assertEqual([mcc.read_frame(path)[0] for time, path in frames], [-500, -250, 0, 250])
+
+        # Splicing again replaces the frames before zero too.
+        splice.splice_caches(dst_path, [(src_path, 1, 2, 0.5)])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(dst_path))), [
+            'cache.xml', 'cacheFrame0Tick125.mc', 'cacheFrame1Tick125.mc',
+        ])
+        self.assertEqual(mcc.get_frame_name('', -375), 'Frame-2Tick125.mc')
+
+
+class TestDescriptor(TempDirTestCase):
+
+    def test_memoization(self):
+
+        points = np.zeros((2, 3), dtype=np.float32)
+        xml_path = write_cache(self.root, 'cache', dict((i, [('a', points), ('b', points)]) for i in (1, 2)))
+        os.utime(xml_path, (0, 0))
+
+        cache = mcc.CacheDescriptor.get(xml_path)
+        self.assertIs(cache, mcc.CacheDescriptor.get(os.path.join(self.root, '.', 'cache.xml')))
+        self.assertEqual(cache.time_per_frame, 250)
+        self.assertEqual(cache.time_range, (250, 500))
+        self.assertEqual(cache.channel_names, ['a', 'b'])
+        self.assertEqual(cache.point_counts, [('a', 2), ('b', 2)])
+        self.assertEqual(cache.frame_range, (250, 500))
+        self.assertIs(cache.etree, cache.etree)
+
+        # New frames and XML modifications are picked up.
+        mcc.write_frame(os.path.join(self.root, 'cacheFrame3.mc'), 750, 750, [('a', points)])
+        self.assertEqual(cache.frame_range, (250, 750))
+        tree = cache.copy_etree()
+        mcc.set_time_range(tree, 250, 750)
+        tree.write(xml_path)
+        self.assertEqual(cache.time_range, (250, 750))
+
+    def test_broken_xml(self):
+
+        points = np.zeros((2, 3), dtype=np.float32)
+        xml_path = write_cache(self.root, 'cache', dict((i, [('a', points)]) for i in (1, 2)))
+        with open(xml_path, 'w') as fh:
+            fh.write('<Autodesk_Cache_File>')
+
+        cache = mcc.CacheDescriptor(xml_path)
+        self.assertRaises(mcc.ParseError, lambda: cache.frames)
+
+        # The frames are still found beside the XML.
+        self.assertEqual(mcc.get_channels(xml_path, memoize=False), [('a', 2)])
+        os.unlink(xml_path)
+        self.assertEqual(mcc.get_channels(xml_path, memoize=False), [('a', 2)])
+
+
+class TestBatch(TempDirTestCase):
+
+    def test_run_tasks(self):
+        self.assertEqual(batch.run_tasks(pow, [(2, 3), (3, 2)], workers=1), [8, 9])
+        self.assertEqual(batch.run_tasks(pow, [(2, 3), (3, 2)], workers=2), [8, 9])
+
+    def test_check_xml_dst(self):
+        path, base = batch.check_xml_dst(os.path.join(self.root, 'a', 'b.xml'))
+        self.assertEqual(base, os.path.join(self.root, 'a', 'b'))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'a')))
+        self.assertRaises(ValueError, batch.check_xml_dst, os.path.join(self.root, 'b.mc'))
+
+    def test_atomic_write(self):
+        path = os.path.join(self.root, 'file')
+        with batch.atomic_write(path) as fh:
+            fh.write('good')
+        try:
+            with batch.atomic_write(path) as fh:
+                fh.write('bad')
+                raise ValueError('failed')
+        except ValueError:
+            pass
+        self.assertEqual(open(path).read(), 'good')
+        self.assertEqual(os.listdir(self.root), ['file'])